@@ -0,0 +1,328 @@
+#! /usr/bin/env python
+"""
+micro-benchmarks of the hot paths of extraction and calling, on fixed synthetic inputs.
+reports ops/s and peak memory (tracemalloc) per op, and compares them with stored baselines.
+
+usage (from the root of the repo):
+    python benchmarks/bench_hot_paths.py                      # run all, compare with baselines
+    python benchmarks/bench_hot_paths.py --filter cigar       # run the benchmarks matching a regex
+    python benchmarks/bench_hot_paths.py --save_baseline      # store results as the new baselines
+
+benchmarks/baselines.json is the baseline committed with the repo, recorded on the machine and with the
+python/numpy/torch versions saved in it. ops/s only compare on the same machine and versions, so before
+using --max_slowdown as a gate on another machine, run --save_baseline there on the base commit (or pass
+--baseline with a file made that way), then run the comparison on the changes.
+"""
+import os
+import sys
+import re
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import contextlib
+from queue import Queue
+from importlib import metadata
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+import numpy as np
+
+from ccsmeth import extract_features as ef
+from ccsmeth.utils.process_utils import get_motif_seqs
+
+baseline_default = os.path.join(here, "baselines.json")
+
+seed = 1234
+ref_len = 30000
+subread_len = 15000
+n_subreads = 8
+seq_len = 21
+
+
+def _package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def _env_info():
+    return {"python": platform.python_version(),
+            "machine": platform.machine(),
+            "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "system": platform.system(),
+            "numpy": np.__version__,
+            "torch": _package_version("torch")}
+
+
+class _Args(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _random_seq(rng, length, cg_ratio=0.02):
+    seq = rng.choice(list("ACGT"), size=length)
+    # plant CpGs so that the site density is close to real genomes
+    cg_idxs = rng.choice(np.arange(0, length - 1, 2), size=int(length * cg_ratio), replace=False)
+    seq[cg_idxs] = "C"
+    seq[cg_idxs + 1] = "G"
+    return "".join(seq)
+
+
+def _random_cigar(rng, length):
+    """
+    :return: cigar, and the query length it consumes
+    """
+    ops = []
+    left, qlen = length, 0
+    while left > 0:
+        num = int(min(left, rng.integers(50, 300)))
+        ops.append("{}=".format(num))
+        left -= num
+        qlen += num
+        if left > 0:
+            num, op = int(rng.integers(1, 3)), "ID"[int(rng.integers(0, 2))]
+            ops.append("{}{}".format(num, op))
+            qlen += num if op == "I" else 0
+    return "".join(ops), qlen
+
+
+class SyntheticData(object):
+    def __init__(self):
+        rng = np.random.default_rng(seed)
+        random.seed(seed)
+        self.motifs = get_motif_seqs("CG")
+        self.contigs = {"chr1": _random_seq(rng, ref_len)}
+        self.args = _Args(mod_loc=0, seq_len=seq_len, methy_label=1, depth=1, num_subreads=0, seed=seed,
+                          norm="zscore", identity=0.8, two_strands=False, comb_strands=False,
+                          no_decode=False, motif_index=None)
+        cigar_qlens = [_random_cigar(rng, subread_len) for _ in range(n_subreads)]
+        self.cigars = [cigar for cigar, _ in cigar_qlens]
+        self.raw_signals = [rng.integers(0, 256, size=qlen).astype(np.int64) for _, qlen in cigar_qlens]
+
+        # subreads of one strand of a hole, as used by _handle_one_strand_of_hole2
+        self.subreads_fwd, self.subreads_bwd = [], []
+        for idx, cigar in enumerate(self.cigars):
+            _, blocks = ef._parse_cigar_blocks(cigar)
+            start = int(rng.integers(0, 100))
+            words = ["m0/1/{}".format(idx), "0", "chr1", str(start + 1), "60", cigar, "*", "0", "0", "*", "*",
+                     ("ip", "C", self.raw_signals[idx]), ("pw", "C", self.raw_signals[idx][::-1])]
+            self.subreads_fwd.append((start, "+", blocks, words))
+            self.subreads_bwd.append((start, "-", blocks, words))
+
+        self.fwd_features = ef._handle_one_strand_of_hole2("m0/1", "chr1", "+", self.subreads_fwd,
+                                                           self.contigs, self.motifs, self.args)
+        self.bwd_features = ef._handle_one_strand_of_hole2("m0/1", "chr1", "-", self.subreads_bwd,
+                                                           self.contigs, self.motifs, self.args)
+        self.comb_features = ef._comb_fb_features(self.fwd_features, self.bwd_features)
+        self.feature_strs = [ef._features_to_str(feature) for feature in self.fwd_features]
+        self.combfeature_strs = [ef._features_to_str_combedfeatures(feature) for feature in self.comb_features]
+
+        # aggregated arrays of one strand, as used by _extract_kmer_features
+        span = ref_len - 200
+        self.kmer_inputs = ([round(x, 6) for x in rng.normal(size=span)],
+                            [round(x, 6) for x in rng.random(size=span)],
+                            [round(x, 6) for x in rng.normal(size=span)],
+                            [round(x, 6) for x in rng.random(size=span)],
+                            [int(x) for x in rng.integers(1, 10, size=span)])
+        self.kmer_span = span
+
+
+def _run_format_worker(format_func, featurestrs):
+    in_q, out_q = Queue(), Queue()
+    in_q.put((0, [line.split("\t") for line in featurestrs]))
+    in_q.put("kill")
+    format_func(in_q, out_q)
+    return out_q.get()[1]
+
+
+def get_benchmarks(data):
+    """
+    :return: list of (name, func, n_items), n_items is the number of items (sites/signals/lines)
+    processed by one call, for reporting items/s
+    """
+    args = data.args
+    ipd_m, ipd_s, pw_m, pw_s, depth = data.kmer_inputs
+    benchmarks = [
+        ("extract._parse_cigar", lambda: ef._parse_cigar(data.cigars[0]), 1),
+        ("extract._parse_cigar_blocks", lambda: ef._parse_cigar_blocks(data.cigars[0]), 1),
+        ("extract._normalize_signals", lambda: ef._normalize_signals(data.raw_signals[0], "zscore"), 1),
+        ("extract._handle_one_strand_of_hole2",
+         lambda: ef._handle_one_strand_of_hole2("m0/1", "chr1", "+", data.subreads_fwd, data.contigs,
+                                                data.motifs, args), 1),
+        ("extract._extract_kmer_features",
+         lambda: ef._extract_kmer_features("m0/1", "chr1", 100, 100 + data.kmer_span - 1, "+",
+                                           ipd_m, ipd_s, pw_m, pw_s, depth, n_subreads, [],
+                                           data.motifs, args.mod_loc, args.seq_len, args.methy_label,
+                                           args.depth, args.num_subreads, args.seed, data.contigs), 1),
+        ("extract._comb_fb_features",
+         lambda: ef._comb_fb_features(data.fwd_features, data.bwd_features), len(data.fwd_features)),
+        ("extract._features_to_str",
+         lambda: [ef._features_to_str(feature) for feature in data.fwd_features], len(data.fwd_features)),
+        ("extract._features_to_str_combedfeatures",
+         lambda: [ef._features_to_str_combedfeatures(feature) for feature in data.comb_features],
+         len(data.comb_features)),
+    ]
+    try:
+        import torch
+    except ImportError:
+        sys.stderr.write("torch is not installed, skip benchmarks of calling\n")
+        return benchmarks
+
+    from ccsmeth import call_modifications as cm
+    from ccsmeth import dataloader as dl
+    from ccsmeth import models
+
+    benchmarks += [
+        ("call._format_features_from_strbatch1",
+         lambda: _run_format_worker(cm._format_features_from_strbatch1, data.feature_strs),
+         len(data.feature_strs)),
+        ("call._format_features_from_strbatch2",
+         lambda: _run_format_worker(cm._format_features_from_strbatch2, data.feature_strs),
+         len(data.feature_strs)),
+        ("call._format_features_from_strbatch2s",
+         lambda: _run_format_worker(cm._format_features_from_strbatch2s, data.combfeature_strs),
+         len(data.combfeature_strs)),
+        ("call._batch_feature_list2s", lambda: cm._batch_feature_list2s(data.comb_features),
+         len(data.comb_features)),
+        ("dataloader.parse_a_line", lambda: [dl.parse_a_line(line) for line in data.feature_strs],
+         len(data.feature_strs)),
+        ("dataloader.parse_a_line2", lambda: [dl.parse_a_line2(line) for line in data.feature_strs],
+         len(data.feature_strs)),
+        ("dataloader.parse_a_line2s", lambda: [dl.parse_a_line2s(line) for line in data.combfeature_strs],
+         len(data.combfeature_strs)),
+    ]
+
+    # forward pass of each model class, on a batch of random inputs
+    torch.manual_seed(seed)
+    torch.set_num_threads(1)
+    batch_size = 64
+    kmer = torch.randint(0, 4, (batch_size, seq_len)).float()
+    signals = [torch.randn(batch_size, seq_len) for _ in range(4)]
+    mats = [torch.randn(batch_size, 2, seq_len, 16) for _ in range(2)]
+    model_inputs = [
+        ("models.ModelRNN", models.ModelRNN(seq_len, model_type="bigru"), [kmer] + signals),
+        ("models.ModelAttRNN", models.ModelAttRNN(seq_len, model_type="attbigru"), [kmer] + signals),
+        ("models.ModelAttRNN2s", models.ModelAttRNN2s(seq_len, model_type="attbigru2s"),
+         [kmer] + signals + [kmer] + signals),
+        ("models.ModelTransEncoder", models.ModelTransEncoder(seq_len, model_type="transencoder"),
+         [kmer] + signals),
+        ("models.ModelResNet18", models.ModelResNet18(), mats),
+    ]
+
+    def _forward(model, inputs):
+        with torch.no_grad():
+            return model(*inputs)
+
+    for name, model, inputs in model_inputs:
+        model.eval()
+        benchmarks.append((name + ".forward", lambda m=model, i=inputs: _forward(m, i), batch_size))
+    return benchmarks
+
+
+def run_one(func, min_time=1.0, max_calls=1000):
+    # the queue workers print start/end messages in every call
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return _run_one(func, min_time, max_calls)
+
+
+def _run_one(func, min_time, max_calls):
+    func()  # warm up
+    tracemalloc.start()
+    func()
+    _, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls, elapsed = 0, 0.0
+    start = time.perf_counter()
+    while elapsed < min_time and calls < max_calls:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+    return calls / elapsed, peak_mem
+
+
+def main():
+    parser = argparse.ArgumentParser("micro-benchmarks of ccsmeth hot paths")
+    parser.add_argument("--filter", type=str, default=None, required=False,
+                        help="only run benchmarks whose names match this regex")
+    parser.add_argument("--baseline", type=str, default=baseline_default, required=False,
+                        help="json file of stored baselines, default benchmarks/baselines.json")
+    parser.add_argument("--save_baseline", action="store_true", default=False, required=False,
+                        help="save results to --baseline")
+    parser.add_argument("--min_time", type=float, default=1.0, required=False,
+                        help="min seconds to run each benchmark, default 1.0")
+    parser.add_argument("--max_slowdown", type=float, default=None, required=False,
+                        help="exit with 1 if any benchmark is slower than baseline by this ratio, "
+                             "e.g. 1.2. default None, do not check")
+    parser.add_argument("--output", type=str, default=None, required=False,
+                        help="json file to save results of this run")
+    args = parser.parse_args()
+
+    baselines = {}
+    env = _env_info()
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as rf:
+            stored = json.load(rf)
+        baselines = stored["results"]
+        diffs = ["{} {} (here {})".format(key, stored.get(key), value) for key, value in sorted(env.items())
+                 if key in stored and stored[key] != value]
+        if len(diffs) > 0:
+            print("baselines of {} were recorded with another setup, ratios are rough: {}".format(
+                args.baseline, ", ".join(diffs)))
+    elif not args.save_baseline:
+        print("no baselines in {}, run with --save_baseline first to compare".format(args.baseline))
+
+    data = SyntheticData()
+    results = {}
+    regressions = []
+    print("{:<45}{:>14}{:>14}{:>14}{:>12}".format("benchmark", "ops/s", "items/s", "peak_mem(KiB)",
+                                                  "vs_base"))
+    for name, func, n_items in get_benchmarks(data):
+        if args.filter is not None and re.search(args.filter, name) is None:
+            continue
+        try:
+            ops, peak_mem = run_one(func, args.min_time)
+        except Exception as e:
+            print("{:<45}failed: {}: {}".format(name, type(e).__name__, str(e).split("\n")[0]))
+            continue
+        results[name] = {"ops_per_s": round(ops, 3), "items_per_s": round(ops * n_items, 3),
+                         "peak_mem_kib": round(peak_mem / 1024.0, 1)}
+        ratio_str = "-"
+        if name in baselines:
+            ratio = ops / baselines[name]["ops_per_s"]
+            ratio_str = "{:.2f}x".format(ratio)
+            if args.max_slowdown is not None and ratio * args.max_slowdown < 1.0:
+                regressions.append(name)
+        print("{:<45}{:>14.1f}{:>14.1f}{:>14.1f}{:>12}".format(name, ops, ops * n_items,
+                                                               peak_mem / 1024.0, ratio_str))
+
+    record = dict(env)
+    record.update({"time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                   "results": results})
+    if args.output is not None:
+        with open(args.output, "w") as wf:
+            json.dump(record, wf, indent=2, sort_keys=True)
+    if args.save_baseline:
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r") as rf:
+                stored = json.load(rf)
+            stored["results"].update(results)
+            results = stored["results"]
+            record["results"] = results
+        with open(args.baseline, "w") as wf:
+            json.dump(record, wf, indent=2, sort_keys=True)
+        print("baselines saved in {}".format(args.baseline))
+    if len(regressions) > 0:
+        print("slower than baseline by more than {}x: {}".format(args.max_slowdown, ", ".join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
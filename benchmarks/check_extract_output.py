@@ -0,0 +1,178 @@
+#!/usr/bin/python
+"""
+check that the features of extract are byte for byte the same as those of the baseline:
+  - on synthetic holes (default), the per-position ipd/pw mean/std of
+    extract_features._handle_one_strand_of_hole_specs() are checked against the two-pass reduction of the
+    baseline, np.mean()/np.std() of the list of values of each position, over depths/norms/strands.
+  - with --input/--ref/--baseline_rev, extract is run on the input by this tree and by the git revision
+    --baseline_rev, and the outputs (sorted, as the order of holes may differ) are compared.
+
+    python benchmarks/check_extract_output.py
+    python benchmarks/check_extract_output.py --input aligned.sam --ref genome.fa --baseline_rev <commit/tag>
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+here = os.path.abspath(os.path.dirname(__file__))
+repo_dir = os.path.dirname(here)
+sys.path.insert(0, repo_dir)
+
+import numpy as np
+
+from ccsmeth import extract_features as ef
+from ccsmeth.utils.process_utils import get_motif_seqs
+
+seed = 1234
+ref_len = 3000
+depths = list(range(1, 12)) + [17, 130]
+norms = ("zscore", "min-mean", "min-max", "mad")
+
+
+class _Args(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _random_subreads(rng, strand, depth):
+    subreads = []
+    for idx in range(depth):
+        start = int(rng.integers(0, 200))
+        cigar = "{}={}I{}={}D{}=".format(*rng.integers(200, 800, size=5).tolist())
+        _, blocks = ef._parse_cigar_blocks(cigar)
+        qlen = int(blocks[-1, 1] + blocks[-1, 2])
+        words = ["m0/1/{}".format(idx), "0", "chr1", str(start + 1), "60", cigar, "*", "0", "0", "*", "*",
+                 ("ip", "C", rng.integers(0, 256, size=qlen)), ("pw", "C", rng.integers(0, 256, size=qlen))]
+        subreads.append((start, strand, blocks, words))
+    return subreads
+
+
+def _baseline_strand_features(holeid, chrom, ccs_strand, subreads, contigs, mod_specs, args):
+    """
+    mean/std of the values of each position in the windows, gathered subread by subread into a list and
+    reduced by np.mean()/np.std(), as extract did before the values were gathered in arrays
+    """
+    subreads_locs = []
+    refpos_min, refpos_max = None, None
+    for start, strand, blocks, words in subreads:
+        refpos2querypos = {}
+        for refpos, querypos, blen in blocks.tolist():
+            for offset in range(blen):
+                refpos2querypos[refpos + offset] = querypos + offset
+        ipd_tag, pw_tag = ef._get_kinetics_tags(words)
+        ipd = ef._decode_kinetics_tag(ipd_tag, args.no_decode, args.norm)
+        pw = ef._decode_kinetics_tag(pw_tag, args.no_decode, args.norm)
+        if strand == "-":
+            ipd, pw = ipd[::-1], pw[::-1]
+        subreads_locs.append((start, ipd, pw, refpos2querypos))
+        rpos_min, rpos_max = start + min(refpos2querypos), start + max(refpos2querypos)
+        refpos_min = rpos_min if refpos_min is None else min(refpos_min, rpos_min)
+        refpos_max = rpos_max if refpos_max is None else max(refpos_max, rpos_max)
+    ref_len_hole = refpos_max - refpos_min + 1
+    specs_tsite_locs = []
+    window_mask = np.zeros(ref_len_hole, dtype=bool)
+    for motifs, mod_loc in mod_specs:
+        tsite_locs = ef._get_tsite_locs(chrom, refpos_min, refpos_max, ccs_strand, motifs, mod_loc, contigs)
+        specs_tsite_locs.append(tsite_locs)
+        window_mask |= ef._get_window_mask(tsite_locs, ccs_strand, ref_len_hole, (args.seq_len - 1) // 2)
+    ipd_mean, ipd_std, pw_mean, pw_std = [ef.exceptval] * ref_len_hole, [ef.exceptval] * ref_len_hole, \
+        [ef.exceptval] * ref_len_hole, [ef.exceptval] * ref_len_hole
+    ipd_depth = [0] * ref_len_hole
+    for idx in np.flatnonzero(window_mask).tolist():
+        refpos = idx + refpos_min
+        ipds, pws = [], []
+        for start, ipd, pw, refpos2querypos in subreads_locs:
+            qpos = refpos2querypos.get(refpos - start)
+            if qpos is not None:
+                ipds.append(ipd[qpos])
+                pws.append(pw[qpos])
+        if len(ipds) > 0:
+            ipd_mean[idx], ipd_std[idx] = ef._cal_mean_n_std(ipds)
+            pw_mean[idx], pw_std[idx] = ef._cal_mean_n_std(pws)
+            ipd_depth[idx] = len(ipds)
+    return [ef._extract_kmer_features(holeid, chrom, refpos_min, refpos_max, ccs_strand, ipd_mean, ipd_std,
+                                      pw_mean, pw_std, ipd_depth, len(subreads), [], motifs, mod_loc,
+                                      args.seq_len, args.methy_label, args.depth, args.num_subreads, args.seed,
+                                      contigs, None, tsite_locs)
+            for (motifs, mod_loc), tsite_locs in zip(mod_specs, specs_tsite_locs)]
+
+
+def check_synthetic():
+    rng = np.random.default_rng(seed)
+    contigs = {"chr1": "".join(rng.choice(list("ACGT"), size=ref_len).tolist())}
+    mod_specs = [(get_motif_seqs("CG"), 0), (get_motif_seqs("CHG"), 0)]
+    cnt_features, failed = 0, []
+    for norm in norms:
+        args = _Args(mod_loc=0, seq_len=21, methy_label=1, depth=1, num_subreads=0, seed=seed, norm=norm,
+                     no_decode=False, motif_index=None)
+        for depth in depths:
+            for strand in ("+", "-"):
+                subreads = _random_subreads(rng, strand, depth)
+                features = ef._handle_one_strand_of_hole_specs("m0/1", "chr1", strand, subreads, contigs,
+                                                               mod_specs, args)
+                expected = _baseline_strand_features("m0/1", "chr1", strand, subreads, contigs, mod_specs,
+                                                     args)
+                cnt_features += sum([len(spec_expected) for spec_expected in expected])
+                if [[ef._features_to_str(x) for x in spec_features] for spec_features in features] != \
+                        [[ef._features_to_str(x) for x in spec_expected] for spec_expected in expected]:
+                    failed.append("norm={} depth={} strand={}".format(norm, depth, strand))
+    print("synthetic holes: {} features of {} norms x {} depths x 2 strands, {}".format(
+        cnt_features, len(norms), len(depths), "ok" if len(failed) == 0 else "different in " + "; ".join(failed)))
+    return len(failed) == 0
+
+
+def _run_extract(code_dir, args, output):
+    cmd = [sys.executable, "-m", "ccsmeth.ccsmeth", "extract", "--input", os.path.abspath(args.input),
+           "--ref", os.path.abspath(args.ref), "--output", output, "--threads", str(args.threads)]
+    if args.extract_args is not None:
+        cmd += args.extract_args.split()
+    subprocess.check_call(cmd, cwd=code_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    with open(output, "r") as rf:
+        return sorted(rf.readlines())
+
+
+def check_input(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        base_dir = os.path.join(tmpdir, "baseline")
+        os.mkdir(base_dir)
+        archive = subprocess.Popen(["git", "archive", args.baseline_rev], cwd=repo_dir, stdout=subprocess.PIPE)
+        subprocess.check_call(["tar", "-x", "-C", base_dir], stdin=archive.stdout)
+        if archive.wait() != 0:
+            raise RuntimeError("git archive {} failed".format(args.baseline_rev))
+        lines_base = _run_extract(base_dir, args, os.path.join(tmpdir, "baseline.tsv"))
+        lines_curr = _run_extract(repo_dir, args, os.path.join(tmpdir, "current.tsv"))
+    cnt_diff = len(set(lines_base).symmetric_difference(set(lines_curr)))
+    same = lines_base == lines_curr
+    print("{}: {} features by {}, {} by this tree, {}".format(
+        args.input, len(lines_base), args.baseline_rev, len(lines_curr),
+        "ok" if same else "{} lines differ".format(cnt_diff)))
+    return same
+
+
+def main():
+    parser = argparse.ArgumentParser("check that the features of extract are the same as the baseline")
+    parser.add_argument("--input", type=str, default=None, required=False,
+                        help="aligned subreads (bam/sam) to run extract on, needs --ref/--baseline_rev")
+    parser.add_argument("--ref", type=str, default=None, required=False,
+                        help="reference of --input")
+    parser.add_argument("--baseline_rev", type=str, default=None, required=False,
+                        help="git revision of the baseline extract, e.g. a release tag")
+    parser.add_argument("--extract_args", type=str, default=None, required=False,
+                        help="more args of extract, e.g. --extract_args=\"--comb_strands --norm mad\"")
+    parser.add_argument("--threads", type=int, default=4, required=False,
+                        help="--threads of extract, default 4")
+    args = parser.parse_args()
+
+    ok = check_synthetic()
+    if args.input is not None:
+        if args.ref is None or args.baseline_rev is None:
+            parser.error("--input needs --ref and --baseline_rev")
+        ok = check_input(args) and ok
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
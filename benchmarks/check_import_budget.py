@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+check the import-time budget of ccsmeth subcommands: import each module in a fresh interpreter,
+and fail if it takes longer than its budget or pulls in a heavy dependency that should only be
+loaded where it is used (e.g. torch in the reader/extract/writer processes of call_mods, which
+are spawned and re-import the module).
+
+    python benchmarks/check_import_budget.py
+    python benchmarks/check_import_budget.py --scale 2.0  # on a slow machine
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+heavy_modules = ("torch", "sklearn", "statsmodels", "scipy", "pandas", "pysam")
+
+# module -> (max import seconds, modules that must not be imported)
+import_budgets = {
+    "ccsmeth.ccsmeth": (1.0, heavy_modules),
+    "ccsmeth.extract_features": (1.0, heavy_modules),
+    "ccsmeth.call_modifications": (1.0, heavy_modules),
+    "ccsmeth.align_subreads": (1.0, heavy_modules),
+    "ccsmeth.simulate_data": (1.0, heavy_modules),
+    "ccsmeth.bench": (1.0, heavy_modules),
+    "ccsmeth.pipeline": (1.0, heavy_modules),
+    "ccsmeth.ccs_features": (1.0, heavy_modules),
+    "ccsmeth.utils.motif_index": (1.0, heavy_modules),
+    "ccsmeth.utils.mappy_align": (1.0, heavy_modules + ("mappy", )),
+}
+
+_probe = """
+import sys, time, json
+start = time.time()
+import {module}
+cost = time.time() - start
+print(json.dumps({{"seconds": cost, "modules": sorted(set([m.split(".")[0] for m in sys.modules]))}}))
+"""
+
+
+def probe_import(module, repo_dir):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = repo_dir + os.pathsep + env.get("PYTHONPATH", "")
+    # best of 3, the first run may include writing .pyc files
+    results = []
+    for _ in range(3):
+        output = subprocess.check_output([sys.executable, "-c", _probe.format(module=module)], env=env,
+                                         cwd=repo_dir)
+        results.append(json.loads(output.decode().strip().split("\n")[-1]))
+    return min(results, key=lambda x: x["seconds"])
+
+
+def main():
+    parser = argparse.ArgumentParser("check import time and imported modules of ccsmeth subcommands")
+    parser.add_argument("--scale", type=float, default=1.0, required=False,
+                        help="scale all time budgets by this factor, default 1.0")
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    failed = []
+    print("\t".join(["module", "seconds", "budget", "status"]))
+    for module, (budget, forbidden) in sorted(import_budgets.items()):
+        result = probe_import(module, repo_dir)
+        budget *= args.scale
+        problems = []
+        if result["seconds"] > budget:
+            problems.append("too slow")
+        heavy = [name for name in forbidden if name in result["modules"]]
+        if len(heavy) > 0:
+            problems.append("imports " + ",".join(heavy))
+        print("\t".join([module, "{:.3f}".format(result["seconds"]), "{:.3f}".format(budget),
+                         "ok" if len(problems) == 0 else "; ".join(problems)]))
+        if len(problems) > 0:
+            failed.append(module)
+    if len(failed) > 0:
+        print("import budget exceeded: {}".format(", ".join(failed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,25 @@ import os
 import argparse
 import sys
 import time
+import queue
+import threading
+from subprocess import Popen, PIPE
 
 from .utils.process_utils import run_cmd
 from .utils.process_utils import display_args
 from .utils.process_utils import minimap2_exec
 from .utils.process_utils import bwa_exec
+from .utils.process_utils import samtools_exec
 from .utils.process_utils import generate_samtools_view_cmd
+from .utils.mappy_align import align_subreads_with_mappy
+from .utils.ccs_filter import holeids_of_args
+from .utils.ccs_filter import write_holeids
+from .extract_features import _get_holes
 
 
 here = os.path.abspath(os.path.dirname(__file__))
 sam2fq_exec = "python " + here + "/utils/subreads_sam2fastq_std.py"
+feeder_wait = 1  # seconds to wait for a chunk feeder to take a block before checking it is still alive
 
 
 def check_input_file(inputfile):
@@ -55,6 +64,224 @@ def generate_aligner_with_options(is_bwa, path_to_bwa, path_to_minimap2, bestn,
     return aligner
 
 
+def _get_holeid(subread_id):
+    words = subread_id.split("/")
+    return words[0] + "/" + words[1]
+
+
+def _samtools_path(path_to_samtools):
+    return samtools_exec if path_to_samtools is None else os.path.abspath(path_to_samtools)
+
+
+def _write_blocks_to_chunk(block_q, proc, cidx, errors):
+    """
+    :param errors: {chunk index: error}, the error of writing to the chunk pipeline is saved in it
+                   (e.g. BrokenPipeError if the aligner exits), and the feeder stops taking blocks
+    """
+    try:
+        while True:
+            block = block_q.get()
+            if block == "kill":
+                break
+            proc.stdin.writelines(block)
+    except (IOError, OSError) as e:
+        errors[cidx] = e
+    finally:
+        try:
+            proc.stdin.close()
+        except (IOError, OSError):
+            pass
+
+
+def _put_block(block_qs, feeders, cidx, block, errors):
+    while True:
+        if not feeders[cidx].is_alive():
+            raise RuntimeError("chunk-{} stopped taking subreads: {}".format(
+                cidx, errors.get(cidx, "its feeder exited")))
+        try:
+            block_qs[cidx].put(block, timeout=feeder_wait)
+            return
+        except queue.Full:
+            continue
+
+
+def _stop_feeder(block_q, feeder):
+    # a feeder which stopped on an error takes no more blocks, no "kill" is needed
+    while feeder.is_alive():
+        try:
+            block_q.put("kill", timeout=feeder_wait)
+            return
+        except queue.Full:
+            continue
+
+
+def _distribute_holes_to_chunks(inputpath, chunk_procs, chunk_holes, path_to_samtools, holeids=None):
+    """
+    send blocks of chunk_holes holes of the input to the chunk pipelines round-robin, block b goes
+    to chunk b % len(chunk_procs). each chunk is fed by its own thread, so that a busy chunk does
+    not stall the others.
+    :return: the last holeid of each block, to merge the chunks back in the input order
+    """
+    if inputpath.endswith(".bam"):
+        proc_read = Popen(" ".join([generate_samtools_view_cmd(path_to_samtools), inputpath]), shell=True,
+                          stdout=PIPE)
+        rf = proc_read.stdout
+    else:
+        proc_read = None
+        rf = open(inputpath, "rb")
+    block_qs = [queue.Queue(maxsize=2) for _ in chunk_procs]
+    errors = {}
+    feeders = [threading.Thread(target=_write_blocks_to_chunk, args=(block_q, proc, cidx, errors), daemon=True)
+               for cidx, (block_q, proc) in enumerate(zip(block_qs, chunk_procs))]
+    for feeder in feeders:
+        feeder.start()
+    block_lasts = []
+    block = []
+    cidx, cnt_block_holes, holeid_curr = 0, 0, None
+    try:
+        for line in rf:
+            if line.startswith(b"@"):
+                continue
+            holeid = _get_holeid(str(line[:line.find(b"\t")], 'utf-8'))
+            if holeids is not None and holeid not in holeids:
+                continue
+            if holeid != holeid_curr:
+                if holeid_curr is not None:
+                    cnt_block_holes += 1
+                    if cnt_block_holes >= chunk_holes:
+                        _put_block(block_qs, feeders, cidx, block, errors)
+                        block_lasts.append(holeid_curr)
+                        cidx = (cidx + 1) % len(chunk_procs)
+                        cnt_block_holes = 0
+                        block = []
+                holeid_curr = holeid
+            block.append(line)
+        if len(block) > 0:
+            _put_block(block_qs, feeders, cidx, block, errors)
+            block_lasts.append(holeid_curr)
+    except RuntimeError:
+        if proc_read is not None:
+            proc_read.kill()
+        raise
+    finally:
+        for block_q, feeder in zip(block_qs, feeders):
+            _stop_feeder(block_q, feeder)
+        for feeder in feeders:
+            feeder.join()
+    if len(errors) > 0:
+        raise RuntimeError("failed in writing subreads to chunk(s) {}: {}".format(
+            ", ".join(["chunk-{}".format(cidx) for cidx in sorted(errors.keys())]),
+            "; ".join([str(errors[cidx]) for cidx in sorted(errors.keys())])))
+    if proc_read is not None:
+        if proc_read.wait() != 0:
+            raise RuntimeError("samtools failed in reading {}".format(inputpath))
+    else:
+        rf.close()
+    return block_lasts
+
+
+class _ChunkReader(object):
+    """
+    read the aligned chunk block by block, aligners keep the input order of reads
+    """
+    def __init__(self, chunkpath, path_to_samtools):
+        if chunkpath.endswith(".bam"):
+            self._proc = Popen(" ".join([generate_samtools_view_cmd(path_to_samtools), chunkpath]),
+                               shell=True, stdout=PIPE)
+            self._rf = self._proc.stdout
+        else:
+            self._proc = None
+            self._rf = open(chunkpath, "rb")
+        self.header = b""
+        self._line = self._rf.readline()
+        while self._line.startswith(b"@"):
+            self.header += self._line
+            self._line = self._rf.readline()
+
+    def read_block(self, last_holeid):
+        """
+        lines of holes till last_holeid (included)
+        """
+        seen_last = False
+        while self._line:
+            holeid = _get_holeid(str(self._line[:self._line.find(b"\t")], 'utf-8'))
+            if holeid == last_holeid:
+                seen_last = True
+            elif seen_last:
+                break
+            yield self._line
+            self._line = self._rf.readline()
+
+    def close(self):
+        self._rf.close()
+        if self._proc is not None and self._proc.wait() != 0:
+            raise RuntimeError("samtools failed in reading aligned chunks")
+
+
+def _merge_chunks(chunkpaths, block_lasts, outputpath, path_to_samtools, threads):
+    readers = [_ChunkReader(chunkpath, path_to_samtools) for chunkpath in chunkpaths]
+    if outputpath.endswith(".bam"):
+        # multithreaded compression of the merged bam
+        proc_write = Popen("{} view -b -@ {} -o {} -".format(_samtools_path(path_to_samtools), threads,
+                                                             outputpath), shell=True, stdin=PIPE)
+        wf = proc_write.stdin
+    else:
+        proc_write = None
+        wf = open(outputpath, "wb")
+    wf.write(readers[0].header)
+    for bidx, last_holeid in enumerate(block_lasts):
+        for line in readers[bidx % len(readers)].read_block(last_holeid):
+            wf.write(line)
+    wf.close()
+    for reader in readers:
+        reader.close()
+    if proc_write is not None and proc_write.wait() != 0:
+        raise RuntimeError("samtools failed in writing {}".format(outputpath))
+
+
+def _align_subreads_in_chunks(args, inputpath, outputpath, reference, holeids=None):
+    """
+    split the subreads into args.chunks chunks by blocks of holes, align each chunk by its own
+    sam2fastq | aligner | samtools pipeline, then merge the aligned chunks in the input hole order
+    """
+    if not (inputpath.endswith(".bam") or inputpath.endswith(".sam")):
+        raise ValueError("--chunks needs --subreads/-i in bam/sam format!")
+    threads_chunk = max(1, args.threads // args.chunks)
+    aligner = generate_aligner_with_options(args.bwa,
+                                            args.path_to_bwa,
+                                            args.path_to_minimap2,
+                                            args.bestn,
+                                            threads_chunk)
+    chunk_ext = ".bam" if outputpath.endswith(".bam") else ".sam"
+    chunkpaths = [outputpath + ".chunk{}".format(cidx) + chunk_ext for cidx in range(args.chunks)]
+    chunk_procs = []
+    for chunkpath in chunkpaths:
+        chunk_cmds = " | ".join([sam2fq_exec, " ".join([aligner, reference, "-"])])
+        if chunk_ext == ".bam":
+            # fast compression for the temporary chunks
+            chunk_cmds += " | {} view -b -l 1 -o {} -".format(_samtools_path(args.path_to_samtools), chunkpath)
+        else:
+            chunk_cmds += " > {}".format(chunkpath)
+        sys.stderr.write("cmds of chunk-{}: {}\n".format(len(chunk_procs), chunk_cmds))
+        chunk_procs.append(Popen(chunk_cmds, shell=True, stdin=PIPE))
+
+    try:
+        block_lasts = _distribute_holes_to_chunks(inputpath, chunk_procs, args.chunk_holes,
+                                                  args.path_to_samtools, holeids)
+    except RuntimeError as e:
+        # the stdin of all chunks is closed by now, so that the pipelines end
+        returncodes = [proc.wait() for proc in chunk_procs]
+        raise RuntimeError("{}, return codes of chunks: {}".format(e, returncodes))
+    returncodes = [proc.wait() for proc in chunk_procs]
+    if any([returncode != 0 for returncode in returncodes]):
+        raise RuntimeError("failed in aligning chunks, return codes: {}".format(returncodes))
+    sys.stderr.write("aligned {} blocks of holes in {} chunks, merging..\n".format(len(block_lasts),
+                                                                                 args.chunks))
+    _merge_chunks(chunkpaths, block_lasts, outputpath, args.path_to_samtools, args.threads)
+    for chunkpath in chunkpaths:
+        os.remove(chunkpath)
+
+
 def align_subreads_to_genome(args):
     sys.stderr.write("[align_subreads]start..\n")
     start = time.time()
@@ -67,6 +294,23 @@ def align_subreads_to_genome(args):
     if not os.path.exists(reference):
         raise IOError("refernce(--ref) file does not exist!")
 
+    # holes to align, from --holeids_e and the usable CCS reads in --ccs_bam
+    holeids = None if args.holeids_e is None else _get_holes(args.holeids_e)
+    holeids = holeids_of_args(args, holeids)
+
+    if args.mappy:
+        if args.bwa:
+            raise ValueError("--mappy and --bwa can not be used together")
+        align_subreads_with_mappy(inputpath, reference, outputpath, args.bestn, args.threads,
+                                  args.holes_batch, args.path_to_samtools, holeids, args.guide_bam,
+                                  args.guide_pad)
+        sys.stderr.write("[align_subreads]costs {:.1f} seconds\n".format(time.time() - start))
+        return
+    if args.chunks > 1:
+        _align_subreads_in_chunks(args, inputpath, outputpath, reference, holeids)
+        sys.stderr.write("[align_subreads]costs {:.1f} seconds\n".format(time.time() - start))
+        return
+
     aligner = generate_aligner_with_options(args.bwa,
                                             args.path_to_bwa,
                                             args.path_to_minimap2,
@@ -80,6 +324,18 @@ def align_subreads_to_genome(args):
 
     samtools_view = generate_samtools_view_cmd(args.path_to_samtools)
 
+    sam2fq_cmd = sam2fq_exec
+    holeids_file = None
+    if holeids is not None:
+        if inputpath.endswith(".fq") or inputpath.endswith(".fastq"):
+            raise ValueError("--holeids_e/--ccs_bam needs --subreads/-i in bam/sam format!")
+        if args.ccs_bam is None:
+            holeids_file = os.path.abspath(args.holeids_e)
+        else:
+            holeids_file = outputpath + ".holeids.txt"
+            write_holeids(holeids, holeids_file)
+        sam2fq_cmd += " --holeids_file " + holeids_file
+
     pre_align_cmds = ""
     if inputpath.endswith(".fq") or inputpath.endswith(".fastq"):
         # pre_align_cmds += " ".join(["cat", inputpath])
@@ -87,10 +343,10 @@ def align_subreads_to_genome(args):
     else:
         if inputpath.endswith(".bam"):
             pre_align_cmds += " ".join([samtools_view, "-h", inputpath])
-            pre_align_cmds += " | " + sam2fq_exec
+            pre_align_cmds += " | " + sam2fq_cmd
         elif inputpath.endswith(".sam"):
             # pre_align_cmds += " ".join(["cat", inputpath])
-            pre_align_cmds += sam2fq_exec + " < " + inputpath
+            pre_align_cmds += sam2fq_cmd + " < " + inputpath
         else:
             raise ValueError()
 
@@ -114,6 +370,8 @@ def align_subreads_to_genome(args):
         sys.stderr.write("succeeded..\n")
     sys.stderr.write("==stdout:\n{}\n".format(str(stdout, 'utf-8')))
     sys.stderr.write("==stderr:\n{}\n".format(str(stderr, 'utf-8')))
+    if holeids_file is not None and args.ccs_bam is not None:
+        os.remove(holeids_file)
 
     endtime = time.time()
     sys.stderr.write("[align_subreads]costs {:.1f} seconds\n".format(endtime - start))
@@ -127,6 +385,18 @@ def main():
     p_input.add_argument("--ref", type=str, required=True,
                          help="path to genome reference to be aligned, in fasta/fa format. "
                               "If using bwa, the reference must have already been indexed.")
+    p_input.add_argument("--holeids_e", type=str, default=None, required=False,
+                         help="file contains holeids to be aligned, e.g. saved by "
+                              "`python -m ccsmeth.utils.ccs_filter`, default None")
+    p_input.add_argument("--ccs_bam", type=str, default=None, required=False,
+                         help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                              "--min_np, --ccs_mapped) are aligned. default None")
+    p_input.add_argument("--min_rq", type=float, default=0.99, required=False,
+                         help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    p_input.add_argument("--min_np", type=int, default=1, required=False,
+                         help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    p_input.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                         help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
 
     p_output = parser.add_argument_group("OUTPUT")
     p_output.add_argument("--output", "-o", type=str, required=False,
@@ -145,6 +415,26 @@ def main():
                               "we use only primary alignment.]")
     p_align.add_argument("--bwa", action="store_true", default=False, required=False,
                          help="use bwa instead of minimap2 for alignment")
+    p_align.add_argument("--mappy", action="store_true", default=False, required=False,
+                         help="align in process with mappy (the python binding of minimap2, "
+                              "`pip install mappy`) instead of the minimap2 pipeline. the index is "
+                              "loaded once and shared by --threads threads, the output is grouped by "
+                              "holes in the input order. --ref can also be a minimap2 index (.mmi)")
+    p_align.add_argument("--holes_batch", type=int, default=50, required=False,
+                         help="number of holes in a batch of a thread, for --mappy only, default 50")
+    p_align.add_argument("--guide_bam", type=str, default=None, required=False,
+                         help="aligned CCS bam/sam of the subreads, for --mappy only. subreads of a hole are "
+                              "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                              "with a small index of the window, instead of to the whole genome. --ref must "
+                              "be a fasta. default None")
+    p_align.add_argument("--guide_pad", type=int, default=1000, required=False,
+                         help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    p_align.add_argument("--chunks", type=int, default=1, required=False,
+                         help="split the subreads into N chunks by blocks of holes, align each chunk by its "
+                              "own minimap2/bwa pipeline with --threads/N threads, and merge the results in "
+                              "the input hole order. for bam/sam input, default 1")
+    p_align.add_argument("--chunk_holes", type=int, default=1000, required=False,
+                         help="number of holes in a block sent to a chunk, for --chunks only, default 1000")
     p_align.add_argument("--path_to_minimap2", type=str, default=None, required=False,
                          help="full path to the executable binary minimap2 file. "
                               "If not specified, it is assumed that minimap2 is "
@@ -0,0 +1,247 @@
+"""
+scaling benchmark of extract/call_mods: run the module on one input with each combination of
+--threads/--threads_call/--holes_batch/--batch_size, record wall time, holes/s, peak RSS and CPU
+utilization of each run, then print the scaling curve and the best configuration.
+"""
+import os
+import sys
+import time
+import shlex
+import argparse
+import itertools
+from subprocess import Popen
+
+from .utils.process_utils import display_args
+
+sweep_params = {"extract": ("threads", "holes_batch"),
+                "call_mods": ("threads", "threads_call", "holes_batch", "batch_size")}
+rss_sample_interval = 0.5
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def _parse_int_list(liststr):
+    return [int(x) for x in liststr.split(",") if x.strip() != ""]
+
+
+def _proc_tree_rss(root_pid):
+    """
+    total rss (bytes) of root_pid and all its descendants, read from /proc (linux only).
+    :return: -1 if /proc is not available
+    """
+    if not os.path.isdir("/proc"):
+        return -1
+    ppid2pids = {}
+    pid2rss = {}
+    for pidstr in os.listdir("/proc"):
+        if not pidstr.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(pidstr), "r") as rf:
+                stat = rf.read()
+        except (IOError, OSError):
+            continue
+        # comm (the 2nd field) may contain spaces, so split after the last ')'
+        fields = stat[stat.rfind(")") + 2:].split()
+        ppid2pids.setdefault(int(fields[1]), []).append(int(pidstr))
+        pid2rss[int(pidstr)] = int(fields[21]) * page_size
+    total_rss = 0
+    pids = [root_pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        total_rss += pid2rss.get(pid, 0)
+        pids += ppid2pids.get(pid, [])
+    return total_rss
+
+
+def _count_output_holes(output_path):
+    holeids = set()
+    if not os.path.exists(output_path):
+        return 0
+    with open(output_path, "r") as rf:
+        for line in rf:
+            words = line.split("\t", 4)
+            if len(words) > 4:
+                holeids.add(words[3])
+    return len(holeids)
+
+
+def _config_cmd(args, config, output_path):
+    cmd = [sys.executable, "-m", "ccsmeth.ccsmeth", args.mode, "--input", args.input, "--output", output_path]
+    if args.ref is not None:
+        cmd += ["--ref", args.ref]
+    if args.mode == "call_mods":
+        cmd += ["--model_file", args.model_file]
+    for param in sweep_params[args.mode]:
+        cmd += ["--" + param, str(config[param])]
+    if args.extra_args is not None:
+        cmd += shlex.split(args.extra_args)
+    return cmd
+
+
+def run_one_config(args, config, output_path):
+    """
+    :return: dict of wall time (s), holes, holes/s, peak rss of the whole process tree (bytes),
+    max rss of a single process (bytes), cpu time (s) and cpu utilization of the run
+    """
+    cmd = _config_cmd(args, config, output_path)
+    with open(output_path + ".log", "w") as logf:
+        start = time.time()
+        proc = Popen(cmd, stdout=logf, stderr=logf)
+        peak_rss = 0
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            peak_rss = max(peak_rss, _proc_tree_rss(proc.pid))
+            time.sleep(rss_sample_interval)
+        wall_time = time.time() - start
+    returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") \
+        else (status >> 8)
+    proc.returncode = returncode  # reaped by os.wait4() already
+    # rusage of the child includes its workers, which are all waited for before it exits
+    cpu_time = rusage.ru_utime + rusage.ru_stime
+    # ru_maxrss is in KB on linux, in bytes on macOS
+    maxrss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    holes = _count_output_holes(output_path) if returncode == 0 else 0
+    return {"returncode": returncode,
+            "wall_time": wall_time,
+            "holes": holes,
+            "holes_per_s": holes / wall_time if wall_time > 0 else 0.0,
+            "peak_rss": peak_rss if peak_rss > 0 else maxrss,
+            "max_proc_rss": maxrss,
+            "cpu_time": cpu_time,
+            "cpu_util": cpu_time / wall_time / (os.cpu_count() or 1) if wall_time > 0 else 0.0}
+
+
+def _configs(args):
+    param2values = {"threads": _parse_int_list(args.threads),
+                    "threads_call": _parse_int_list(args.threads_call),
+                    "holes_batch": _parse_int_list(args.holes_batch),
+                    "batch_size": _parse_int_list(args.batch_size)}
+    params = sweep_params[args.mode]
+    for values in itertools.product(*[param2values[param] for param in params]):
+        yield dict(zip(params, values))
+
+
+def _format_row(config, params, result):
+    return "\t".join([str(config[param]) for param in params] +
+                     [str(result["returncode"]),
+                      "{:.2f}".format(result["wall_time"]),
+                      str(result["holes"]),
+                      "{:.3f}".format(result["holes_per_s"]),
+                      "{:.1f}".format(result["peak_rss"] / 1024.0 / 1024),
+                      "{:.1f}".format(result["max_proc_rss"] / 1024.0 / 1024),
+                      "{:.1f}".format(result["cpu_time"]),
+                      "{:.3f}".format(result["cpu_util"])])
+
+
+def bench(args):
+    sys.stderr.write("[bench]start..\n")
+    start = time.time()
+    if args.mode == "call_mods" and args.model_file is None:
+        raise ValueError("--model_file is needed to bench call_mods")
+    if args.mode == "extract" and args.ref is None:
+        raise ValueError("--ref is needed to bench extract")
+    args.input = os.path.abspath(args.input)
+    work_dir = os.path.abspath(args.work_dir)
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    params = sweep_params[args.mode]
+    header = "\t".join(list(params) + ["returncode", "wall_time_s", "holes", "holes_per_s",
+                                       "peak_rss_mb", "max_proc_rss_mb", "cpu_time_s", "cpu_util"])
+    results = []
+    for cfgidx, config in enumerate(_configs(args)):
+        for ridx in range(args.repeat):
+            output_path = os.path.join(work_dir, "{}.cfg{}.rep{}.tsv".format(args.mode, cfgidx, ridx))
+            sys.stderr.write("running config {} (repeat {}): {}\n".format(cfgidx, ridx, config))
+            result = run_one_config(args, config, output_path)
+            if result["returncode"] != 0:
+                sys.stderr.write("config {} failed with return_code-{}, see {}.log\n".format(
+                    cfgidx, result["returncode"], output_path))
+            results.append((config, result))
+            if not args.keep_outputs and os.path.exists(output_path):
+                os.remove(output_path)
+
+    if args.result_file is not None:
+        with open(args.result_file, "w") as wf:
+            wf.write(header + "\n")
+            for config, result in results:
+                wf.write(_format_row(config, params, result) + "\n")
+        sys.stderr.write("results saved in {}\n".format(args.result_file))
+
+    print("# all runs\n" + header)
+    for config, result in results:
+        print(_format_row(config, params, result))
+    succeeded = [(config, result) for config, result in results if result["returncode"] == 0]
+    if len(succeeded) == 0:
+        sys.stderr.write("[bench]no config succeeded\n")
+        return
+    # scaling curve: the fastest run of each --threads, speedup is relative to the fewest threads
+    threads2best = {}
+    for config, result in succeeded:
+        if config["threads"] not in threads2best or \
+                result["holes_per_s"] > threads2best[config["threads"]][1]["holes_per_s"]:
+            threads2best[config["threads"]] = (config, result)
+    base_threads = min(threads2best.keys())
+    base_speed = threads2best[base_threads][1]["holes_per_s"]
+    print("\n# scaling curve (best run of each --threads)\nthreads\tholes_per_s\tspeedup\tcpu_util")
+    for threads in sorted(threads2best.keys()):
+        _, result = threads2best[threads]
+        speedup = result["holes_per_s"] / base_speed if base_speed > 0 else 0.0
+        print("{}\t{:.3f}\t{:.2f}\t{:.3f}".format(threads, result["holes_per_s"], speedup, result["cpu_util"]))
+    best_config, best_result = max(succeeded, key=lambda x: x[1]["holes_per_s"])
+    print("\n# best config: {} -> {:.3f} holes/s, {:.2f}s, peak rss {:.1f}MB".format(
+        " ".join(["--{} {}".format(param, best_config[param]) for param in params]),
+        best_result["holes_per_s"], best_result["wall_time"], best_result["peak_rss"] / 1024.0 / 1024))
+    sys.stderr.write("[bench]costs {:.1f} seconds\n".format(time.time() - start))
+
+
+def add_bench_args(parser):
+    p_input = parser.add_argument_group("INPUT")
+    p_input.add_argument("--mode", type=str, default="extract", required=False,
+                         choices=["extract", "call_mods"],
+                         help="module to benchmark, extract or call_mods, default extract")
+    p_input.add_argument("--input", "-i", type=str, required=True,
+                         help="input of the module, e.g. from `ccsmeth simulate`")
+    p_input.add_argument("--ref", type=str, required=False, default=None,
+                         help="path to genome reference, needed for extract, and for call_mods with "
+                              "aligned subreads as input")
+    p_input.add_argument("--model_file", "-m", type=str, required=False, default=None,
+                         help="model file, needed for call_mods")
+    p_input.add_argument("--extra_args", type=str, required=False, default=None,
+                         help="other args passed to the module as they are, e.g. \"--comb_strands\"")
+
+    p_sweep = parser.add_argument_group("SWEEP")
+    p_sweep.add_argument("--threads", type=str, default="2,4,8,16", required=False,
+                         help="comma-separated values of --threads to try, default 2,4,8,16")
+    p_sweep.add_argument("--threads_call", type=str, default="1,2,4", required=False,
+                         help="comma-separated values of --threads_call to try (call_mods only), "
+                              "default 1,2,4")
+    p_sweep.add_argument("--holes_batch", type=str, default="50", required=False,
+                         help="comma-separated values of --holes_batch to try, default 50")
+    p_sweep.add_argument("--batch_size", type=str, default="512", required=False,
+                         help="comma-separated values of --batch_size to try (call_mods only), default 512")
+    p_sweep.add_argument("--repeat", type=int, default=1, required=False,
+                         help="runs of each config, default 1")
+
+    p_output = parser.add_argument_group("OUTPUT")
+    p_output.add_argument("--work_dir", type=str, default="ccsmeth_bench", required=False,
+                          help="dir to save outputs/logs of the runs, default ccsmeth_bench")
+    p_output.add_argument("--result_file", type=str, default=None, required=False,
+                          help="save the results of all runs to this tsv file")
+    p_output.add_argument("--keep_outputs", action="store_true", default=False, required=False,
+                          help="keep the outputs of the runs, only logs are kept by default")
+
+
+def main():
+    parser = argparse.ArgumentParser("benchmark extract/call_mods with different worker configs")
+    add_bench_args(parser)
+
+    args = parser.parse_args()
+    display_args(args, True)
+    bench(args)
+
+
+if __name__ == '__main__':
+    main()
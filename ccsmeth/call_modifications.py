@@ -10,53 +10,64 @@ import os
 import sys
 
 import numpy as np
-import torch
-import torch.multiprocessing as mp
-from sklearn import metrics
-
-try:
-    mp.set_start_method('spawn')
-except RuntimeError:
-    pass
-except AttributeError:
-    pass
-
-# from utils.process_utils import Queue
-from torch.multiprocessing import Queue
+# torch and the models are imported only in the call processes and call_mods(), the other
+# processes of reading/extracting/writing do not need them
 import time
 # import random
 
-from .models import ModelRNN
-from .models import ModelAttRNN
-from .models import ModelAttRNN2s
-from .models import ModelResNet18
-from .models import ModelTransEncoder
-
 from .utils.process_utils import base2code_dna
 from .utils.process_utils import code2base_dna
+from .utils.process_utils import kmers_to_codes
 from .utils.process_utils import display_args
 from .utils.process_utils import nproc_to_call_mods_in_cpu_mode
 from .utils.process_utils import str2bool
-
-from .utils.process_utils import get_motif_seqs
-from .utils.ref_reader import DNAReference
-
-from .utils.constants_torch import FloatTensor
-from .utils.constants_torch import use_cuda
+from .utils.process_utils import accuracy_score
+
+from .utils.ref_reader import load_reference_contigs
+from .utils.motif_index import load_motif_index
+
+from .utils.metrics import StageMetrics
+from .utils.metrics import MetricsMonitor
+from .utils.batch_tuner import BatchTuner
+from .utils.batch_tuner import BatchController
+from .utils.reorder import ReorderBuffer
+from .utils.reorder import get_order_window
+from .utils.mem_budget import estimate_nbytes
+from .utils.mem_budget import get_memory_budget
+from .utils.mem_budget import report_peak_memory
+from .utils.profiling import wrap_target
+from .utils.profiling import prepare_profile_dir
+from .utils.profiling import merge_profiles
+from .utils.mp_context import get_mp_context
+from .utils.mod_freq import ModFreqAggregator
+from .utils.ccs_filter import holeids_of_args
 
 from .extract_features import worker_read
-from .extract_features import handle_one_hole2
+from .extract_features import handle_one_hole_specs
+from .extract_features import get_mod_specs
+from .extract_features import check_align_args
 from .extract_features import _get_holes
+from .ccs_features import worker_read_ccs
+from .ccs_features import get_motif_scanner
+from .ccs_features import ccs_reads_to_batch2s
 
 queen_size_border = 1000
 time_wait = 1
 
 
 def _read_features_file_to_str(features_file, featurestrs_batch_q, holes_batch=50,
-                               holeids_e=None, holeids_ne=None):
+                               holeids_e=None, holeids_ne=None, metrics_q=None, metrics_interval=10,
+                               order_window=None, mem_budget=None):
+    """
+    :param order_window: utils/reorder.OrderWindow, see extract_features.worker_read()
+    :param mem_budget: utils/mem_budget.MemoryBudget, see extract_features.worker_read()
+    """
     print("read_features process-{} starts".format(os.getpid()))
+    metrics = StageMetrics("reader", metrics_q, metrics_interval)
     h_num = 0
+    cnt_batches = 0
     preholeid = None
+    batch_start = time.time()
     with open(features_file, "r") as rf:
         featurestrs = []
         for line in rf:
@@ -72,30 +83,65 @@ def _read_features_file_to_str(features_file, featurestrs_batch_q, holes_batch=5
                 preholeid = holeid
                 h_num += 1
                 if h_num % holes_batch == 0:
-                    featurestrs_batch_q.put(featurestrs)
+                    if order_window is not None:
+                        metrics.add_idle(order_window.wait(cnt_batches))
+                    if mem_budget is not None:
+                        metrics.add_idle(mem_budget.admit(estimate_nbytes((cnt_batches, featurestrs))))
+                    featurestrs_batch_q.put((cnt_batches, featurestrs))
+                    cnt_batches += 1
+                    metrics.add(holes=holes_batch, sites=len(featurestrs))
+                    metrics.observe_batch(time.time() - batch_start)
                     while featurestrs_batch_q.qsize() > queen_size_border:
                         time.sleep(time_wait)
+                        metrics.add_idle(time_wait)
+                    metrics.report()
+                    batch_start = time.time()
                     featurestrs = []
             featurestrs.append(words)
         h_num += 1
         if len(featurestrs) > 0:
-            featurestrs_batch_q.put(featurestrs)
+            if order_window is not None:
+                metrics.add_idle(order_window.wait(cnt_batches))
+            if mem_budget is not None:
+                metrics.add_idle(mem_budget.admit(estimate_nbytes((cnt_batches, featurestrs))))
+            featurestrs_batch_q.put((cnt_batches, featurestrs))
+            metrics.add(holes=h_num % holes_batch, sites=len(featurestrs))
+            metrics.observe_batch(time.time() - batch_start)
     featurestrs_batch_q.put("kill")
+    metrics.report(force=True)
     print("read_features process-{} ending, read {} holes".format(os.getpid(), h_num))
 
 
-def _format_features_from_strbatch1(featurestrs_batch_q, features_batch_q):
+def _put_batch(out_q, out_batch, in_batch, mem_budget=None):
+    """
+    put out_batch made from in_batch, the bytes of out_batch are added to mem_budget before it is put, and
+    those of in_batch are released after
+    """
+    if mem_budget is None:
+        out_q.put(out_batch)
+        return
+    mem_budget.add(estimate_nbytes(out_batch))
+    out_q.put(out_batch)
+    mem_budget.release(estimate_nbytes(in_batch))
+
+
+def _format_features_from_strbatch1(featurestrs_batch_q, features_batch_q, metrics_q=None, metrics_interval=10,
+                                      mem_budget=None):
     print("format_features process-{} starts".format(os.getpid()))
+    metrics = StageMetrics("format", metrics_q, metrics_interval)
     b_num = 0
     while True:
         if featurestrs_batch_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
             continue
-        featurestrs = featurestrs_batch_q.get()
-        if featurestrs == "kill":
+        featurestrs_batch = featurestrs_batch_q.get()
+        if featurestrs_batch == "kill":
             featurestrs_batch_q.put("kill")
             break
+        seq, featurestrs = featurestrs_batch
         b_num += 1
+        batch_start = time.time()
 
         sampleinfo = []  # contains: chrom, abs_loc, strand, holeid, depth_all
         kmers = []
@@ -117,22 +163,34 @@ def _format_features_from_strbatch1(featurestrs_batch_q, features_batch_q):
 
             labels.append(int(words[13]))
 
-        features_batch_q.put((sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, labels))
+        _put_batch(features_batch_q, (seq, (sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, labels)),
+                   featurestrs_batch, mem_budget)
+        metrics.add(samples=len(sampleinfo))
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            metrics.add_idle(mem_budget.pause([features_batch_q]))
+        metrics.report()
+    metrics.report(force=True)
     print("format_features process-{} ending, read {} batches".format(os.getpid(), b_num))
 
 
-def _format_features_from_strbatch2s(featurestrs_batch_q, features_batch_q):
+def _format_features_from_strbatch2s(featurestrs_batch_q, features_batch_q, metrics_q=None, metrics_interval=10,
+                                       mem_budget=None):
     print("format_features process-{} starts".format(os.getpid()))
+    metrics = StageMetrics("format", metrics_q, metrics_interval)
     b_num = 0
     while True:
         if featurestrs_batch_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
             continue
-        featurestrs = featurestrs_batch_q.get()
-        if featurestrs == "kill":
+        featurestrs_batch = featurestrs_batch_q.get()
+        if featurestrs_batch == "kill":
             featurestrs_batch_q.put("kill")
             break
+        seq, featurestrs = featurestrs_batch
         b_num += 1
+        batch_start = time.time()
 
         sampleinfo = []  # contains: chrom, abs_loc, strand, holeid, depth_all
         kmers = []
@@ -168,23 +226,35 @@ def _format_features_from_strbatch2s(featurestrs_batch_q, features_batch_q):
 
             labels.append(int(words[21]))
 
-        features_batch_q.put((sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds,
-                              kmers2, ipd_means2, ipd_stds2, pw_means2, pw_stds2, labels))
+        _put_batch(features_batch_q, (seq, (sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds,
+                                            kmers2, ipd_means2, ipd_stds2, pw_means2, pw_stds2, labels)),
+                   featurestrs_batch, mem_budget)
+        metrics.add(samples=len(sampleinfo))
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            metrics.add_idle(mem_budget.pause([features_batch_q]))
+        metrics.report()
+    metrics.report(force=True)
     print("format_features process-{} ending, read {} batches".format(os.getpid(), b_num))
 
 
-def _format_features_from_strbatch2(featurestrs_batch_q, features_batch_q):
+def _format_features_from_strbatch2(featurestrs_batch_q, features_batch_q, metrics_q=None, metrics_interval=10,
+                                      mem_budget=None):
     print("format_features process-{} starts".format(os.getpid()))
+    metrics = StageMetrics("format", metrics_q, metrics_interval)
     b_num = 0
     while True:
         if featurestrs_batch_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
             continue
-        featurestrs = featurestrs_batch_q.get()
-        if featurestrs == "kill":
+        featurestrs_batch = featurestrs_batch_q.get()
+        if featurestrs_batch == "kill":
             featurestrs_batch_q.put("kill")
             break
+        seq, featurestrs = featurestrs_batch
         b_num += 1
+        batch_start = time.time()
 
         sampleinfo = []  # contains: chrom, abs_loc, strand, holeid, depth_all
         kmers = []
@@ -200,31 +270,42 @@ def _format_features_from_strbatch2(featurestrs_batch_q, features_batch_q):
 
             height, width = len(kmer), len(base2code_dna.keys())
 
-            ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float)
-            ipd_m_mat = np.zeros((1, height, width), dtype=np.float)
+            ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float64)
+            ipd_m_mat = np.zeros((1, height, width), dtype=np.float64)
             ipd_m_mat[0, np.arange(len(kmer)), kmer] = ipd_means
-            pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float)
-            pw_m_mat = np.zeros((1, height, width), dtype=np.float)
+            pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float64)
+            pw_m_mat = np.zeros((1, height, width), dtype=np.float64)
             pw_m_mat[0, np.arange(len(kmer)), kmer] = pw_means
             mats_ccs_mean.append(np.concatenate((ipd_m_mat, pw_m_mat), axis=0))  # (C=2, H, W)
 
-            ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float)
-            ipd_s_mat = np.zeros((1, height, width), dtype=np.float)
+            ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float64)
+            ipd_s_mat = np.zeros((1, height, width), dtype=np.float64)
             ipd_s_mat[0, np.arange(len(kmer)), kmer] = ipd_stds
-            pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float)
-            pw_s_mat = np.zeros((1, height, width), dtype=np.float)
+            pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float64)
+            pw_s_mat = np.zeros((1, height, width), dtype=np.float64)
             pw_s_mat[0, np.arange(len(kmer)), kmer] = pw_stds
             mats_ccs_std.append(np.concatenate((ipd_s_mat, pw_s_mat), axis=0))  # (C=2, H, W)
 
             labels.append(int(words[13]))
 
-        features_batch_q.put((sampleinfo, kmers, mats_ccs_mean, mats_ccs_std, labels))
+        _put_batch(features_batch_q, (seq, (sampleinfo, kmers, mats_ccs_mean, mats_ccs_std, labels)),
+                   featurestrs_batch, mem_budget)
+        metrics.add(samples=len(sampleinfo))
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            metrics.add_idle(mem_budget.pause([features_batch_q]))
+        metrics.report()
+    metrics.report(force=True)
     print("format_features process-{} ending, read {} batches".format(os.getpid(), b_num))
 
 
 def _call_mods(features_batch, model, batch_size):
     # features_batch: 1. if from _read_features_file(), has 1 * args.batch_size samples (not any more, modified)
     # --------------: 2. if from _worker_extract_features(), has uncertain number of samples
+    import torch
+    from .utils.constants_torch import FloatTensor
+    from .utils.constants_torch import use_cuda
+
     sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, \
         labels = features_batch
     labels = np.reshape(labels, (len(labels)))
@@ -252,8 +333,7 @@ def _call_mods(features_batch, model, batch_size):
             predicted = vpredicted.numpy()
             logits = vlogits.data.numpy()
 
-            acc_batch = metrics.accuracy_score(
-                y_true=b_labels, y_pred=predicted)
+            acc_batch = accuracy_score(b_labels, predicted)
             accuracys.append(acc_batch)
 
             for idx in range(len(b_sampleinfo)):
@@ -277,6 +357,10 @@ def _call_mods(features_batch, model, batch_size):
 def _call_mods2s(features_batch, model, batch_size):
     # features_batch: 1. if from _read_features_file(), has 1 * args.batch_size samples
     # --------------: 2. if from _worker_extract_features(), has uncertain number of samples
+    import torch
+    from .utils.constants_torch import FloatTensor
+    from .utils.constants_torch import use_cuda
+
     sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, \
         kmers2, ipd_means2, ipd_stds2, pw_means2, pw_stds2, \
         labels = features_batch
@@ -312,8 +396,7 @@ def _call_mods2s(features_batch, model, batch_size):
             predicted = vpredicted.numpy()
             logits = vlogits.data.numpy()
 
-            acc_batch = metrics.accuracy_score(
-                y_true=b_labels, y_pred=predicted)
+            acc_batch = accuracy_score(b_labels, predicted)
             accuracys.append(acc_batch)
 
             for idx in range(len(b_sampleinfo)):
@@ -337,6 +420,10 @@ def _call_mods2s(features_batch, model, batch_size):
 def _call_mods2(features_batch, model, batch_size):
     # features_batch: 1. if from _read_features_file(), has 1 * args.batch_size samples
     # --------------: 2. if from _worker_extract_features(), has uncertain number of samples
+    import torch
+    from .utils.constants_torch import FloatTensor
+    from .utils.constants_torch import use_cuda
+
     sampleinfo, kmers, mats_ccs_mean, mats_ccs_std, labels = features_batch
     labels = np.reshape(labels, (len(labels)))
 
@@ -360,8 +447,7 @@ def _call_mods2(features_batch, model, batch_size):
             predicted = vpredicted.numpy()
             logits = vlogits.data.numpy()
 
-            acc_batch = metrics.accuracy_score(
-                y_true=b_labels, y_pred=predicted)
+            acc_batch = accuracy_score(b_labels, predicted)
             accuracys.append(acc_batch)
 
             for idx in range(len(b_sampleinfo)):
@@ -382,8 +468,18 @@ def _call_mods2(features_batch, model, batch_size):
     return pred_str, accuracy, batch_num
 
 
-def _call_mods_q(model_path, features_batch_q, pred_str_q, args):
+def _call_mods_q(model_path, features_batch_q, pred_str_q, args, metrics_q=None, batch_tuner=None,
+                 mem_budget=None):
+    import torch
+    from .models import ModelRNN
+    from .models import ModelAttRNN
+    from .models import ModelAttRNN2s
+    from .models import ModelResNet18
+    from .models import ModelTransEncoder
+    from .utils.constants_torch import use_cuda
+
     print('call_mods process-{} starts'.format(os.getpid()))
+    metrics = StageMetrics("call", metrics_q, args.metrics_interval)
     if args.model_type in {"bilstm", "bigru", }:
         model = ModelRNN(args.seq_len, args.layer_rnn, args.class_num,
                          args.dropout_rate, args.hid_rnn,
@@ -431,48 +527,105 @@ def _call_mods_q(model_path, features_batch_q, pred_str_q, args):
 
         if features_batch_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
+            if batch_tuner is not None:
+                batch_tuner.observe("call", idle=time_wait)
             continue
 
-        features_batch = features_batch_q.get()
-        if features_batch == "kill":
+        in_batch = features_batch_q.get()
+        if in_batch == "kill":
             features_batch_q.put("kill")
             break
+        seq, features_batch = in_batch
+        if features_batch is None:
+            # holes without sites, passed on to keep the sequence of batches
+            _put_batch(pred_str_q, (seq, []), in_batch, mem_budget)
+            continue
+        batch_start = time.time()
+        batch_size = args.batch_size if batch_tuner is None else batch_tuner.batch_size()
 
         if args.model_type in {"bilstm", "bigru", "attbilstm", "attbigru", "transencoder", }:
-            pred_str, accuracy, batch_num = _call_mods(features_batch, model, args.batch_size)
+            pred_str, accuracy, batch_num = _call_mods(features_batch, model, batch_size)
         elif args.model_type in {"resnet18", }:
-            pred_str, accuracy, batch_num = _call_mods2(features_batch, model, args.batch_size)
+            pred_str, accuracy, batch_num = _call_mods2(features_batch, model, batch_size)
         elif args.model_type in {"attbigru2s", }:
-            pred_str, accuracy, batch_num = _call_mods2s(features_batch, model, args.batch_size)
+            pred_str, accuracy, batch_num = _call_mods2s(features_batch, model, batch_size)
         else:
             raise ValueError("model_type not right!")
 
-        pred_str_q.put(pred_str)
+        _put_batch(pred_str_q, (seq, pred_str), in_batch, mem_budget)
+        metrics.add(samples=len(pred_str))
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            metrics.add_idle(mem_budget.pause([pred_str_q]))
+        metrics.report()
+        if batch_tuner is not None:
+            batch_tuner.observe("call", busy=time.time() - batch_start, samples=len(pred_str))
         # for debug
         # print("call_mods process-{} reads 1 batch, features_batch_q:{}, "
         #       "pred_str_q: {}".format(os.getpid(), features_batch_q.qsize(), pred_str_q.qsize()))
         accuracy_list.append(accuracy)
         batch_num_total += batch_num
+    metrics.report(force=True)
     # print('total accuracy in process {}: {}'.format(os.getpid(), np.mean(accuracy_list)))
     print('call_mods process-{} ending, proceed {} batches({})'.format(os.getpid(), batch_num_total,
-                                                                       args.batch_size))
-
-
-def _write_predstr_to_file(write_fp, predstr_q):
+                                                                       args.batch_size if batch_tuner is None
+                                                                       else batch_tuner.batch_size()))
+
+
+def _write_pred_batch(wf, pred_str, freq_aggregator=None):
+    for one_pred_str in pred_str:
+        wf.write(one_pred_str + "\n")
+    if freq_aggregator is not None:
+        for one_pred_str in pred_str:
+            freq_aggregator.add(one_pred_str)
+
+
+def _write_predstr_to_file(write_fp, predstr_q, metrics_q=None, metrics_interval=10, freq_args=None,
+                           order_window=None, writer_idx=0, mem_budget=None):
+    """
+    :param freq_args: args with freq_output/prob_cf/rm_1strand/freq_sort/freq_bed, to aggregate the
+                      modification frequency of sites from the calls while writing them. None to disable.
+    :param order_window: utils/reorder.OrderWindow, to write the batches in the order of holes in the input,
+                         None to write them as they come
+    :param mem_budget: utils/mem_budget.MemoryBudget, the batches got are released from it
+    """
     print('write_process-{} starts'.format(os.getpid()))
+    metrics = StageMetrics("write", metrics_q, metrics_interval)
+    freq_aggregator = None
+    if freq_args is not None:
+        freq_aggregator = ModFreqAggregator(freq_args.prob_cf, freq_args.rm_1strand)
+    reorder_buffer = ReorderBuffer(order_window.written(writer_idx)) if order_window is not None else None
     with open(write_fp, 'w') as wf:
         while True:
             # during test, it's ok without the sleep()
             if predstr_q.empty():
                 time.sleep(time_wait)
+                metrics.add_idle(time_wait)
                 continue
-            pred_str = predstr_q.get()
-            if pred_str == "kill":
+            pred_batch = predstr_q.get()
+            if pred_batch == "kill":
                 print('write_process-{} finished'.format(os.getpid()))
                 break
-            for one_pred_str in pred_str:
-                wf.write(one_pred_str + "\n")
+            batch_start = time.time()
+            if mem_budget is not None:
+                mem_budget.release(estimate_nbytes(pred_batch))
+            seq, pred_str = pred_batch
+            for pred_str in (reorder_buffer.push(seq, pred_str) if reorder_buffer is not None else [pred_str]):
+                _write_pred_batch(wf, pred_str, freq_aggregator)
+                metrics.add(samples=len(pred_str))
             wf.flush()
+            metrics.observe_batch(time.time() - batch_start)
+            metrics.report()
+        if reorder_buffer is not None and len(reorder_buffer) > 0:
+            print('write_process-{}: {} batches written out of order'.format(os.getpid(), len(reorder_buffer)))
+            for pred_str in reorder_buffer.flush():
+                _write_pred_batch(wf, pred_str, freq_aggregator)
+    metrics.report(force=True)
+    if freq_aggregator is not None:
+        cnt_sites = freq_aggregator.write(freq_args.freq_output, freq_args.freq_sort, freq_args.freq_bed)
+        print("write_process-{}: {} of {} calls used, frequency of {} sites saved in {}".format(
+            os.getpid(), freq_aggregator.used, freq_aggregator.count, cnt_sites, freq_args.freq_output))
 
 
 def _batch_feature_list1(feature_list):
@@ -488,44 +641,27 @@ def _batch_feature_list1(feature_list):
             kmer_ipdm, kmer_ipds, kmer_pwm, kmer_pws, kmer_subr_ipds, kmer_subr_pws, label = featureline
         sampleinfo.append("\t".join(list(map(str, [chrom, abs_loc, strand, holeid, depth_all]))))
         kmers.append(np.array([base2code_dna[x] for x in kmer_seq]))
-        ipd_means.append(np.array(kmer_ipdm, dtype=np.float))
-        ipd_stds.append(np.array(kmer_ipds, dtype=np.float))
-        pw_means.append(np.array(kmer_pwm, dtype=np.float))
-        pw_stds.append(np.array(kmer_pws, dtype=np.float))
+        ipd_means.append(np.array(kmer_ipdm, dtype=np.float64))
+        ipd_stds.append(np.array(kmer_ipds, dtype=np.float64))
+        pw_means.append(np.array(kmer_pwm, dtype=np.float64))
+        pw_stds.append(np.array(kmer_pws, dtype=np.float64))
         labels.append(label)
     return sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, labels
 
 
 def _batch_feature_list2s(feature_list):
-    sampleinfo = []  # contains: chrom, abs_loc, strand, holeid, depth_all
-    kmers = []
-    ipd_means = []
-    ipd_stds = []
-    pw_means = []
-    pw_stds = []
-    kmers2 = []
-    ipd_means2 = []
-    ipd_stds2 = []
-    pw_means2 = []
-    pw_stds2 = []
-    labels = []
-    for featureline in feature_list:
-        chrom, abs_loc, strand, holeid, depth_all, \
-            kmer_seq, kmer_depth, kmer_ipdm, kmer_ipds, kmer_pwm, kmer_pws, kmer_subr_ipds, kmer_subr_pws, \
-            kmer_seq2, kmer_depth2, kmer_ipdm2, kmer_ipds2, kmer_pwm2, kmer_pws2, kmer_subr_ipds2, kmer_subr_pws2, \
-            label = featureline
-        sampleinfo.append("\t".join(list(map(str, [chrom, abs_loc, strand, holeid, depth_all]))))
-        kmers.append(np.array([base2code_dna[x] for x in kmer_seq]))
-        ipd_means.append(np.array(kmer_ipdm, dtype=np.float))
-        ipd_stds.append(np.array(kmer_ipds, dtype=np.float))
-        pw_means.append(np.array(kmer_pwm, dtype=np.float))
-        pw_stds.append(np.array(kmer_pws, dtype=np.float))
-        kmers2.append(np.array([base2code_dna[x] for x in kmer_seq2]))
-        ipd_means2.append(np.array(kmer_ipdm2, dtype=np.float))
-        ipd_stds2.append(np.array(kmer_ipds2, dtype=np.float))
-        pw_means2.append(np.array(kmer_pwm2, dtype=np.float))
-        pw_stds2.append(np.array(kmer_pws2, dtype=np.float))
-        labels.append(label)
+    """
+    combined-strands features of sites, gathered field by field into (n, seq_len) arrays
+    """
+    # contains: chrom, abs_loc, strand, holeid, depth_all
+    sampleinfo = ["\t".join(list(map(str, featureline[:5]))) for featureline in feature_list]
+    kmers = kmers_to_codes([featureline[5] for featureline in feature_list])
+    ipd_means, ipd_stds, pw_means, pw_stds = [np.array([featureline[fidx] for featureline in feature_list],
+                                                       dtype=np.float64) for fidx in (7, 8, 9, 10)]
+    kmers2 = kmers_to_codes([featureline[13] for featureline in feature_list])
+    ipd_means2, ipd_stds2, pw_means2, pw_stds2 = [np.array([featureline[fidx] for featureline in feature_list],
+                                                           dtype=np.float64) for fidx in (15, 16, 17, 18)]
+    labels = [featureline[21] for featureline in feature_list]
     return sampleinfo, kmers, ipd_means, ipd_stds, pw_means, pw_stds, \
         kmers2, ipd_means2, ipd_stds2, pw_means2, pw_stds2, labels
 
@@ -548,19 +684,19 @@ def _batch_feature_list2(feature_list):
 
         height, width = len(kmer), len(base2code_dna.keys())
 
-        ipd_means = np.array([float(x) for x in kmer_ipdm.split(",")], dtype=np.float)
-        ipd_m_mat = np.zeros((1, height, width), dtype=np.float)
+        ipd_means = np.array([float(x) for x in kmer_ipdm.split(",")], dtype=np.float64)
+        ipd_m_mat = np.zeros((1, height, width), dtype=np.float64)
         ipd_m_mat[0, np.arange(len(kmer)), kmer] = ipd_means
-        pw_means = np.array([float(x) for x in kmer_pwm.split(",")], dtype=np.float)
-        pw_m_mat = np.zeros((1, height, width), dtype=np.float)
+        pw_means = np.array([float(x) for x in kmer_pwm.split(",")], dtype=np.float64)
+        pw_m_mat = np.zeros((1, height, width), dtype=np.float64)
         pw_m_mat[0, np.arange(len(kmer)), kmer] = pw_means
         mats_ccs_mean.append(np.concatenate((ipd_m_mat, pw_m_mat), axis=0))  # (C=2, H, W)
 
-        ipd_stds = np.array([float(x) for x in kmer_ipds.split(",")], dtype=np.float)
-        ipd_s_mat = np.zeros((1, height, width), dtype=np.float)
+        ipd_stds = np.array([float(x) for x in kmer_ipds.split(",")], dtype=np.float64)
+        ipd_s_mat = np.zeros((1, height, width), dtype=np.float64)
         ipd_s_mat[0, np.arange(len(kmer)), kmer] = ipd_stds
-        pw_stds = np.array([float(x) for x in kmer_pws.split(",")], dtype=np.float)
-        pw_s_mat = np.zeros((1, height, width), dtype=np.float)
+        pw_stds = np.array([float(x) for x in kmer_pws.split(",")], dtype=np.float64)
+        pw_s_mat = np.zeros((1, height, width), dtype=np.float64)
         pw_s_mat[0, np.arange(len(kmer)), kmer] = pw_stds
         mats_ccs_std.append(np.concatenate((ipd_s_mat, pw_s_mat), axis=0))  # (C=2, H, W)
 
@@ -568,41 +704,121 @@ def _batch_feature_list2(feature_list):
     return sampleinfo, kmers, mats_ccs_mean, mats_ccs_std, labels
 
 
-def _worker_extract_features(hole_align_q, features_batch_q, contigs, motifs, args):
+def _worker_extract_features(hole_align_q, features_batch_qs, contigs, mod_specs, args, metrics_q=None,
+                             batch_tuner=None, mem_budget=None):
+    """
+    :param features_batch_qs: a queue for the features of each of mod_specs
+    :param mem_budget: utils/mem_budget.MemoryBudget, see extract_features._worker_extract()
+    """
     sys.stderr.write("extrac_features process-{} starts\n".format(os.getpid()))
+    metrics = StageMetrics("extract", metrics_q, args.metrics_interval)
     cnt_holesbatch = 0
     while True:
         # print("hole_align_q size:", hole_align_q.qsize(), "; pid:", os.getpid())
         if hole_align_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
+            if batch_tuner is not None:
+                batch_tuner.observe("extract", idle=time_wait)
             continue
-        holes_aligninfo = hole_align_q.get()
-        if holes_aligninfo == "kill":
+        holes_batch = hole_align_q.get()
+        if holes_batch == "kill":
             hole_align_q.put("kill")
             break
-        feature_list = []
+        seq, holes_aligninfo = holes_batch
+        batch_start = time.time()
+        specs_features = [[] for _ in mod_specs]
         for hole_aligninfo in holes_aligninfo:
-            feature_list += handle_one_hole2(hole_aligninfo, contigs, motifs, args)
-        if len(feature_list) > 0:
-            if args.model_type in {"bilstm", "bigru", "attbilstm", "attbigru", "transencoder", }:
-                features_batch_q.put(_batch_feature_list1(feature_list))
+            for spec_idx, features in enumerate(handle_one_hole_specs(hole_aligninfo, contigs, mod_specs, args)):
+                specs_features[spec_idx] += features
+        cnt_sites = 0
+        for features_batch_q, feature_list in zip(features_batch_qs, specs_features):
+            # a batch is put for each batch of holes, None if no sites, to keep the sequence of batches
+            if len(feature_list) == 0:
+                features_batch = None
+            elif args.model_type in {"bilstm", "bigru", "attbilstm", "attbigru", "transencoder", }:
+                features_batch = _batch_feature_list1(feature_list)
             elif args.model_type in {"attbigru2s", }:
-                features_batch_q.put(_batch_feature_list2s(feature_list))
+                features_batch = _batch_feature_list2s(feature_list)
             elif args.model_type in {"resnet18", }:
-                features_batch_q.put(_batch_feature_list2(feature_list))
+                features_batch = _batch_feature_list2(feature_list)
             else:
                 raise ValueError("model_type not right!")
+            if mem_budget is not None:
+                mem_budget.add(estimate_nbytes((seq, features_batch)))
+            features_batch_q.put((seq, features_batch))
+            cnt_sites += len(feature_list)
+        metrics.add(holes=len(holes_aligninfo), sites=cnt_sites)
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            mem_budget.release(estimate_nbytes(holes_batch))
+            metrics.add_idle(mem_budget.pause(features_batch_qs))
+        metrics.report()
+        if batch_tuner is not None:
+            batch_tuner.observe("extract", busy=time.time() - batch_start)
+
+        cnt_holesbatch += 1
+        if cnt_holesbatch % 200 == 0:
+            sys.stderr.write("extrac_features process-{}, {} hole_batches({}) "
+                             "proceed\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
+            sys.stderr.flush()
+    metrics.report(force=True)
+    sys.stderr.write("extrac_features process-{} ending, proceed {} "
+                     "hole_batches({})\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
+
+
+def _worker_extract_ccs_features(ccs_read_q, features_batch_q, args, metrics_q=None, batch_tuner=None,
+                                 mem_budget=None):
+    sys.stderr.write("extrac_features process-{} starts\n".format(os.getpid()))
+    metrics = StageMetrics("extract", metrics_q, args.metrics_interval)
+    scanner = get_motif_scanner(args.motifs)
+    cnt_holesbatch = 0
+    while True:
+        if ccs_read_q.empty():
+            time.sleep(time_wait)
+            metrics.add_idle(time_wait)
+            if batch_tuner is not None:
+                batch_tuner.observe("extract", idle=time_wait)
+            continue
+        in_batch = ccs_read_q.get()
+        if in_batch == "kill":
+            ccs_read_q.put("kill")
+            break
+        seq, ccs_reads = in_batch
+        batch_start = time.time()
+        features_batch = ccs_reads_to_batch2s(ccs_reads, scanner, args)
+        _put_batch(features_batch_q, (seq, features_batch), in_batch, mem_budget)
+        metrics.add(holes=len(ccs_reads), sites=0 if features_batch is None else len(features_batch[0]))
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            metrics.add_idle(mem_budget.pause([features_batch_q]))
+        metrics.report()
+        if batch_tuner is not None:
+            batch_tuner.observe("extract", busy=time.time() - batch_start)
 
         cnt_holesbatch += 1
         if cnt_holesbatch % 200 == 0:
             sys.stderr.write("extrac_features process-{}, {} hole_batches({}) "
                              "proceed\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
             sys.stderr.flush()
+    metrics.report(force=True)
     sys.stderr.write("extrac_features process-{} ending, proceed {} "
                      "hole_batches({})\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
 
 
+def _start_metrics_monitor(args, queues, mp_ctx):
+    if args.metrics_file is None:
+        return None, None
+    metrics_q = mp_ctx.Queue()
+    metrics_monitor = MetricsMonitor(metrics_q, args.metrics_file, queues, args.metrics_interval)
+    metrics_monitor.start()
+    return metrics_q, metrics_monitor
+
+
 def call_mods(args):
+    import torch
+    from .utils.constants_torch import use_cuda
+
     print("[main]call_mods starts..")
     start = time.time()
     torch.manual_seed(args.tseed)
@@ -614,22 +830,72 @@ def call_mods(args):
     input_path = os.path.abspath(args.input)
     if not os.path.exists(input_path):
         raise ValueError("--input_file does not exist!")
+    # (model, output) of --motifs/--mod_loc, and of each --extra_motifs
+    extra_motifs = args.extra_motifs if args.extra_motifs is not None else []
+    model_paths = [model_path] + [os.path.abspath(extra_motif[2]) for extra_motif in extra_motifs]
+    outputs = [args.output] + [extra_motif[3] for extra_motif in extra_motifs]
+    for extra_model_path in model_paths[1:]:
+        if not os.path.exists(extra_model_path):
+            raise ValueError("MODEL_FILE {} of --extra_motifs does not exist!".format(extra_model_path))
+    if len(set(map(os.path.abspath, outputs))) < len(outputs):
+        raise ValueError("the outputs of --output/--extra_motifs must be different files!")
+    if len(extra_motifs) > 0 and (args.mode == "ccs" or not (input_path.endswith(".bam") or
+                                                              input_path.endswith(".sam"))):
+        raise ValueError("--extra_motifs needs subreads as input (aligned bam/sam, or with --align)!")
 
     holeids_e = None if args.holeids_e is None else _get_holes(args.holeids_e)
     holeids_ne = None if args.holeids_ne is None else _get_holes(args.holeids_ne)
-
+    holeids_e = holeids_of_args(args, holeids_e)
+
+    args.profile, profile_start = prepare_profile_dir(args.profile)
+    mp_ctx = get_mp_context(args.start_method)
+
+    if args.mode == "ccs":
+        # features from the kinetics tags of ccs reads, no subreads/alignments/reference
+        if not (input_path.endswith(".bam") or input_path.endswith(".sam")):
+            raise ValueError("--input must be ccs reads with kinetics tags in bam/sam format in --mode ccs!")
+        if args.model_type not in {"attbigru2s", }:
+            raise ValueError("--mode ccs needs a two-strand model (--model_type attbigru2s)!")
+        if args.align:
+            raise ValueError("--align is not needed in --mode ccs!")
     if input_path.endswith(".bam") or input_path.endswith(".sam"):
-        if args.ref is None:
-            raise ValueError("please specify a reference genome file (--ref)! ")
-        reference = os.path.abspath(args.ref)
-        if not os.path.exists(reference):
-            raise IOError("refernce(--ref) file does not exist!")
-        contigs = DNAReference(reference).getcontigs()
-        motifs = get_motif_seqs(args.motifs)
-
-        hole_align_q = Queue()
-        features_batch_q = Queue()
-        pred_str_q = Queue()
+        hole_align_q = mp_ctx.Queue()
+        features_batch_qs = [mp_ctx.Queue() for _ in model_paths]
+        pred_str_qs = [mp_ctx.Queue() for _ in model_paths]
+        queues = {"hole_align_q": hole_align_q}
+        for spec_idx in range(len(model_paths)):
+            suffix = str(spec_idx) if spec_idx > 0 else ""
+            queues["features_batch_q" + suffix] = features_batch_qs[spec_idx]
+            queues["pred_str_q" + suffix] = pred_str_qs[spec_idx]
+        metrics_q, metrics_monitor = _start_metrics_monitor(args, queues, mp_ctx)
+        batch_tuner = BatchTuner(mp_ctx, args.holes_batch, args.batch_size, args.holes_batch_bounds,
+                                 args.batch_size_bounds) if args.adaptive_batch else None
+        order_window = get_order_window(mp_ctx, args.reorder_window, len(pred_str_qs))
+        mem_budget = get_memory_budget(mp_ctx, args.max_memory)
+        if args.mode == "ccs":
+            features_batch_q = features_batch_qs[0]
+            read_target, read_args = worker_read_ccs, (input_path, hole_align_q, args, holeids_e, holeids_ne,
+                                                       metrics_q, args.metrics_interval, batch_tuner,
+                                                       order_window, mem_budget)
+            extract_target, extract_args = _worker_extract_ccs_features, (hole_align_q, features_batch_q, args,
+                                                                          metrics_q, batch_tuner, mem_budget)
+        else:
+            if args.ref is None:
+                raise ValueError("please specify a reference genome file (--ref)! ")
+            reference = os.path.abspath(args.ref)
+            if not os.path.exists(reference):
+                raise IOError("refernce(--ref) file does not exist!")
+            check_align_args(args)
+            contigs = load_reference_contigs(reference, args.ref_cache)
+            mod_specs = get_mod_specs(args, extra_motifs)
+            if args.motif_index is not None:
+                args.motif_index = os.path.abspath(args.motif_index)
+                load_motif_index(args.motif_index).check_compatible(mod_specs[0][0], args.mod_loc, contigs)
+            read_target, read_args = worker_read, (input_path, hole_align_q, args, holeids_e, holeids_ne,
+                                                   metrics_q, batch_tuner, order_window, mem_budget)
+            extract_target, extract_args = _worker_extract_features, (hole_align_q, features_batch_qs, contigs,
+                                                                      mod_specs, args, metrics_q, batch_tuner,
+                                                                      mem_budget)
 
         nproc = args.threads
         nproc_dp = args.threads_call
@@ -643,48 +909,87 @@ def call_mods(args):
             print("--threads must be > nproc_dp + 2!!")
             nproc = nproc_dp + 2 + 1
 
-        p_read = mp.Process(target=worker_read, args=(input_path, hole_align_q, args, holeids_e, holeids_ne))
+        target, target_args = wrap_target(read_target, read_args, args.profile, "reader")
+        p_read = mp_ctx.Process(target=target, args=target_args)
         p_read.daemon = True
         p_read.start()
 
-        p_w = mp.Process(target=_write_predstr_to_file, args=(args.output, pred_str_q))
-        p_w.daemon = True
-        p_w.start()
+        # a writer for each spec, the frequency (--freq_output) is of --motifs only
+        ps_write = []
+        for spec_idx, (output, pred_str_q) in enumerate(zip(outputs, pred_str_qs)):
+            freq_args = args if args.freq_output is not None and spec_idx == 0 else None
+            target, target_args = wrap_target(_write_predstr_to_file, (output, pred_str_q, metrics_q,
+                                                                       args.metrics_interval, freq_args,
+                                                                       order_window, spec_idx, mem_budget),
+                                              args.profile, "write")
+            p_w = mp_ctx.Process(target=target, args=target_args)
+            p_w.daemon = True
+            p_w.start()
+            ps_write.append(p_w)
 
-        # TODO: why the processes in ps_extract start so slowly?
         ps_extract = []
-        ps_call = []
+        specs_ps_call = [[] for _ in model_paths]
         nproc_ext = nproc - nproc_dp - 2
         for i in range(max(nproc_ext, nproc_dp)):
             if i < nproc_ext:
-                p = mp.Process(target=_worker_extract_features, args=(hole_align_q, features_batch_q,
-                                                                      contigs, motifs, args))
+                target, target_args = wrap_target(extract_target, extract_args, args.profile, "extract")
+                p = mp_ctx.Process(target=target, args=target_args)
                 p.daemon = True
                 p.start()
                 ps_extract.append(p)
             if i < nproc_dp:
-                p = mp.Process(target=_call_mods_q, args=(model_path, features_batch_q, pred_str_q, args))
-                p.daemon = True
-                p.start()
-                ps_call.append(p)
+                # nproc_dp call workers for the model of each spec
+                for spec_idx in range(len(model_paths)):
+                    target, target_args = wrap_target(_call_mods_q, (model_paths[spec_idx],
+                                                                     features_batch_qs[spec_idx],
+                                                                     pred_str_qs[spec_idx], args, metrics_q,
+                                                                     batch_tuner, mem_budget),
+                                                      args.profile, "call", args.profile_torch)
+                    p = mp_ctx.Process(target=target, args=target_args)
+                    p.daemon = True
+                    p.start()
+                    specs_ps_call[spec_idx].append(p)
+
+        batch_controller = None
+        if batch_tuner is not None:
+            batch_controller = BatchController(batch_tuner, [hole_align_q], features_batch_qs, nproc_ext,
+                                               nproc_dp * len(model_paths))
+            batch_controller.start()
 
         p_read.join()
+        if p_read.exitcode != 0:
+            # the reader may have been killed before it put "kill", e.g. by a crash in loading the aligner
+            hole_align_q.put("kill")
 
         for p in ps_extract:
             p.join()
-        features_batch_q.put("kill")
-
-        for p in ps_call:
-            p.join()
-        pred_str_q.put("kill")
+        for features_batch_q in features_batch_qs:
+            features_batch_q.put("kill")
 
-        p_w.join()
+        for ps_call, pred_str_q in zip(specs_ps_call, pred_str_qs):
+            for p in ps_call:
+                p.join()
+            pred_str_q.put("kill")
+
+        for p_w in ps_write:
+            p_w.join()
+
+        if batch_controller is not None:
+            batch_controller.stop()
+        if metrics_monitor is not None:
+            metrics_monitor.stop()
+        if p_read.exitcode != 0:
+            raise RuntimeError("read_input process failed with exitcode {}, the calls in {} are "
+                               "incomplete".format(p_read.exitcode, ", ".join(outputs)))
     else:
-        # features_batch_q = mp.Queue()
-        features_batch_q = Queue()
-        # pred_str_q = mp.Queue()
-        pred_str_q = Queue()
-        featurestrs_batch_q = Queue()
+        if args.adaptive_batch:
+            sys.stderr.write("--adaptive_batch is not used with features.tsv as input\n")
+        features_batch_q = mp_ctx.Queue()
+        pred_str_q = mp_ctx.Queue()
+        featurestrs_batch_q = mp_ctx.Queue()
+        metrics_q, metrics_monitor = _start_metrics_monitor(args, {"featurestrs_batch_q": featurestrs_batch_q,
+                                                                   "features_batch_q": features_batch_q,
+                                                                   "pred_str_q": pred_str_q}, mp_ctx)
 
         nproc = args.threads
         nproc_dp = args.threads_call
@@ -699,31 +1004,52 @@ def call_mods(args):
             nproc = nproc_dp + 2 + 1
         nproc_cnvt = nproc - nproc_dp - 2
 
-        p_read = mp.Process(target=_read_features_file_to_str, args=(input_path, featurestrs_batch_q,
-                                                                     args.holes_batch,
-                                                                     holeids_e, holeids_ne))
+        order_window = get_order_window(mp_ctx, args.reorder_window)
+        mem_budget = get_memory_budget(mp_ctx, args.max_memory)
+        target, target_args = wrap_target(_read_features_file_to_str, (input_path, featurestrs_batch_q,
+                                                                       args.holes_batch, holeids_e,
+                                                                       holeids_ne, metrics_q,
+                                                                       args.metrics_interval, order_window,
+                                                                       mem_budget),
+                                          args.profile, "reader")
+        p_read = mp_ctx.Process(target=target, args=target_args)
         p_read.daemon = True
         p_read.start()
 
         ps_str2value = []
         if args.model_type in {"bilstm", "bigru", "attbilstm", "attbigru", "transencoder", }:
             for _ in range(nproc_cnvt):
-                p = mp.Process(target=_format_features_from_strbatch1, args=(featurestrs_batch_q,
-                                                                             features_batch_q))
+                target, target_args = wrap_target(_format_features_from_strbatch1, (featurestrs_batch_q,
+                                                                                    features_batch_q,
+                                                                                    metrics_q,
+                                                                                    args.metrics_interval,
+                                                                                    mem_budget),
+                                                  args.profile, "format")
+                p = mp_ctx.Process(target=target, args=target_args)
                 p.daemon = True
                 p.start()
                 ps_str2value.append(p)
         elif args.model_type in {"resnet18", }:
             for _ in range(nproc_cnvt):
-                p = mp.Process(target=_format_features_from_strbatch2, args=(featurestrs_batch_q,
-                                                                             features_batch_q))
+                target, target_args = wrap_target(_format_features_from_strbatch2, (featurestrs_batch_q,
+                                                                                    features_batch_q,
+                                                                                    metrics_q,
+                                                                                    args.metrics_interval,
+                                                                                    mem_budget),
+                                                  args.profile, "format")
+                p = mp_ctx.Process(target=target, args=target_args)
                 p.daemon = True
                 p.start()
                 ps_str2value.append(p)
         elif args.model_type in {"attbigru2s", }:
             for _ in range(nproc_cnvt):
-                p = mp.Process(target=_format_features_from_strbatch2s, args=(featurestrs_batch_q,
-                                                                              features_batch_q))
+                target, target_args = wrap_target(_format_features_from_strbatch2s, (featurestrs_batch_q,
+                                                                                     features_batch_q,
+                                                                                     metrics_q,
+                                                                                     args.metrics_interval,
+                                                                                     mem_budget),
+                                                  args.profile, "format")
+                p = mp_ctx.Process(target=target, args=target_args)
                 p.daemon = True
                 p.start()
                 ps_str2value.append(p)
@@ -732,13 +1058,21 @@ def call_mods(args):
 
         predstr_procs = []
         for _ in range(nproc_dp):
-            p = mp.Process(target=_call_mods_q, args=(model_path, features_batch_q, pred_str_q, args))
+            target, target_args = wrap_target(_call_mods_q, (model_path, features_batch_q, pred_str_q, args,
+                                                             metrics_q, None, mem_budget),
+                                              args.profile, "call", args.profile_torch)
+            p = mp_ctx.Process(target=target, args=target_args)
             p.daemon = True
             p.start()
             predstr_procs.append(p)
 
         # print("write_process started..")
-        p_w = mp.Process(target=_write_predstr_to_file, args=(args.output, pred_str_q))
+        target, target_args = wrap_target(_write_predstr_to_file, (args.output, pred_str_q, metrics_q,
+                                                                   args.metrics_interval,
+                                                                   args if args.freq_output is not None else None,
+                                                                   order_window, 0, mem_budget),
+                                          args.profile, "write")
+        p_w = mp_ctx.Process(target=target, args=target_args)
         p_w.daemon = True
         p_w.start()
 
@@ -754,20 +1088,41 @@ def call_mods(args):
 
         p_w.join()
 
-    print("[main]call_mods costs %.2f seconds.." % (time.time() - start))
+        if metrics_monitor is not None:
+            metrics_monitor.stop()
 
+    if args.profile is not None:
+        merge_profiles(args.profile, profile_start, "call_mods")
+
+    report_peak_memory("main", mem_budget)
+    print("[main]call_mods costs %.2f seconds.." % (time.time() - start))
 
-def main():
-    parser = argparse.ArgumentParser("call modifications")
 
+def add_call_mods_args(parser):
     p_input = parser.add_argument_group("INPUT")
     p_input.add_argument("--input", "-i", action="store", type=str,
                          required=True,
                          help="input file, can be aligned.bam/sam, or features.tsv generated by "
                               "extract_features.py. If aligned.bam/sam is provided, args in EXTRACTION "
                               "should (reference_path must) be provided.")
+    p_input.add_argument("--mode", type=str, default="align", choices=["align", "ccs"], required=False,
+                         help="align: call from subreads (aligned.bam/sam, or with --align) or features.tsv; "
+                              "ccs: call from the kinetics tags (fi/ri/fp/rp) of CCS reads in --input "
+                              "(e.g. from `ccs --hifi-kinetics`), without subreads/reference, "
+                              "--model_type attbigru2s only. default align")
     p_input.add_argument("--holes_batch", type=int, default=50, required=False,
                          help="number of holes in an batch to get/put in queues")
+    p_input.add_argument("--holes_batch_bases", type=int, default=10000000, required=False,
+                         help="max number of subread bases in a batch of holes, a batch is put once it has "
+                              "--holes_batch holes or this many bases, so that batches of deep/long holes cost "
+                              "about the same; a hole of more bases is put in a batch of its own. 0 to batch by "
+                              "--holes_batch only. default 10000000")
+    p_input.add_argument("--max_memory", type=str, default=None, required=False,
+                         help="max memory of the batches waiting in the queues between the reader, workers and "
+                              "writers, in bytes or with a unit (e.g. 4G, 512M). when it is reached, the reader "
+                              "pauses, and the workers pause while the next stage has batches to drain. the sizes "
+                              "of batches are estimated and the reference/models are not counted, so it is not a "
+                              "hard limit of the RSS. default None, batches are limited by count only")
 
     p_call = parser.add_argument_group("CALL")
     p_call.add_argument("--model_file", "-m", action="store", type=str, required=True,
@@ -793,6 +1148,15 @@ def main():
 
     p_call.add_argument("--batch_size", "-b", default=512, type=int, required=False,
                         action="store", help="batch size, default 512")
+    p_call.add_argument("--adaptive_batch", action="store_true", default=False, required=False,
+                        help="tune --holes_batch and --batch_size at runtime, from the busy/idle time of the "
+                             "extract/call workers and the depths of the queues, within --holes_batch_bounds/"
+                             "--batch_size_bounds. --holes_batch/--batch_size are the start values. "
+                             "subreads/ccs bam/sam input only")
+    p_call.add_argument("--holes_batch_bounds", type=int, nargs=2, default=[5, 500], required=False,
+                        metavar=("MIN", "MAX"), help="bounds of holes_batch with --adaptive_batch, default 5 500")
+    p_call.add_argument("--batch_size_bounds", type=int, nargs=2, default=[64, 4096], required=False,
+                        metavar=("MIN", "MAX"), help="bounds of batch_size with --adaptive_batch, default 64 4096")
 
     # BiRNN/transformerencoder model param
     p_call.add_argument('--n_vocab', type=int, default=16, required=False,
@@ -820,14 +1184,69 @@ def main():
     p_output = parser.add_argument_group("OUTPUT")
     p_output.add_argument("--output", "-o", action="store", type=str, required=True,
                           help="the file path to save the predicted result")
+    p_output.add_argument("--reorder_window", type=int, default=64, required=False,
+                          help="max number of batches of holes done ahead of the earliest unwritten one, which "
+                               "wait in the writer to be written in the hole order of the input; the reader pauses "
+                               "when it is reached. 0 to write the batches as they are done (not in input order). "
+                               "default 64")
+    p_output.add_argument("--freq_output", type=str, default=None, required=False,
+                          help="also aggregate the modification frequency of sites from the calls while "
+                               "writing them, and save it to this file, default None")
+    p_output.add_argument("--freq_bed", action="store_true", default=False, required=False,
+                          help="save the frequency in bedMethyl format, for --freq_output")
+    p_output.add_argument("--freq_sort", action="store_true", default=False, required=False,
+                          help="sort sites in the frequency file, for --freq_output")
+    p_output.add_argument("--prob_cf", type=float, default=0.0, required=False,
+                          help="use a call in the frequency only if abs(prob1-prob0)>=prob_cf, "
+                               "for --freq_output. range [0, 1], default 0.0, use all calls")
+    p_output.add_argument("--rm_1strand", action="store_true", default=False, required=False,
+                          help="abandon ccs reads with only 1 strand subreads in the frequency, "
+                               "for --freq_output")
 
     p_extract = parser.add_argument_group("EXTRACTION")
     p_extract.add_argument("--ref", type=str, required=False,
                            help="path to genome reference to be aligned, in fasta/fa format.")
+    p_extract.add_argument("--ref_cache", action="store_true", default=False, required=False,
+                           help="serve the reference from a pre-uppercased 1-byte-per-base cache file "
+                                "(ref.ccsmeth.seq, built at the first use) instead of the fasta. By default "
+                                "the reference is memory-mapped through its .fai index (built if missing), "
+                                "and shared by all processes.")
+    p_extract.add_argument("--align", action="store_true", default=False, required=False,
+                           help="the input is unaligned subreads.bam/sam, align them to --ref on the fly "
+                                "with mappy (`pip install mappy`) and extract from the alignments directly, "
+                                "without writing/reading an intermediate aligned bam")
+    p_extract.add_argument("--align_index", type=str, default=None, required=False,
+                           help="minimap2 index (.mmi, -x map-pb) of --ref for --align, to skip building "
+                                "the index from --ref")
+    p_extract.add_argument("--align_threads", type=int, default=4, required=False,
+                           help="number of threads to align with, for --align only, default 4")
+    p_extract.add_argument("--guide_bam", type=str, default=None, required=False,
+                           help="aligned CCS bam/sam of the subreads, for --align only. subreads of a hole are "
+                                "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                                "instead of to the whole genome. default None")
+    p_extract.add_argument("--guide_pad", type=int, default=1000, required=False,
+                           help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    p_extract.add_argument("--align_to_ccs", action="store_true", default=False, required=False,
+                           help="with --align and --guide_bam, align subreads to the CCS read of their hole instead "
+                                "of the reference, aggregate kinetics in CCS coordinates, and lift the sites to "
+                                "the reference through the CCS alignment. --guide_bam must be grouped by holes in "
+                                "the same order as the subreads (e.g. aligned without sorting)")
+    p_extract.add_argument("--tee_aligned", type=str, default=None, required=False,
+                           help="also save the alignments of --align to this bam/sam file, default None")
     p_extract.add_argument("--holeids_e", type=str, default=None, required=False,
                            help="file contains holeids to be extracted, default None")
     p_extract.add_argument("--holeids_ne", type=str, default=None, required=False,
                            help="file contains holeids not to be extracted, default None")
+    p_extract.add_argument("--ccs_bam", type=str, default=None, required=False,
+                           help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                                "--min_np, --ccs_mapped) are used, the others are dropped before parsing. "
+                                "default None")
+    p_extract.add_argument("--min_rq", type=float, default=0.99, required=False,
+                           help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    p_extract.add_argument("--min_np", type=int, default=1, required=False,
+                           help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    p_extract.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                           help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
     p_extract.add_argument("--motifs", action="store", type=str,
                            required=False, default='CG',
                            help='motif seq to be extracted, default: CG. '
@@ -838,6 +1257,14 @@ def main():
                                 'the same')
     p_extract.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
                            help='0-based location of the targeted base in the motif, default 0')
+    p_extract.add_argument("--extra_motifs", action="append", nargs=4, type=str, required=False,
+                           metavar=("MOTIFS", "MOD_LOC", "MODEL_FILE", "OUTPUT"), default=None,
+                           help="an extra motif spec to call in the same pass (subreads input only), its sites are "
+                                "called by MODEL_FILE (of the same --model_type/params as --model_file) and saved "
+                                "in OUTPUT. can be repeated. --freq_output is of --motifs only, default None")
+    p_extract.add_argument("--motif_index", type=str, default=None, required=False,
+                           help="motif index built by `ccsmeth index_motifs` with the same --ref/--motifs/--mod_loc, "
+                                "to get target sites from the index instead of scanning the reference, default None")
     p_extract.add_argument("--methy_label", action="store", type=int,
                            choices=[1, 0], required=False, default=1,
                            help="the label of the interested modified bases, this is for training."
@@ -877,6 +1304,30 @@ def main():
                                              "no more than threads/4 is suggested. default 2.")
     parser.add_argument('--tseed', type=int, default=1234,
                         help='random seed for torch')
+    parser.add_argument("--start_method", type=str, default="forkserver", required=False,
+                        choices=["forkserver", "spawn"],
+                        help="how to start worker processes. forkserver: fork workers from a server process "
+                             "with numpy/torch/ccsmeth preloaded, which is much faster to start (falls back to "
+                             "spawn if not available); spawn: start each worker in a new interpreter. "
+                             "default forkserver")
+
+    p_metrics = parser.add_argument_group("METRICS")
+    p_metrics.add_argument("--metrics_file", type=str, default=None, required=False,
+                           help="file to export per-stage throughput/latency/queue-depth metrics "
+                                "periodically, in json-lines format, or in prometheus text format "
+                                "if the file ends with .prom. default None, no metrics exported")
+    p_metrics.add_argument("--metrics_interval", type=float, default=10, required=False,
+                           help="interval (seconds) of exporting metrics, default 10")
+    p_metrics.add_argument("--profile", type=str, default=None, required=False,
+                           help="directory to save cProfile stats of each worker process, the stats "
+                                "are merged into DIR/report.txt at the end. default None, no profiling")
+    p_metrics.add_argument("--profile_torch", action="store_true", default=False, required=False,
+                           help="also run torch profiler in call workers when --profile is set")
+
+
+def main():
+    parser = argparse.ArgumentParser("call modifications")
+    add_call_mods_args(parser)
 
     args = parser.parse_args()
     display_args(args)
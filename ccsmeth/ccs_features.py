@@ -1,22 +1,34 @@
+"""
+features of CCS (HiFi) reads from their kinetics tags (fi/ri/fp/rp, fn/rn), without subreads and their
+alignments. used by `ccsmeth call_mods --mode ccs`, which feeds the features to the two-strand model
+directly, or as a script to save the features:
+    python -m ccsmeth.ccs_features -i hifi_reads.bam -o hifi_reads.features.tsv
+"""
 import os
 import argparse
 import sys
 import time
 import numpy as np
-from statsmodels import robust
 from subprocess import Popen, PIPE
 import multiprocessing as mp
 from multiprocessing import Queue
 import re
-import random
+from importlib.util import find_spec
 # from collections import Counter
 
-from utils.process_utils import display_args
-from utils.process_utils import codecv1_to_frame
-from utils.process_utils import generate_samtools_view_cmd
-from utils.process_utils import get_refloc_of_methysite_in_motif
-from utils.process_utils import get_motif_seqs
-from utils.process_utils import complement_seq
+from .utils.process_utils import display_args
+from .utils.process_utils import codecv1_to_frame
+from .utils.process_utils import generate_samtools_view_cmd
+from .utils.process_utils import get_motif_seqs
+from .utils.process_utils import base2code_dna
+from .utils.process_utils import base2code_dna_table
+from .utils.process_utils import mad
+from .utils.metrics import StageMetrics
+from .utils.metrics import metrics_interval_default
+from .utils.reorder import ReorderBuffer
+from .utils.reorder import get_order_window
+from .utils.reorder import reorder_window_default
+from .utils.mem_budget import estimate_nbytes
 
 code2frames = codecv1_to_frame()
 queen_size_border = 1000
@@ -25,6 +37,10 @@ time_wait = 1
 exceptval = 1000
 subreads_value_default = "-"
 
+kinetics_tags = ("fi", "ri", "fp", "rp")
+_code2frames = np.array([code2frames[i] for i in range(len(code2frames))], dtype=np.int64)
+_code2comp = np.array([base2code_dna[b] for b in "TGCAN"], dtype=np.int64)
+
 
 def check_input_file(inputfile):
     if not (inputfile.endswith(".bam") or inputfile.endswith(".sam")):
@@ -59,65 +75,62 @@ def _get_holeid(subread_id):
     return holeid
 
 
-def _ccs_words_to_feature(words, args):
-    query, flag, seq, tags = [words[i] for i in (0, 1, 9, 11)]
-    tags_dict = dict(re.split(':\S:', x) for x in tags.split("\t"))
-    lib, id, ccs = query.split("/")
-    holeid = lib + "/" + id
-    fi, fp, ri, rp = [], [], [], []
-    feature_strs = []
-    seq = revcom(seq) if flag.isnumeric() and int(flag) & 0X10 else seq
+def get_motif_scanner(motifs):
+    """
+    one precompiled regex of all the (IUPAC-expanded) motifs, compiled once per process instead of
+    per read. the lookahead also reports sites of overlapped motifs.
+    """
+    motif_seqs = get_motif_seqs(motifs)
+    return re.compile("(?=(?:{}))".format("|".join(motif_seqs)))
 
-    try:
-        fi = [int(x) for x in tags_dict['fi'].split(",")[1:]]
-        ri = [int(x) for x in tags_dict['ri'].split(",")[1:]]
-        fp = [int(x) for x in tags_dict['fp'].split(",")[1:]]
-        rp = [int(x) for x in tags_dict['rp'].split(",")[1:]]
-        fn = int(tags_dict['fn'])
-        rn = int(tags_dict['rn'])
-        if fn < args.depth or rn < args.depth:
-            return feature_strs
-
-        if not args.no_decode:
-            fi = [code2frames[ipdval] for ipdval in fi]
-            ri = [code2frames[ipval] for ipval in ri]
-            fp = [code2frames[pwval] for pwval in fp]
-            rp = [code2frames[pwval] for pwval in rp]
-            fi = _normalize_signals(fi, args.norm)
-            ri = _normalize_signals(ri, args.norm)
-            fp = _normalize_signals(fp, args.norm)
-            rp = _normalize_signals(rp, args.norm)
-            ri = ri[::-1]
-            rp = rp[::-1]
-
-        kmer_width = args.seq_len
-        half_width = kmer_width // 2
-        motifs = get_motif_seqs(args.motifs)
-        len_seq = len(seq)
-        for regex in motifs:
-            for match in re.finditer(regex, seq):
-                if match.start() < half_width or len_seq - match.start() < half_width + 2:
-                    continue
-                cg_index = match.start()
-                kmer_start = cg_index - half_width
-                kmer_end = kmer_start + kmer_width + 1
-                kmer = seq[kmer_start:kmer_end]
-                pos_kmer = kmer[:-1]
-                neg_kmer = revcom(kmer[1:])
-                repeatfn = [str(fn)] * kmer_width
-                repeatrn = [str(rn)] * kmer_width
-                # repeatstd = ["0"] * kmer_width
-
-                kmer_feature = (ccs, cg_index, "+", holeid, max(fn, rn), 
-                                pos_kmer, repeatfn, fi[kmer_start:kmer_end-1], repeatfn, fp[kmer_start:kmer_end-1], repeatfn, "-", "-", 
-                                neg_kmer, repeatrn, ri[kmer_end-1:kmer_start:-1], repeatrn, rp[kmer_end-1:kmer_start:-1], repeatrn, "-", "-",
-                                args.methy_label)
-                feature_str = _features_to_str_combedfeatures(kmer_feature)
-                feature_strs.append(feature_str)
-
-        return feature_strs
-    except Exception:
-        return feature_strs
+
+def _parse_ccs_line(line):
+    """
+    :return: (name, is_reverse, seq, fi, ri, fp, rp, fn, rn) of a sam line, or None if it has no kinetics
+    """
+    words = line.rstrip("\n").split("\t")
+    kinetics = {}
+    for tag in words[11:]:
+        key = tag[:2]
+        if key in kinetics_tags:
+            # e.g. fi:B:C,12,34,..
+            kinetics[key] = np.array(tag[7:].split(","), dtype=np.int64)
+        elif key == "fn" or key == "rn":
+            kinetics[key] = int(tag[5:])
+    if len(kinetics) < 6:
+        return None
+    return words[0], bool(int(words[1]) & 0x10), words[9], kinetics["fi"], kinetics["ri"], \
+        kinetics["fp"], kinetics["rp"], kinetics["fn"], kinetics["rn"]
+
+
+def _iter_ccs_lines(inputpath, path_to_samtools=None):
+    cmd_view_input = cmd_get_stdout_of_input(inputpath, path_to_samtools)
+    sys.stderr.write("cmd to view input: {}\n".format(cmd_view_input))
+    proc_read = Popen(cmd_view_input, shell=True, stdout=PIPE)
+    for output in proc_read.stdout:
+        output = str(output, 'utf-8')
+        if output.startswith("#") or output.startswith("@"):
+            continue
+        yield output
+    proc_read.wait()
+
+
+def _iter_ccs_reads_pysam(inputpath):
+    """
+    primary records of a bam/sam as (name, is_reverse, seq, fi, ri, fp, rp, fn, rn), the kinetics
+    arrays are taken from the decoded tags of pysam as they are, without formatting/parsing strings
+    """
+    import pysam
+    with pysam.AlignmentFile(inputpath, "rb" if inputpath.endswith(".bam") else "r", check_sq=False) as rf:
+        for read in rf.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+            try:
+                kinetics = [np.asarray(read.get_tag(tag), dtype=np.int64) for tag in kinetics_tags]
+                fn, rn = read.get_tag("fn"), read.get_tag("rn")
+            except KeyError:
+                continue
+            yield (read.query_name, read.is_reverse, read.query_sequence) + tuple(kinetics) + (fn, rn)
 
 
 def revcom(seq):
@@ -125,41 +138,187 @@ def revcom(seq):
     return seq.translate(tab)[::-1]
 
 
-def worker_read(inputfile, readline_q, args):
+def _ccs_read_sites(ccs_read, scanner, args):
+    """
+    :param ccs_read: (name, is_reverse, seq, fi, ri, fp, rp, fn, rn), or a sam line of it
+    :return: name, seq, sites, fi, fp, ri, rp, fn, rn. seq and the kinetics are in the orientation of
+             sequencing, ri/rp are reversed to the same order as fi/fp. sites are 0-based locs of the
+             targeted base of motifs in seq, which have a whole kmer on both strands. None if no site.
+    """
+    if isinstance(ccs_read, str):
+        ccs_read = _parse_ccs_line(ccs_read)
+        if ccs_read is None:
+            return None
+    name, is_reverse, seq, fi, ri, fp, rp, fn, rn = ccs_read
+    if fn < args.depth or rn < args.depth:
+        return None
+    seq = revcom(seq) if is_reverse else seq
+    len_seq = len(seq)
+    if not (len(fi) == len(ri) == len(fp) == len(rp) == len_seq):
+        return None
+
+    half_width = args.seq_len // 2
+    sites = np.fromiter((match.start() for match in scanner.finditer(seq)), dtype=np.int64) + args.mod_loc
+    sites = sites[(sites >= half_width) & (sites < len_seq - half_width - 1)]
+    if len(sites) == 0:
+        return None
+
+    if not args.no_decode:
+        fi, ri, fp, rp = _code2frames[fi], _code2frames[ri], _code2frames[fp], _code2frames[rp]
+    fi = _normalize_signals(fi, args.norm)
+    ri = _normalize_signals(ri, args.norm)[::-1]
+    fp = _normalize_signals(fp, args.norm)
+    rp = _normalize_signals(rp, args.norm)[::-1]
+    return name, seq, sites, fi, fp, ri, rp, fn, rn
+
+
+def ccs_reads_to_batch2s(ccs_reads, scanner, args):
+    """
+    features of the sites of ccs reads, built by read with array indexing, in the same layout as
+    _batch_feature_list2s() of call_mods (the kmer/ipd/pw of both strands as stacked arrays).
+    the std of a ccs kinetics value is not known, fn/rn is set instead.
+    :return: None if no site
+    """
+    offsets = np.arange(-(args.seq_len // 2), args.seq_len // 2 + 1)
+    sampleinfo = []
+    kmers, ipd_means, ipd_stds, pw_means, pw_stds = [], [], [], [], []
+    kmers2, ipd_means2, ipd_stds2, pw_means2, pw_stds2 = [], [], [], [], []
+    for ccs_read in ccs_reads:
+        read_sites = _ccs_read_sites(ccs_read, scanner, args)
+        if read_sites is None:
+            continue
+        name, seq, sites, fi, fp, ri, rp, fn, rn = read_sites
+        namewords = name.split("/")
+        if len(namewords) < 3:
+            continue
+        holeid = namewords[0] + "/" + namewords[1]
+        sampleinfo += ["\t".join([namewords[2], str(site), "+", holeid, str(max(fn, rn))])
+                       for site in sites.tolist()]
+
+        codes = base2code_dna_table[np.frombuffer(seq.encode(), dtype=np.uint8)]
+        locs_f = sites[:, None] + offsets
+        # the kmer of the complementary strand, centered on the base paired with the next base
+        locs_r = (sites + 1)[:, None] - offsets
+        kmers.append(codes[locs_f])
+        ipd_means.append(fi[locs_f])
+        ipd_stds.append(np.full(locs_f.shape, fn, dtype=np.float64))
+        pw_means.append(fp[locs_f])
+        pw_stds.append(np.full(locs_f.shape, fn, dtype=np.float64))
+        kmers2.append(_code2comp[codes[locs_r]])
+        ipd_means2.append(ri[locs_r])
+        ipd_stds2.append(np.full(locs_r.shape, rn, dtype=np.float64))
+        pw_means2.append(rp[locs_r])
+        pw_stds2.append(np.full(locs_r.shape, rn, dtype=np.float64))
+    if len(sampleinfo) == 0:
+        return None
+    labels = [args.methy_label] * len(sampleinfo)
+    return (sampleinfo, np.concatenate(kmers), np.concatenate(ipd_means).astype(np.float64),
+            np.concatenate(ipd_stds), np.concatenate(pw_means).astype(np.float64), np.concatenate(pw_stds),
+            np.concatenate(kmers2), np.concatenate(ipd_means2).astype(np.float64),
+            np.concatenate(ipd_stds2), np.concatenate(pw_means2).astype(np.float64), np.concatenate(pw_stds2),
+            labels)
+
+
+def ccs_reads_to_featurestrs(ccs_reads, scanner, args):
+    """
+    features of the sites of ccs reads, as lines of the combined-strands feature file
+    """
+    kmer_width = args.seq_len
+    half_width = kmer_width // 2
+    feature_strs = []
+    for ccs_read in ccs_reads:
+        read_sites = _ccs_read_sites(ccs_read, scanner, args)
+        if read_sites is None:
+            continue
+        name, seq, sites, fi, fp, ri, rp, fn, rn = read_sites
+        namewords = name.split("/")
+        if len(namewords) < 3:
+            continue
+        holeid = namewords[0] + "/" + namewords[1]
+        repeatfn = [str(fn)] * kmer_width
+        repeatrn = [str(rn)] * kmer_width
+        for cg_index in sites.tolist():
+            kmer_start = cg_index - half_width
+            kmer_end = kmer_start + kmer_width + 1
+            kmer = seq[kmer_start:kmer_end]
+            pos_kmer = kmer[:-1]
+            neg_kmer = revcom(kmer[1:])
+            kmer_feature = (namewords[2], cg_index, "+", holeid, max(fn, rn),
+                            pos_kmer, repeatfn, fi[kmer_start:kmer_end-1], repeatfn, fp[kmer_start:kmer_end-1],
+                            repeatfn, "-", "-",
+                            neg_kmer, repeatrn, ri[kmer_end-1:kmer_start:-1], repeatrn, rp[kmer_end-1:kmer_start:-1],
+                            repeatrn, "-", "-",
+                            args.methy_label)
+            feature_strs.append(_features_to_str_combedfeatures(kmer_feature))
+    return feature_strs
+
+
+def worker_read_ccs(inputfile, read_q, args, holeids_e=None, holeids_ne=None, metrics_q=None,
+                    metrics_interval=metrics_interval_default, batch_tuner=None, order_window=None,
+                    mem_budget=None):
+    """
+    put batches of args.holes_batch ccs reads into read_q. a bam is read by pysam if it is installed,
+    the reads are put as parsed tuples then; or else as sam lines, which are parsed by the workers.
+    :param batch_tuner: utils/batch_tuner.BatchTuner, holes_batch is read from it instead of args if set
+    :param order_window: utils/reorder.OrderWindow, batches are put as (seq, reads), and batch seq is not
+                         put before the writers are within the window
+    :param mem_budget: utils/mem_budget.MemoryBudget, a batch is not put before it fits in the budget
+    """
     sys.stderr.write("read_input process-{} starts\n".format(os.getpid()))
-    cmd_view_input = cmd_get_stdout_of_input(inputfile, args.path_to_samtools)
-    sys.stderr.write("cmd to view input: {}\n".format(cmd_view_input))
-    proc_read = Popen(cmd_view_input, shell=True, stdout=PIPE)
+    metrics = StageMetrics("reader", metrics_q, metrics_interval)
+    use_pysam = inputfile.endswith(".bam") and find_spec("pysam") is not None
+    if inputfile.endswith(".bam") and not use_pysam:
+        sys.stderr.write("pysam is not installed, reading {} by samtools\n".format(inputfile))
+    ccs_reads = _iter_ccs_reads_pysam(inputfile) if use_pysam else \
+        _iter_ccs_lines(inputfile, args.path_to_samtools)
+
     cnt_holes = 0
-    readline_list = []
-    while True:
-        output = str(proc_read.stdout.readline(), 'utf-8')
-        if output != "":
+    cnt_batches = 0
+    reads_batch = []
+    batch_start = time.time()
+    # "kill" is put even if reading the input fails, so that the workers do not wait forever
+    try:
+        for ccs_read in ccs_reads:
+            if holeids_e is not None or holeids_ne is not None:
+                holeid = _get_holeid(ccs_read[:ccs_read.find("\t")] if isinstance(ccs_read, str) else ccs_read[0])
+                if holeids_e is not None and holeid not in holeids_e:
+                    continue
+                if holeids_ne is not None and holeid in holeids_ne:
+                    continue
             cnt_holes += 1
-            readline_list.append(output)
-            if len(readline_list) >= args.holes_batch:
-                readline_q.put(readline_list)
-                readline_list = []
-                while readline_q.qsize() > queen_size_border:
+            reads_batch.append(ccs_read)
+            if len(reads_batch) >= (args.holes_batch if batch_tuner is None else batch_tuner.holes_batch()):
+                if order_window is not None:
+                    metrics.add_idle(order_window.wait(cnt_batches))
+                if mem_budget is not None:
+                    metrics.add_idle(mem_budget.admit(estimate_nbytes((cnt_batches, reads_batch))))
+                read_q.put((cnt_batches, reads_batch))
+                cnt_batches += 1
+                metrics.add(holes=len(reads_batch))
+                metrics.observe_batch(time.time() - batch_start)
+                reads_batch = []
+                while read_q.qsize() > queen_size_border:
                     time.sleep(time_wait)
-        elif proc_read.poll() is not None:
-            break
-        else:
-            continue
-
-    readline_q.put(readline_list)
-    while readline_q.qsize() > queen_size_border:
-        time.sleep(time_wait)
-
-    readline_q.put("kill")
-    rc_read = proc_read.poll()
-    sys.stderr.write("read_input process-{} ending, read {} holes, with return_code-{}\n".format(os.getpid(),
-                                                                                                 cnt_holes,
-                                                                                                 rc_read))
-
-
-def _ccs_extract(readline_q, featurestr_q, args, holeids_e=None, holeids_ne=None):
+                    metrics.add_idle(time_wait)
+                metrics.report()
+                batch_start = time.time()
+        if len(reads_batch) > 0:
+            if order_window is not None:
+                metrics.add_idle(order_window.wait(cnt_batches))
+            if mem_budget is not None:
+                metrics.add_idle(mem_budget.admit(estimate_nbytes((cnt_batches, reads_batch))))
+            read_q.put((cnt_batches, reads_batch))
+            metrics.add(holes=len(reads_batch))
+            metrics.observe_batch(time.time() - batch_start)
+    finally:
+        read_q.put("kill")
+    metrics.report(force=True)
+    sys.stderr.write("read_input process-{} ending, read {} holes\n".format(os.getpid(), cnt_holes))
+
+
+def _ccs_extract(readline_q, featurestr_q, args):
     sys.stderr.write("extrac_features process-{} starts\n".format(os.getpid()))
+    scanner = get_motif_scanner(args.motifs)
     cnt_linebatch = 0
     while True:
         # print("hole_align_q size:", hole_align_q.qsize(), "; pid:", os.getpid())
@@ -170,46 +329,9 @@ def _ccs_extract(readline_q, featurestr_q, args, holeids_e=None, holeids_ne=None
         if readline_list == "kill":
             readline_q.put("kill")
             break
-        feature_strs = []
-
-        for output in readline_list:
-            try:
-                if output.startswith("#") or output.startswith("@"):
-                    continue
-                words = output.strip().split('\t', 11)
-                holeid = _get_holeid(words[0])
-                if holeids_e is not None and holeid not in holeids_e:
-                    continue
-                if holeids_ne is not None and holeid in holeids_ne:
-                    continue
-
-                # flag = int(words[1])
-                # mapq = int(words[4])
-                # if not (flag == 0 or flag == 16):  # skip segment alignment
-                #     continue
-                # if mapq < args.mapq:  # skip low mapq alignment
-                #     continue
-                # now working on words:
-                kmer_feature_list = _ccs_words_to_feature(words, args)
-                for kmer_feature in kmer_feature_list:
-                    feature_strs.append(kmer_feature)
-            #     if holeid != holeid_curr:
-            #         if len(hole_align_tmp) > 0:
-            #             cnt_holes += 1
-            #             holes_align_tmp.append((holeid_curr, hole_align_tmp))
-            #             if len(holes_align_tmp) >= args.holes_batch:
-            #                 hole_align_q.put(holes_align_tmp)
-            #                 holes_align_tmp = []
-            #                 while hole_align_q.qsize() > queen_size_border:
-            #                     time.sleep(time_wait)
-            #         hole_align_tmp = []
-            #         holeid_curr = holeid
-            #     hole_align_tmp.append(words)
-            except Exception:
-                raise ValueError("error in extracting lines of input!")
-                continue
+        seq, readline_list = readline_list
 
-        featurestr_q.put(feature_strs)
+        featurestr_q.put((seq, ccs_reads_to_featurestrs(readline_list, scanner, args)))
         while featurestr_q.qsize() > queen_size_border:
             time.sleep(time_wait)
         cnt_linebatch += 1
@@ -230,7 +352,7 @@ def _normalize_signals(signals, normalize_method="zscore"):
     elif normalize_method == 'min-mean':
         sshift, sscale = np.min(signals), np.mean(signals)
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), np.float(robust.mad(signals))
+        sshift, sscale = np.median(signals), mad(signals)
     else:
         raise ValueError("")
     if sscale == 0.0:
@@ -288,21 +410,29 @@ def _features_to_str_combedfeatures(features):
                       str(label)])
 
 
-def _write_featurestr_to_file(write_fp, featurestr_q):
+def _write_featurestr_to_file(write_fp, featurestr_q, order_window=None):
     sys.stderr.write('write_process-{} started\n'.format(os.getpid()))
+    reorder_buffer = ReorderBuffer(order_window.written()) if order_window is not None else None
     with open(write_fp, 'w') as wf:
         while True:
             # during test, it's ok without the sleep(time_wait)
             if featurestr_q.empty():
                 time.sleep(time_wait)
                 continue
-            features_str = featurestr_q.get()
-            if features_str == "kill":
+            features_batch = featurestr_q.get()
+            if features_batch == "kill":
                 sys.stderr.write('write_process-{} finished\n'.format(os.getpid()))
                 break
-            for one_features_str in features_str:
-                wf.write(one_features_str + "\n")
+            seq, features_str = features_batch
+            for features_str in (reorder_buffer.push(seq, features_str) if reorder_buffer is not None
+                                 else [features_str]):
+                for one_features_str in features_str:
+                    wf.write(one_features_str + "\n")
             wf.flush()
+        if reorder_buffer is not None:
+            for features_str in reorder_buffer.flush():
+                for one_features_str in features_str:
+                    wf.write(one_features_str + "\n")
 
 
 def _get_holes(holeidfile):
@@ -335,7 +465,9 @@ def extract_ccs_features(args):
     readline_q = Queue()
     featurestr_q = Queue()
 
-    p_read = mp.Process(target=worker_read, args=(inputpath, readline_q, args))
+    order_window = get_order_window(mp, reorder_window_default)
+    p_read = mp.Process(target=worker_read_ccs, args=(inputpath, readline_q, args, holeids_e, holeids_ne,
+                                                      None, metrics_interval_default, None, order_window))
     p_read.daemon = True
     p_read.start()
 
@@ -346,22 +478,16 @@ def extract_ccs_features(args):
     if nproc > 2:
         nproc -= 2
     for _ in range(nproc):
-        p = mp.Process(target=_ccs_extract, args=(readline_q, featurestr_q, args, holeids_e, holeids_ne))
+        p = mp.Process(target=_ccs_extract, args=(readline_q, featurestr_q, args))
         p.daemon = True
         p.start()
         ps_extract.append(p)
 
     # print("write_process started..")
-    p_w = mp.Process(target=_write_featurestr_to_file, args=(outputpath, featurestr_q))
+    p_w = mp.Process(target=_write_featurestr_to_file, args=(outputpath, featurestr_q, order_window))
     p_w.daemon = True
     p_w.start()
 
-    while True:
-        # print("killing _worker_extract process")
-        running = any(p.is_alive() for p in ps_extract)
-        if not running:
-            break
-
     for p in ps_extract:
         p.join()
     p_read.join()
@@ -380,9 +506,8 @@ def main():
                         help="number of threads, default 5")
     p_input = parser.add_argument_group("INPUT")
     p_input.add_argument("--input", "-i", type=str, required=True,
-                         help="alignment results in bam/sam format. "
-                              "We assume that all items/reads are sorted by hole_ids "
-                              "in aligned.bam, which generated by align_subreads.py from subreads.bam.")
+                         help="CCS reads with kinetics tags (fi/ri/fp/rp, fn/rn) in bam/sam format, "
+                              "e.g. from `ccs --hifi-kinetics`.")
     p_input.add_argument("--holeids_e", type=str, default=None, required=False,
                          help="file contains holeids to be extracted, default None")
     p_input.add_argument("--holeids_ne", type=str, default=None, required=False,
@@ -31,6 +31,34 @@ def main_extract(args):
     extract_subreads_features(args)
 
 
+def main_simulate(args):
+    from .simulate_data import simulate
+
+    display_args(args, True)
+    simulate(args)
+
+
+def main_index_motifs(args):
+    from .utils.motif_index import index_motifs
+
+    display_args(args, True)
+    index_motifs(args)
+
+
+def main_bench(args):
+    from .bench import bench
+
+    display_args(args, True)
+    bench(args)
+
+
+def main_pipeline(args):
+    from .pipeline import pipeline
+
+    display_args(args)
+    pipeline(args)
+
+
 def main_train(args):
     from .train import train
     import time
@@ -49,13 +77,21 @@ def main_train(args):
 def main():
     parser = argparse.ArgumentParser(prog='ccsmeth',
                                      description="detecting methylation from PacBio CCS reads, "
-                                                 "ccsmeth contains four modules:\n"
+                                                 "ccsmeth contains eight modules:\n"
                                                  "\t%(prog)s align: align subreads to reference\n"
                                                  "\t%(prog)s call_mods: call modifications\n"
                                                  "\t%(prog)s extract: extract features from aligned "
                                                  "subreads for training or testing\n"
                                                  "\t%(prog)s train: train a model, need two independent "
-                                                 "datasets for training and validating",
+                                                 "datasets for training and validating\n"
+                                                 "\t%(prog)s simulate: simulate a reference and subreads/ccs "
+                                                 "reads with kinetics for testing\n"
+                                                 "\t%(prog)s bench: benchmark extract/call_mods with "
+                                                 "different worker configs\n"
+                                                 "\t%(prog)s index_motifs: index motif sites of a reference "
+                                                 "for extract/call_mods\n"
+                                                 "\t%(prog)s pipeline: align, extract, call modifications "
+                                                 "and calculate frequency of subreads in one run",
                                      formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(
         '-v', '--version', action='version',
@@ -68,6 +104,15 @@ def main():
     sub_extract = subparsers.add_parser("extract", description="extract features from aligned subreads.")
     sub_train = subparsers.add_parser("train", description="train a model, need two independent datasets for training "
                                                            "and validating")
+    sub_simulate = subparsers.add_parser("simulate", description="simulate a reference and subreads/ccs reads "
+                                                                 "with kinetics, for testing and benchmarking")
+    sub_index_motifs = subparsers.add_parser("index_motifs", description="index sites of motifs in a reference, "
+                                                                         "for --motif_index of extract/call_mods")
+    sub_bench = subparsers.add_parser("bench", description="benchmark extract/call_mods with different "
+                                                           "--threads/--threads_call/--holes_batch/--batch_size")
+    sub_pipeline = subparsers.add_parser("pipeline", description="align subreads on the fly, extract features, "
+                                                                 "call modifications and aggregate the frequency "
+                                                                 "of sites in one streaming run")
 
     # sub_align ============================================================================
     sa_input = sub_align.add_argument_group("INPUT")
@@ -76,6 +121,18 @@ def main():
     sa_input.add_argument("--ref", type=str, required=True,
                           help="path to genome reference to be aligned, in fasta/fa format. "
                                "If using bwa, the reference must have already been indexed.")
+    sa_input.add_argument("--holeids_e", type=str, default=None, required=False,
+                          help="file contains holeids to be aligned, e.g. saved by "
+                               "`python -m ccsmeth.utils.ccs_filter`, default None")
+    sa_input.add_argument("--ccs_bam", type=str, default=None, required=False,
+                          help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                               "--min_np, --ccs_mapped) are aligned. default None")
+    sa_input.add_argument("--min_rq", type=float, default=0.99, required=False,
+                          help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    sa_input.add_argument("--min_np", type=int, default=1, required=False,
+                          help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    sa_input.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                          help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
 
     sa_output = sub_align.add_argument_group("OUTPUT")
     sa_output.add_argument("--output", "-o", type=str, required=False,
@@ -94,6 +151,26 @@ def main():
                                "we use only primary alignment.]")
     sa_align.add_argument("--bwa", action="store_true", default=False, required=False,
                           help="use bwa instead of minimap2 for alignment")
+    sa_align.add_argument("--mappy", action="store_true", default=False, required=False,
+                          help="align in process with mappy (the python binding of minimap2, "
+                               "`pip install mappy`) instead of the minimap2 pipeline. the index is "
+                               "loaded once and shared by --threads threads, the output is grouped by "
+                               "holes in the input order. --ref can also be a minimap2 index (.mmi)")
+    sa_align.add_argument("--holes_batch", type=int, default=50, required=False,
+                          help="number of holes in a batch of a thread, for --mappy only, default 50")
+    sa_align.add_argument("--guide_bam", type=str, default=None, required=False,
+                          help="aligned CCS bam/sam of the subreads, for --mappy only. subreads of a hole are "
+                               "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                               "with a small index of the window, instead of to the whole genome. --ref must "
+                               "be a fasta. default None")
+    sa_align.add_argument("--guide_pad", type=int, default=1000, required=False,
+                          help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    sa_align.add_argument("--chunks", type=int, default=1, required=False,
+                          help="split the subreads into N chunks by blocks of holes, align each chunk by its "
+                               "own minimap2/bwa pipeline with --threads/N threads, and merge the results in "
+                               "the input hole order. for bam/sam input, default 1")
+    sa_align.add_argument("--chunk_holes", type=int, default=1000, required=False,
+                          help="number of holes in a block sent to a chunk, for --chunks only, default 1000")
     sa_align.add_argument("--path_to_minimap2", type=str, default=None, required=False,
                           help="full path to the executable binary minimap2 file. "
                                "If not specified, it is assumed that minimap2 is "
@@ -117,8 +194,24 @@ def main():
                           help="input file, can be aligned.bam/sam, or features.tsv generated by "
                                "extract_features.py. If aligned.bam/sam is provided, args in EXTRACTION "
                                "should (reference_path must) be provided.")
+    sc_input.add_argument("--mode", type=str, default="align", choices=["align", "ccs"], required=False,
+                          help="align: call from subreads (aligned.bam/sam, or with --align) or features.tsv; "
+                               "ccs: call from the kinetics tags (fi/ri/fp/rp) of CCS reads in --input "
+                               "(e.g. from `ccs --hifi-kinetics`), without subreads/reference, "
+                               "--model_type attbigru2s only. default align")
     sc_input.add_argument("--holes_batch", type=int, default=50, required=False,
                           help="number of holes in an batch to get/put in queues")
+    sc_input.add_argument("--holes_batch_bases", type=int, default=10000000, required=False,
+                          help="max number of subread bases in a batch of holes, a batch is put once it has "
+                               "--holes_batch holes or this many bases, so that batches of deep/long holes cost "
+                               "about the same; a hole of more bases is put in a batch of its own. 0 to batch by "
+                               "--holes_batch only. default 10000000")
+    sc_input.add_argument("--max_memory", type=str, default=None, required=False,
+                          help="max memory of the batches waiting in the queues between the reader, workers and "
+                               "writers, in bytes or with a unit (e.g. 4G, 512M). when it is reached, the reader "
+                               "pauses, and the workers pause while the next stage has batches to drain. the sizes "
+                               "of batches are estimated and the reference/models are not counted, so it is not a "
+                               "hard limit of the RSS. default None, batches are limited by count only")
 
     sc_call = sub_call_mods.add_argument_group("CALL")
     sc_call.add_argument("--model_file", "-m", action="store", type=str, required=True,
@@ -144,6 +237,15 @@ def main():
 
     sc_call.add_argument("--batch_size", "-b", default=512, type=int, required=False,
                          action="store", help="batch size, default 512")
+    sc_call.add_argument("--adaptive_batch", action="store_true", default=False, required=False,
+                         help="tune --holes_batch and --batch_size at runtime, from the busy/idle time of the "
+                              "extract/call workers and the depths of the queues, within --holes_batch_bounds/"
+                              "--batch_size_bounds. --holes_batch/--batch_size are the start values. "
+                              "subreads/ccs bam/sam input only")
+    sc_call.add_argument("--holes_batch_bounds", type=int, nargs=2, default=[5, 500], required=False,
+                         metavar=("MIN", "MAX"), help="bounds of holes_batch with --adaptive_batch, default 5 500")
+    sc_call.add_argument("--batch_size_bounds", type=int, nargs=2, default=[64, 4096], required=False,
+                         metavar=("MIN", "MAX"), help="bounds of batch_size with --adaptive_batch, default 64 4096")
 
     # BiRNN/transformerencoder model param
     sc_call.add_argument('--n_vocab', type=int, default=16, required=False,
@@ -171,14 +273,69 @@ def main():
     sc_output = sub_call_mods.add_argument_group("OUTPUT")
     sc_output.add_argument("--output", "-o", action="store", type=str, required=True,
                            help="the file path to save the predicted result")
+    sc_output.add_argument("--reorder_window", type=int, default=64, required=False,
+                           help="max number of batches of holes done ahead of the earliest unwritten one, which "
+                                "wait in the writer to be written in the hole order of the input; the reader pauses "
+                                "when it is reached. 0 to write the batches as they are done (not in input order). "
+                                "default 64")
+    sc_output.add_argument("--freq_output", type=str, default=None, required=False,
+                           help="also aggregate the modification frequency of sites from the calls while "
+                                "writing them, and save it to this file, default None")
+    sc_output.add_argument("--freq_bed", action="store_true", default=False, required=False,
+                           help="save the frequency in bedMethyl format, for --freq_output")
+    sc_output.add_argument("--freq_sort", action="store_true", default=False, required=False,
+                           help="sort sites in the frequency file, for --freq_output")
+    sc_output.add_argument("--prob_cf", type=float, default=0.0, required=False,
+                           help="use a call in the frequency only if abs(prob1-prob0)>=prob_cf, "
+                                "for --freq_output. range [0, 1], default 0.0, use all calls")
+    sc_output.add_argument("--rm_1strand", action="store_true", default=False, required=False,
+                           help="abandon ccs reads with only 1 strand subreads in the frequency, "
+                                "for --freq_output")
 
     sc_extract = sub_call_mods.add_argument_group("EXTRACTION")
     sc_extract.add_argument("--ref", type=str, required=False,
                             help="path to genome reference to be aligned, in fasta/fa format.")
+    sc_extract.add_argument("--ref_cache", action="store_true", default=False, required=False,
+                            help="serve the reference from a pre-uppercased 1-byte-per-base cache file "
+                                 "(ref.ccsmeth.seq, built at the first use) instead of the fasta. By default "
+                                 "the reference is memory-mapped through its .fai index (built if missing), "
+                                 "and shared by all processes.")
+    sc_extract.add_argument("--align", action="store_true", default=False, required=False,
+                            help="the input is unaligned subreads.bam/sam, align them to --ref on the fly "
+                                 "with mappy (`pip install mappy`) and extract from the alignments directly, "
+                                 "without writing/reading an intermediate aligned bam")
+    sc_extract.add_argument("--align_index", type=str, default=None, required=False,
+                            help="minimap2 index (.mmi, -x map-pb) of --ref for --align, to skip building "
+                                 "the index from --ref")
+    sc_extract.add_argument("--align_threads", type=int, default=4, required=False,
+                            help="number of threads to align with, for --align only, default 4")
+    sc_extract.add_argument("--guide_bam", type=str, default=None, required=False,
+                            help="aligned CCS bam/sam of the subreads, for --align only. subreads of a hole are "
+                                 "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                                 "instead of to the whole genome. default None")
+    sc_extract.add_argument("--guide_pad", type=int, default=1000, required=False,
+                            help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    sc_extract.add_argument("--align_to_ccs", action="store_true", default=False, required=False,
+                            help="with --align and --guide_bam, align subreads to the CCS read of their hole instead "
+                                 "of the reference, aggregate kinetics in CCS coordinates, and lift the sites to "
+                                 "the reference through the CCS alignment. --guide_bam must be grouped by holes in "
+                                 "the same order as the subreads (e.g. aligned without sorting)")
+    sc_extract.add_argument("--tee_aligned", type=str, default=None, required=False,
+                            help="also save the alignments of --align to this bam/sam file, default None")
     sc_extract.add_argument("--holeids_e", type=str, default=None, required=False,
                             help="file contains holeids to be extracted, default None")
     sc_extract.add_argument("--holeids_ne", type=str, default=None, required=False,
                             help="file contains holeids not to be extracted, default None")
+    sc_extract.add_argument("--ccs_bam", type=str, default=None, required=False,
+                            help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                                 "--min_np, --ccs_mapped) are used, the others are dropped before parsing. "
+                                 "default None")
+    sc_extract.add_argument("--min_rq", type=float, default=0.99, required=False,
+                            help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    sc_extract.add_argument("--min_np", type=int, default=1, required=False,
+                            help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    sc_extract.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                            help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
     sc_extract.add_argument("--motifs", action="store", type=str,
                             required=False, default='CG',
                             help='motif seq to be extracted, default: CG. '
@@ -189,6 +346,14 @@ def main():
                                  'the same')
     sc_extract.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
                             help='0-based location of the targeted base in the motif, default 0')
+    sc_extract.add_argument("--extra_motifs", action="append", nargs=4, type=str, required=False,
+                            metavar=("MOTIFS", "MOD_LOC", "MODEL_FILE", "OUTPUT"), default=None,
+                            help="an extra motif spec to call in the same pass (subreads input only), its sites are "
+                                 "called by MODEL_FILE (of the same --model_type/params as --model_file) and saved "
+                                 "in OUTPUT. can be repeated. --freq_output is of --motifs only, default None")
+    sc_extract.add_argument("--motif_index", type=str, default=None, required=False,
+                            help="motif index built by `ccsmeth index_motifs` with the same --ref/--motifs/--mod_loc, "
+                                 "to get target sites from the index instead of scanning the reference, default None")
     sc_extract.add_argument("--methy_label", action="store", type=int,
                             choices=[1, 0], required=False, default=1,
                             help="the label of the interested modified bases, this is for training."
@@ -228,6 +393,25 @@ def main():
                                                     "no more than threads/4 is suggested. default 2.")
     sub_call_mods.add_argument('--tseed', type=int, default=1234,
                                help='random seed for torch')
+    sub_call_mods.add_argument("--start_method", type=str, default="forkserver", required=False,
+                               choices=["forkserver", "spawn"],
+                               help="how to start worker processes. forkserver: fork workers from a server process "
+                                    "with numpy/torch/ccsmeth preloaded, which is much faster to start (falls back to "
+                                    "spawn if not available); spawn: start each worker in a new interpreter. "
+                                    "default forkserver")
+
+    sc_metrics = sub_call_mods.add_argument_group("METRICS")
+    sc_metrics.add_argument("--metrics_file", type=str, default=None, required=False,
+                            help="file to export per-stage throughput/latency/queue-depth metrics "
+                                 "periodically, in json-lines format, or in prometheus text format "
+                                 "if the file ends with .prom. default None, no metrics exported")
+    sc_metrics.add_argument("--metrics_interval", type=float, default=10, required=False,
+                            help="interval (seconds) of exporting metrics, default 10")
+    sc_metrics.add_argument("--profile", type=str, default=None, required=False,
+                            help="directory to save cProfile stats of each worker process, the stats "
+                                 "are merged into DIR/report.txt at the end. default None, no profiling")
+    sc_metrics.add_argument("--profile_torch", action="store_true", default=False, required=False,
+                            help="also run torch profiler in call workers when --profile is set")
 
     sub_call_mods.set_defaults(func=main_call_mods)
 
@@ -239,15 +423,57 @@ def main():
                                "in aligned.bam, which generated by align_subreads.py from subreads.bam.")
     se_input.add_argument("--ref", type=str, required=True,
                           help="path to genome reference to be aligned, in fasta/fa format.")
+    se_input.add_argument("--ref_cache", action="store_true", default=False, required=False,
+                          help="serve the reference from a pre-uppercased 1-byte-per-base cache file "
+                               "(ref.ccsmeth.seq, built at the first use) instead of the fasta. By default "
+                               "the reference is memory-mapped through its .fai index (built if missing), "
+                               "and shared by all processes.")
+    se_input.add_argument("--align", action="store_true", default=False, required=False,
+                          help="the input is unaligned subreads.bam/sam, align them to --ref on the fly "
+                               "with mappy (`pip install mappy`) and extract from the alignments directly, "
+                               "without writing/reading an intermediate aligned bam")
+    se_input.add_argument("--align_index", type=str, default=None, required=False,
+                          help="minimap2 index (.mmi, -x map-pb) of --ref for --align, to skip building "
+                               "the index from --ref")
+    se_input.add_argument("--align_threads", type=int, default=4, required=False,
+                          help="number of threads to align with, for --align only, default 4")
+    se_input.add_argument("--guide_bam", type=str, default=None, required=False,
+                          help="aligned CCS bam/sam of the subreads, for --align only. subreads of a hole are "
+                               "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                               "instead of to the whole genome. default None")
+    se_input.add_argument("--guide_pad", type=int, default=1000, required=False,
+                          help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    se_input.add_argument("--align_to_ccs", action="store_true", default=False, required=False,
+                          help="with --align and --guide_bam, align subreads to the CCS read of their hole instead "
+                               "of the reference, aggregate kinetics in CCS coordinates, and lift the sites to "
+                               "the reference through the CCS alignment. --guide_bam must be grouped by holes in "
+                               "the same order as the subreads (e.g. aligned without sorting)")
+    se_input.add_argument("--tee_aligned", type=str, default=None, required=False,
+                          help="also save the alignments of --align to this bam/sam file, default None")
     se_input.add_argument("--holeids_e", type=str, default=None, required=False,
                           help="file contains holeids to be extracted, default None")
     se_input.add_argument("--holeids_ne", type=str, default=None, required=False,
                           help="file contains holeids not to be extracted, default None")
+    se_input.add_argument("--ccs_bam", type=str, default=None, required=False,
+                          help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                               "--min_np, --ccs_mapped) are used, the others are dropped before parsing. "
+                               "default None")
+    se_input.add_argument("--min_rq", type=float, default=0.99, required=False,
+                          help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    se_input.add_argument("--min_np", type=int, default=1, required=False,
+                          help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    se_input.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                          help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
 
     se_output = sub_extract.add_argument_group("OUTPUT")
     se_output.add_argument("--output", "-o", type=str, required=False,
                            help="output file path to save the extracted features. "
                                 "If not specified, use input_prefix.tsv as default.")
+    se_output.add_argument("--reorder_window", type=int, default=64, required=False,
+                           help="max number of batches of holes done ahead of the earliest unwritten one, which "
+                                "wait in the writer to be written in the hole order of the input; the reader pauses "
+                                "when it is reached. 0 to write the batches as they are done (not in input order). "
+                                "default 64")
 
     se_extract = sub_extract.add_argument_group("EXTRACT")
     se_extract.add_argument("--seq_len", type=int, default=21, required=False,
@@ -262,6 +488,14 @@ def main():
                                  'the same')
     se_extract.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
                             help='0-based location of the targeted base in the motif, default 0')
+    se_extract.add_argument("--extra_motifs", action="append", nargs=3, type=str, required=False,
+                            metavar=("MOTIFS", "MOD_LOC", "OUTPUT"), default=None,
+                            help="an extra motif spec to extract in the same pass, features of its sites are "
+                                 "saved in OUTPUT. can be repeated, e.g. --extra_motifs CHG,CHH 0 chh.features.tsv, "
+                                 "default None")
+    se_extract.add_argument("--motif_index", type=str, default=None, required=False,
+                            help="motif index built by `ccsmeth index_motifs` with the same --ref/--motifs/--mod_loc, "
+                                 "to get target sites from the index instead of scanning the reference, default None")
     se_extract.add_argument("--methy_label", action="store", type=int,
                             choices=[1, 0], required=False, default=1,
                             help="the label of the interested modified bases, this is for training."
@@ -293,12 +527,34 @@ def main():
                                  "the PATH.")
     se_extract.add_argument("--holes_batch", type=int, default=50, required=False,
                             help="number of holes in an batch to get/put in queues")
+    se_extract.add_argument("--holes_batch_bases", type=int, default=10000000, required=False,
+                            help="max number of subread bases in a batch of holes, a batch is put once it has "
+                                 "--holes_batch holes or this many bases, so that batches of deep/long holes cost "
+                                 "about the same; a hole of more bases is put in a batch of its own. 0 to batch by "
+                                 "--holes_batch only. default 10000000")
+    se_extract.add_argument("--max_memory", type=str, default=None, required=False,
+                            help="max memory of the batches waiting in the queues between the reader, workers and "
+                                 "writers, in bytes or with a unit (e.g. 4G, 512M). when it is reached, the reader "
+                                 "pauses, and the workers pause while the next stage has batches to drain. the sizes "
+                                 "of batches are estimated and the reference/models are not counted, so it is not a "
+                                 "hard limit of the RSS. default None, batches are limited by count only")
     se_extract.add_argument("--seed", type=int, default=1234, required=False,
                             help="seed for randomly selecting subreads, default 1234")
 
     sub_extract.add_argument("--threads", type=int, default=5, required=False,
                              help="number of threads, default 5")
 
+    se_metrics = sub_extract.add_argument_group("METRICS")
+    se_metrics.add_argument("--metrics_file", type=str, default=None, required=False,
+                            help="file to export per-stage throughput/latency/queue-depth metrics "
+                                 "periodically, in json-lines format, or in prometheus text format "
+                                 "if the file ends with .prom. default None, no metrics exported")
+    se_metrics.add_argument("--metrics_interval", type=float, default=10, required=False,
+                            help="interval (seconds) of exporting metrics, default 10")
+    se_metrics.add_argument("--profile", type=str, default=None, required=False,
+                            help="directory to save cProfile stats of each worker process, the stats "
+                                 "are merged into DIR/report.txt at the end. default None, no profiling")
+
     sub_extract.set_defaults(func=main_extract)
 
     # sub_train =====================================================================================
@@ -374,6 +630,44 @@ def main():
 
     sub_train.set_defaults(func=main_train)
 
+    # sub_simulate ==================================================================================
+    from .simulate_data import add_simulate_args
+    add_simulate_args(sub_simulate)
+
+    sub_simulate.set_defaults(func=main_simulate)
+
+    # sub_index_motifs ==============================================================================
+    si_input = sub_index_motifs.add_argument_group("INPUT")
+    si_input.add_argument("--ref", type=str, required=True,
+                          help="path to genome reference, in fasta/fa format.")
+    si_input.add_argument("--motifs", action="store", type=str,
+                          required=False, default='CG',
+                          help='motif seq to be indexed, default: CG. '
+                               'can be multi motifs splited by comma '
+                               '(no space allowed in the input str), '
+                               'or use IUPAC alphabet, '
+                               'the mod_loc of all motifs must be '
+                               'the same')
+    si_input.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
+                          help='0-based location of the targeted base in the motif, default 0')
+    si_output = sub_index_motifs.add_argument_group("OUTPUT")
+    si_output.add_argument("--output", "-o", type=str, required=False, default=None,
+                           help="output file of the index, default ref.motifs.idx")
+
+    sub_index_motifs.set_defaults(func=main_index_motifs)
+
+    # sub_bench =====================================================================================
+    from .bench import add_bench_args
+    add_bench_args(sub_bench)
+
+    sub_bench.set_defaults(func=main_bench)
+
+    # sub_pipeline ==================================================================================
+    from .pipeline import add_pipeline_args
+    add_pipeline_args(sub_pipeline)
+
+    sub_pipeline.set_defaults(func=main_pipeline)
+
     args = parser.parse_args()
     if hasattr(args, 'func'):
         args.func(args)
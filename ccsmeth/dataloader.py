@@ -21,10 +21,10 @@ def parse_a_line(line):
     sampleinfo = "\t".join(words[0:5])
 
     kmer = np.array([base2code_dna[x] for x in words[5]])
-    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float)
-    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float)
-    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float)
-    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float)
+    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float64)
+    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float64)
+    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float64)
+    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float64)
 
     label = int(words[13])
 
@@ -69,16 +69,16 @@ def parse_a_line2s(line):
     sampleinfo = "\t".join(words[0:5])
 
     kmer = np.array([base2code_dna[x] for x in words[5]])
-    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float)
-    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float)
-    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float)
-    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float)
+    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float64)
+    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float64)
+    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float64)
+    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float64)
 
     kmer2 = np.array([base2code_dna[x] for x in words[13]])
-    ipd_means2 = np.array([float(x) for x in words[15].split(",")], dtype=np.float)
-    ipd_stds2 = np.array([float(x) for x in words[16].split(",")], dtype=np.float)
-    pw_means2 = np.array([float(x) for x in words[17].split(",")], dtype=np.float)
-    pw_stds2 = np.array([float(x) for x in words[18].split(",")], dtype=np.float)
+    ipd_means2 = np.array([float(x) for x in words[15].split(",")], dtype=np.float64)
+    ipd_stds2 = np.array([float(x) for x in words[16].split(",")], dtype=np.float64)
+    pw_means2 = np.array([float(x) for x in words[17].split(",")], dtype=np.float64)
+    pw_stds2 = np.array([float(x) for x in words[18].split(",")], dtype=np.float64)
 
     label = int(words[21])
 
@@ -124,19 +124,19 @@ def parse_a_line2(line):
     kmer = np.array([base2code_dna[x] for x in words[5]])
     height, width = len(kmer), len(base2code_dna.keys())
 
-    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float)
-    ipd_m_mat = np.zeros((1, height, width), dtype=np.float)
+    ipd_means = np.array([float(x) for x in words[7].split(",")], dtype=np.float64)
+    ipd_m_mat = np.zeros((1, height, width), dtype=np.float64)
     ipd_m_mat[0, np.arange(len(kmer)), kmer] = ipd_means
-    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float)
-    pw_m_mat = np.zeros((1, height, width), dtype=np.float)
+    pw_means = np.array([float(x) for x in words[9].split(",")], dtype=np.float64)
+    pw_m_mat = np.zeros((1, height, width), dtype=np.float64)
     pw_m_mat[0, np.arange(len(kmer)), kmer] = pw_means
     mat_ccs_mean = np.concatenate((ipd_m_mat, pw_m_mat), axis=0)  # (C=2, H, W)
 
-    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float)
-    ipd_s_mat = np.zeros((1, height, width), dtype=np.float)
+    ipd_stds = np.array([float(x) for x in words[8].split(",")], dtype=np.float64)
+    ipd_s_mat = np.zeros((1, height, width), dtype=np.float64)
     ipd_s_mat[0, np.arange(len(kmer)), kmer] = ipd_stds
-    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float)
-    pw_s_mat = np.zeros((1, height, width), dtype=np.float)
+    pw_stds = np.array([float(x) for x in words[10].split(",")], dtype=np.float64)
+    pw_s_mat = np.zeros((1, height, width), dtype=np.float64)
     pw_s_mat[0, np.arange(len(kmer)), kmer] = pw_stds
     mat_ccs_std = np.concatenate((ipd_s_mat, pw_s_mat), axis=0)  # (C=2, H, W)
 
@@ -3,7 +3,6 @@ import argparse
 import sys
 import time
 import numpy as np
-from statsmodels import robust
 from subprocess import Popen, PIPE
 import multiprocessing as mp
 from multiprocessing import Queue
@@ -16,12 +15,36 @@ from .utils.process_utils import codecv1_to_frame
 from .utils.process_utils import generate_samtools_view_cmd
 from .utils.process_utils import get_refloc_of_methysite_in_motif
 from .utils.process_utils import get_motif_seqs
-from .utils.ref_reader import DNAReference
+from .utils.ref_reader import load_reference_contigs
+from .utils.motif_index import load_motif_index
 from .utils.process_utils import complement_seq
+from .utils.process_utils import mad
+from .utils.process_utils import SamWriter
+from .utils.ccs_filter import holeids_of_args
+from .utils.mappy_align import get_aligner
+from .utils.mappy_align import check_aligner_inputs
+from .utils.mappy_align import ccs_contig
+from .utils.mappy_align import read_sam_header
+from .utils.mappy_align import aligner_sam_header
+from .utils.mappy_align import iter_subreads_holes
+from .utils.mappy_align import iter_aligned_holes
+from .utils.mappy_align import aligned_subread_to_fields
+from .utils.metrics import StageMetrics
+from .utils.metrics import MetricsMonitor
+from .utils.reorder import ReorderBuffer
+from .utils.reorder import get_order_window
+from .utils.mem_budget import estimate_nbytes
+from .utils.mem_budget import get_memory_budget
+from .utils.mem_budget import report_peak_memory
+from .utils.profiling import wrap_target
+from .utils.profiling import prepare_profile_dir
+from .utils.profiling import merge_profiles
 
 code2frames = codecv1_to_frame()
+_code2frames = np.array([code2frames[i] for i in range(len(code2frames))], dtype=np.int64)
 queen_size_border = 1000
 time_wait = 1
+align_bestn = 3  # the same as `ccsmeth align`, so that --tee_aligned is the same as its output
 
 exceptval = 1000
 subreads_value_default = "-"
@@ -60,23 +83,118 @@ def _get_holeid(subread_id):
     return holeid
 
 
-def worker_read(inputfile, hole_align_q, args, holeids_e=None, holeids_ne=None):
-    sys.stderr.write("read_input process-{} starts\n".format(os.getpid()))
+def _align_reference(args):
+    return args.align_index if args.align_index is not None and args.guide_bam is None else args.ref
+
+
+def check_align_args(args):
+    """
+    check the args of --align in the main process, before the reader process loads the aligner
+    """
+    if not args.align:
+        return
+    if args.tee_aligned is not None and args.align_to_ccs:
+        raise ValueError("--tee_aligned is not supported with --align_to_ccs, the subreads are "
+                         "aligned to the CCS reads, not the reference")
+    check_aligner_inputs(_align_reference(args), args.guide_bam, args.align_to_ccs)
+
+
+def _iter_alignments_of_input(inputfile, args, read_status, holeids_e=None, holeids_ne=None):
+    """
+    sam fields of the alignments in the input (aligned bam/sam), or of the input subreads aligned on
+    the fly (--align), in the input order. read_status["returncode"] is set when the input is exhausted.
+    """
+    if args.align:
+        reference = _align_reference(args)
+        sys.stderr.write("aligning input to {} on the fly\n".format(reference))
+        aligner = get_aligner(reference, align_bestn, args.align_threads, args.guide_bam, args.guide_pad,
+                              args.path_to_samtools, args.align_to_ccs)
+        writer = None
+        if args.tee_aligned is not None:
+            writer = SamWriter(args.tee_aligned,
+                               aligner_sam_header(aligner, read_sam_header(inputfile, args.path_to_samtools)),
+                               args.path_to_samtools)
+        holes = ((holeid, subreads) for holeid, subreads in iter_subreads_holes(inputfile, args.path_to_samtools)
+                 if (holeids_e is None or holeid in holeids_e) and (holeids_ne is None or holeid not in holeids_ne))
+        for _, hole_aligns in iter_aligned_holes(holes, aligner, align_bestn, args.align_threads, args.holes_batch):
+            for words in hole_aligns:
+                if writer is not None:
+                    writer.write(aligned_subread_to_fields(words))
+                yield words
+        if writer is not None:
+            writer.close()
+        read_status["returncode"] = 0
+        return
+
     cmd_view_input = cmd_get_stdout_of_input(inputfile, args.path_to_samtools)
     sys.stderr.write("cmd to view input: {}\n".format(cmd_view_input))
     proc_read = Popen(cmd_view_input, shell=True, stdout=PIPE)
+    for output in proc_read.stdout:
+        output = str(output, 'utf-8')
+        if output.startswith("#") or output.startswith("@"):
+            continue
+        if holeids_e is not None or holeids_ne is not None:
+            # drop holes before splitting the whole line
+            holeid = _get_holeid(output[:output.find("\t")])
+            if (holeids_e is not None and holeid not in holeids_e) or \
+                    (holeids_ne is not None and holeid in holeids_ne):
+                continue
+        yield output.strip().split("\t")
+    read_status["returncode"] = proc_read.wait()
+
+
+def _subread_cost(words):
+    # estimated work of a subread: its number of bases
+    return len(words[9]) if words[9] != "*" else 1
+
+
+def _put_holes_batch(hole_align_q, seq, holes_align_tmp, metrics, batch_start, wait=True, order_window=None,
+                     mem_budget=None):
+    if order_window is not None:
+        metrics.add_idle(order_window.wait(seq))
+    if mem_budget is not None:
+        metrics.add_idle(mem_budget.admit(estimate_nbytes((seq, holes_align_tmp))))
+    hole_align_q.put((seq, holes_align_tmp))
+    metrics.add(holes=len(holes_align_tmp))
+    metrics.observe_batch(time.time() - batch_start)
+    if wait:
+        while hole_align_q.qsize() > queen_size_border:
+            time.sleep(time_wait)
+            metrics.add_idle(time_wait)
+        metrics.report()
+    return time.time()
+
 
+def worker_read(inputfile, hole_align_q, args, holeids_e=None, holeids_ne=None, metrics_q=None, batch_tuner=None,
+                order_window=None, mem_budget=None):
+    """
+    holes are put in batches of args.holes_batch holes, or of args.holes_batch_bases bases of subreads
+    if the holes are deep/long, whichever comes first. a hole of more than args.holes_batch_bases bases
+    is put in a batch of its own. the sam fields of all subreads of a hole, ip/pw tags included, are held
+    until the hole is put, there is no bound on the memory of one hole.
+    :param batch_tuner: utils/batch_tuner.BatchTuner, holes_batch is read from it instead of args if set
+    :param order_window: utils/reorder.OrderWindow, batches are put as (seq, holes), and batch seq is not
+                         put before the writers are within the window
+    :param mem_budget: utils/mem_budget.MemoryBudget, a batch is not put before it fits in the budget
+    """
+    sys.stderr.write("read_input process-{} starts\n".format(os.getpid()))
+    metrics = StageMetrics("reader", metrics_q, args.metrics_interval)
+    max_batch_cost = args.holes_batch_bases if args.holes_batch_bases > 0 else None
+
+    read_status = {}
     holes_align_tmp = []
+    batch_cost = 0
     holeid_curr = ""
     hole_align_tmp = []
+    hole_cost = 0
     cnt_holes = 0
-    while True:
-        output = str(proc_read.stdout.readline(), 'utf-8')
-        if output != "":
+    cnt_batches = 0
+    batch_start = time.time()
+    # "kill" is put even if reading/aligning the input fails, so that the workers do not wait forever,
+    # the error then fails the process, which the main process reports
+    try:
+        for words in _iter_alignments_of_input(inputfile, args, read_status, holeids_e, holeids_ne):
             try:
-                if output.startswith("#") or output.startswith("@"):
-                    continue
-                words = output.strip().split("\t")
                 holeid = _get_holeid(words[0])
                 if holeids_e is not None and holeid not in holeids_e:
                     continue
@@ -92,30 +210,47 @@ def worker_read(inputfile, hole_align_q, args, holeids_e=None, holeids_ne=None):
                 if holeid != holeid_curr:
                     if len(hole_align_tmp) > 0:
                         cnt_holes += 1
+                        if max_batch_cost is not None and hole_cost >= max_batch_cost and len(holes_align_tmp) > 0:
+                            # an oversized hole goes to a batch of its own
+                            batch_start = _put_holes_batch(hole_align_q, cnt_batches, holes_align_tmp, metrics,
+                                                           batch_start, order_window=order_window,
+                                                           mem_budget=mem_budget)
+                            cnt_batches += 1
+                            holes_align_tmp, batch_cost = [], 0
                         holes_align_tmp.append((holeid_curr, hole_align_tmp))
-                        if len(holes_align_tmp) >= args.holes_batch:
-                            hole_align_q.put(holes_align_tmp)
-                            holes_align_tmp = []
-                            while hole_align_q.qsize() > queen_size_border:
-                                time.sleep(time_wait)
+                        batch_cost += hole_cost
+                        holes_batch = args.holes_batch if batch_tuner is None else batch_tuner.holes_batch()
+                        if len(holes_align_tmp) >= holes_batch or \
+                                (max_batch_cost is not None and batch_cost >= max_batch_cost):
+                            batch_start = _put_holes_batch(hole_align_q, cnt_batches, holes_align_tmp, metrics,
+                                                           batch_start, order_window=order_window,
+                                                           mem_budget=mem_budget)
+                            cnt_batches += 1
+                            holes_align_tmp, batch_cost = [], 0
                     hole_align_tmp = []
+                    hole_cost = 0
                     holeid_curr = holeid
                 hole_align_tmp.append(words)
+                hole_cost += _subread_cost(words)
             except Exception:
                 # raise ValueError("error in parsing lines of input!")
                 continue
-        elif proc_read.poll() is not None:
-            if len(hole_align_tmp) > 0:
-                cnt_holes += 1
-                holes_align_tmp.append((holeid_curr, hole_align_tmp))
-            if len(holes_align_tmp) > 0:
-                hole_align_q.put(holes_align_tmp)
-            break
-        else:
-            # print("output:", output)
-            continue
-    hole_align_q.put("kill")
-    rc_read = proc_read.poll()
+        if len(hole_align_tmp) > 0:
+            cnt_holes += 1
+            if max_batch_cost is not None and hole_cost >= max_batch_cost and len(holes_align_tmp) > 0:
+                batch_start = _put_holes_batch(hole_align_q, cnt_batches, holes_align_tmp, metrics, batch_start, False,
+                                               order_window=order_window, mem_budget=mem_budget)
+                cnt_batches += 1
+                holes_align_tmp = []
+            holes_align_tmp.append((holeid_curr, hole_align_tmp))
+        if len(holes_align_tmp) > 0:
+            _put_holes_batch(hole_align_q, cnt_batches, holes_align_tmp, metrics, batch_start, False,
+                             order_window=order_window, mem_budget=mem_budget)
+            cnt_batches += 1
+    finally:
+        hole_align_q.put("kill")
+    metrics.report(force=True)
+    rc_read = read_status.get("returncode")
     sys.stderr.write("read_input process-{} ending, read {} holes, with return_code-{}\n".format(os.getpid(),
                                                                                                  cnt_holes,
                                                                                                  rc_read))
@@ -129,7 +264,7 @@ def _normalize_signals(signals, normalize_method="zscore"):
     elif normalize_method == 'min-mean':
         sshift, sscale = np.min(signals), np.mean(signals)
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), np.float(robust.mad(signals))
+        sshift, sscale = np.median(signals), mad(signals)
     else:
         raise ValueError("")
     if sscale == 0.0:
@@ -177,6 +312,74 @@ def _parse_cigar(cigarseq):
     return identity, queryseq_poses, refpos2querypos
 
 
+_cigar_pattern = re.compile(r'(\d+)([SHXM=IDNP])')
+
+
+def _parse_cigar_blocks(cigarseq):
+    """
+    the same as _parse_cigar(), but the aligned (X/=/M) positions are kept as blocks instead of per base
+    :return: identity, int array of (refpos, querypos, length) of each aligned block, positions are
+             0-based offsets from the start of the alignment
+    """
+    blocks = []
+    cnt_s, cnt_m, cnt_i, cnt_d = 0, 0, 0, 0
+    cidx_q, cidx_t = 0, 0
+    for num, op in _cigar_pattern.findall(cigarseq):
+        num = int(num)
+        if op == 'S':
+            cidx_q += num
+            cnt_s += num
+        elif op == 'X' or op == '=' or op == 'M':
+            blocks.append((cidx_t, cidx_q, num))
+            cidx_q += num
+            cidx_t += num
+            cnt_m += num
+        elif op == 'I':
+            cidx_q += num
+            cnt_i += num
+        elif op == 'D':
+            cidx_t += num
+            cnt_d += num
+        else:
+            sys.stderr.write("warning: got {} in cigar!\n".format(op))
+    identity = float(cnt_m)/(cnt_s + cnt_m + cnt_i + cnt_d)
+    return identity, np.array(blocks, dtype=np.int64).reshape(-1, 3)
+
+
+def _get_kinetics_tags(words):
+    """
+    ip/pw tags of a subread, not decoded: arrays of subreads aligned in process (see
+    utils/mappy_align.py), or the strings of sam tags
+    :return: ipd_tag, pw_tag, None if missing or the lengths of ipd/pw do not match
+    """
+    ipd, pw = None, None
+    for i in range(11, len(words)):
+        if isinstance(words[i], tuple):
+            if words[i][0] == "ip":
+                ipd = words[i][2]
+            elif words[i][0] == "pw":
+                pw = words[i][2]
+        elif words[i].startswith("ip:B:C,"):
+            ipd = words[i]
+        elif words[i].startswith("pw:B:C,"):
+            pw = words[i]
+    if ipd is None or pw is None:
+        return None, None
+    lens = [len(tag) if not isinstance(tag, str) else tag.count(",") for tag in (ipd, pw)]
+    if lens[0] == 0 or lens[0] != lens[1]:
+        return None, None
+    return ipd, pw
+
+
+def _decode_kinetics_tag(tag, no_decode, norm):
+    if isinstance(tag, str):
+        codes = np.array([int(val) for val in tag.split(",")[1:]], dtype=np.int64)
+    else:
+        codes = np.asarray(tag, dtype=np.int64)
+    signals = codes if no_decode else _code2frames[codes]
+    return _normalize_signals(signals, norm)
+
+
 def _cal_mean_n_std(mylist):
     return round(np.mean(mylist), 6), round(np.std(mylist), 6)
 
@@ -187,9 +390,34 @@ def check_excpval(myarray):
     return False
 
 
+def _get_tsite_locs_from_index(motif_index, chrom, pos_min, pos_max, strand, mod_loc, motiflen):
+    """
+    locs of target sites in align_seq (reverse complemented if strand is -), the same as
+    get_refloc_of_methysite_in_motif(align_seq, ...), but from the motif index
+    """
+    if strand == "+":
+        sites = motif_index.get_sites(chrom, "+", pos_min + mod_loc, pos_max + 2 + mod_loc - motiflen)
+        return (sites.astype(np.int64) - pos_min).tolist()
+    sites = motif_index.get_sites(chrom, "-", pos_min + motiflen - 1 - mod_loc, pos_max + 1 - mod_loc)
+    return (pos_max - sites.astype(np.int64))[::-1].tolist()
+
+
+def _get_tsite_locs(chrom, pos_min, pos_max, strand, motifs, mod_loc, contigs, motif_index=None):
+    """
+    0-based locs of the targeted sites in contigs[chrom][pos_min:(pos_max+1)], on the given strand
+    (locs of "-" strand sites are counted from pos_max)
+    """
+    if motif_index is not None:
+        return _get_tsite_locs_from_index(motif_index, chrom, pos_min, pos_max, strand, mod_loc, len(motifs[0]))
+    align_seq = contigs[chrom][pos_min:(pos_max+1)]
+    if strand == "-":
+        align_seq = complement_seq(align_seq)
+    return get_refloc_of_methysite_in_motif(align_seq, set(motifs), mod_loc)
+
+
 def _extract_kmer_features(holeid, chrom, pos_min, pos_max, strand, ipd_mean, ipd_std, pw_mean, pw_std,
                            ipd_depth, depth_all, subreads_info, motifs, mod_loc, seq_len, label, depth,
-                           num_subreads, seed, contigs):
+                           num_subreads, seed, contigs, motif_index=None, tsite_locs=None):
     align_seq = contigs[chrom][pos_min:(pos_max+1)]
     if strand == "-":
         align_seq = complement_seq(align_seq)
@@ -203,7 +431,12 @@ def _extract_kmer_features(holeid, chrom, pos_min, pos_max, strand, ipd_mean, ip
         abs_start = pos_min
     else:
         abs_start = chromlen - (pos_min + len(align_seq))
-    tsite_locs = get_refloc_of_methysite_in_motif(align_seq, set(motifs), mod_loc)
+    if tsite_locs is None:
+        if motif_index is None:
+            tsite_locs = get_refloc_of_methysite_in_motif(align_seq, set(motifs), mod_loc)
+        else:
+            tsite_locs = _get_tsite_locs_from_index(motif_index, chrom, pos_min, pos_max, strand, mod_loc,
+                                                    len(motifs[0]))
     num_bases = (seq_len - 1) // 2
     feature_list = []
     for offset_loc in tsite_locs:
@@ -273,59 +506,118 @@ def _extract_kmer_features(holeid, chrom, pos_min, pos_max, strand, ipd_mean, ip
 #     return max(lst, key=data.get)
 
 
-def _handle_one_strand_of_hole2(holeid, holechrom, ccs_strand, subreads_lines, contigs, motifs, args):
-    refpos2ipd, refpos2pw = {}, {}
-    refposes = set()
+def _get_window_mask(tsite_locs, strand, ref_len, num_bases):
+    """
+    union of the kmer windows of the sites which have a whole kmer, as a mask of offsets of the + strand
+    """
+    tsite_locs = np.asarray(tsite_locs, dtype=np.int64)
+    tsite_locs = tsite_locs[(tsite_locs >= num_bases) & (tsite_locs < ref_len - num_bases)]
+    centers = tsite_locs if strand == "+" else ref_len - 1 - tsite_locs
+    edges = np.zeros(ref_len + 1, dtype=np.int64)
+    np.add.at(edges, centers - num_bases, 1)
+    np.add.at(edges, centers + num_bases + 1, -1)
+    return np.cumsum(edges[:-1]) > 0
+
+
+def _handle_one_strand_of_hole2(holeid, holechrom, ccs_strand, subreads_lines, contigs, motifs, args,
+                                use_motif_index=True):
+    return _handle_one_strand_of_hole_specs(holeid, holechrom, ccs_strand, subreads_lines, contigs,
+                                            [(motifs, args.mod_loc)], args, use_motif_index)[0]
+
+
+def _handle_one_strand_of_hole_specs(holeid, holechrom, ccs_strand, subreads_lines, contigs, mod_specs, args,
+                                     use_motif_index=True):
+    """
+    the subreads of one strand are decoded one at a time, and only their ipd/pw values at the positions in
+    the kmer windows of the sites are kept, so the memory is of depth * the span of the windows, not of the
+    decoded subreads. the values of each position are reduced by np.mean()/np.std() as lists of them were,
+    positions of the same depth in one (positions, depth) array.
+    :param subreads_lines: [(start, strand, cigar blocks, sam fields), ] of the subreads, see
+                           handle_one_hole_specs(), the ip/pw tags are decoded here
+    :param mod_specs: [(motifs, mod_loc), ], the kinetics of the strand are aggregated once, in the union
+                      of the kmer windows of the sites of all specs. --motif_index is of the first spec.
+    :return: [features of each spec, ]
+    """
     subreads_info = []
     depth_all = len(subreads_lines)
-    for subread_info in subreads_lines:
-        chrom, start, strand, ipd, pw, qlocs_to_ref, refpos2querypos = subread_info
-        # assert (strand == ccs_strand)  # duplicate
+    refpos_min, refpos_max = None, None
+    for start, _, blocks, _ in subreads_lines:
+        if len(blocks) == 0:
+            continue
+        rpos_min, rpos_max = start + blocks[0, 0], start + blocks[-1, 0] + blocks[-1, 2] - 1
+        refpos_min = rpos_min if refpos_min is None else min(refpos_min, rpos_min)
+        refpos_max = rpos_max if refpos_max is None else max(refpos_max, rpos_max)
+    if refpos_min is None:
+        return [[] for _ in mod_specs]
+    refpos_min, refpos_max = int(refpos_min), int(refpos_max)
 
+    # TODO: disable subreads_features for now
+    # # to handle missing values (deletion in cigar, -1),
+    # # append 1000 in the ipd/pw for index -1
+    # subread_ipd = [np.insert(ipd, len(ipd), exceptval)[idx] for idx in qlocs_to_ref]
+    # subread_pw = [np.insert(pw, len(pw), exceptval)[idx] for idx in qlocs_to_ref]
+    # subreads_info.append((start, subread_ipd, subread_pw))
+
+    # only the kmer windows of the targeted sites are used, the mean/std of ipd/pw are calculated
+    # only at the positions in the windows, the others are left as exceptval
+    motif_index = load_motif_index(args.motif_index) if args.motif_index is not None and use_motif_index \
+        else None
+    ref_len = refpos_max - refpos_min + 1
+    specs_tsite_locs = []
+    window_mask = np.zeros(ref_len, dtype=bool)
+    for spec_idx, (motifs, mod_loc) in enumerate(mod_specs):
+        tsite_locs = _get_tsite_locs(holechrom, refpos_min, refpos_max, ccs_strand, motifs, mod_loc, contigs,
+                                     motif_index if spec_idx == 0 else None)
+        specs_tsite_locs.append(tsite_locs)
+        window_mask |= _get_window_mask(tsite_locs, ccs_strand, ref_len, (args.seq_len - 1) // 2)
+
+    refoffs_list, ipds_list, pws_list = [], [], []
+    for start, strand, blocks, words in subreads_lines:
+        if len(blocks) == 0:
+            continue
+        # reference offsets (from refpos_min) of the aligned bases, and their query positions
+        blens = blocks[:, 2]
+        inblock = np.arange(blens.sum()) - np.repeat(np.cumsum(blens) - blens, blens)
+        refoffs = np.repeat(blocks[:, 0] + (start - refpos_min), blens) + inblock
+        inwindow = window_mask[refoffs]
+        refoffs = refoffs[inwindow]
+        if len(refoffs) == 0:
+            continue
+        qposes = (np.repeat(blocks[:, 1], blens) + inblock)[inwindow]
+        ipd_tag, pw_tag = _get_kinetics_tags(words)
+        try:
+            ipd = _decode_kinetics_tag(ipd_tag, args.no_decode, args.norm)
+            pw = _decode_kinetics_tag(pw_tag, args.no_decode, args.norm)
+        except ValueError:
+            continue
         if strand == "-":
             ipd = ipd[::-1]
             pw = pw[::-1]
-
-        for rpos in refpos2querypos.keys():
-            qpos = refpos2querypos[rpos]
-            if (start+rpos) not in refposes:
-                refposes.add((start+rpos))
-                refpos2ipd[(start+rpos)] = []
-                refpos2pw[(start+rpos)] = []
-            refpos2ipd[(start+rpos)].append(ipd[qpos])
-            refpos2pw[(start+rpos)].append(pw[qpos])
-
-        # TODO: disable subreads_features for now
-        # # to handle missing values (deletion in cigar, -1),
-        # # append 1000 in the ipd/pw for index -1
-        # subread_ipd = [np.insert(ipd, len(ipd), exceptval)[idx] for idx in qlocs_to_ref]
-        # subread_pw = [np.insert(pw, len(pw), exceptval)[idx] for idx in qlocs_to_ref]
-        # subreads_info.append((start, subread_ipd, subread_pw))
-
-    # calculate mean/std of ipd/pw
-    if len(refposes) == 0:
-        return []
-
-    refposes_list = list(refposes)
-    refpos_max = np.max(refposes_list)
-    refpos_min = np.min(refposes_list)
-    ref_len = refpos_max - refpos_min + 1
-    ipd_mean, ipd_std, pw_mean, pw_std = [exceptval] * ref_len, [exceptval] * ref_len, \
-                                         [exceptval] * ref_len, [exceptval] * ref_len
-    ipd_depth = [0] * ref_len
-    for idx in range(0, ref_len):
-        if (idx + refpos_min) in refposes:
-            ipd_m, ipd_s = _cal_mean_n_std(refpos2ipd[idx + refpos_min])
-            pw_m, pw_s = _cal_mean_n_std(refpos2pw[idx + refpos_min])
-            ipd_mean[idx] = ipd_m
-            ipd_std[idx] = ipd_s
-            pw_mean[idx] = pw_m
-            pw_std[idx] = pw_s
-            ipd_depth[idx] = len(refpos2ipd[idx + refpos_min])
-    del refpos2ipd
-    del refpos2pw
-    del refposes
-    del refposes_list
+        refoffs_list.append(refoffs)
+        ipds_list.append(ipd[qposes])
+        pws_list.append(pw[qposes])
+
+    # object arrays, so that the positions not covered are left as exceptval (int) in the lists
+    ipd_mean, ipd_std, pw_mean, pw_std = [np.full(ref_len, exceptval, dtype=object) for _ in range(4)]
+    ipd_depth = np.zeros(ref_len, dtype=np.int64)
+    if len(refoffs_list) > 0:
+        refoffs = np.concatenate(refoffs_list)
+        # stable, the values of a position stay in the order of the subreads
+        order = np.argsort(refoffs, kind="stable")
+        refoffs = refoffs[order]
+        ipds, pws = np.concatenate(ipds_list)[order], np.concatenate(pws_list)[order]
+        del refoffs_list, ipds_list, pws_list
+        poses, firsts, depths = np.unique(refoffs, return_index=True, return_counts=True)
+        ipd_depth[poses] = depths
+        for depth in np.unique(depths).tolist():
+            in_depth = depths == depth
+            val_idxs = firsts[in_depth][:, None] + np.arange(depth)
+            for vals, means, stds in ((ipds, ipd_mean, ipd_std), (pws, pw_mean, pw_std)):
+                vals_mat = vals[val_idxs]
+                means[poses[in_depth]] = np.round(np.mean(vals_mat, axis=1), 6)
+                stds[poses[in_depth]] = np.round(np.std(vals_mat, axis=1), 6)
+    ipd_mean, ipd_std, pw_mean, pw_std = ipd_mean.tolist(), ipd_std.tolist(), pw_mean.tolist(), pw_std.tolist()
+    ipd_depth = ipd_depth.tolist()
 
     # TODO: disable subreads_features for now
     # # paddle subreads ipd/pw list to align ref
@@ -337,47 +629,76 @@ def _handle_one_strand_of_hole2(holeid, holechrom, ccs_strand, subreads_lines, c
     #     subread_pw = [exceptval] * pad_left + subread_pw + [exceptval] * pad_right
     #     subreads_info[idx] = (subread_ipd, subread_pw)
 
-    feature_list = _extract_kmer_features(holeid, holechrom, refpos_min, refpos_max, ccs_strand,
-                                          ipd_mean, ipd_std, pw_mean, pw_std, ipd_depth, depth_all,
-                                          subreads_info, motifs, args.mod_loc, args.seq_len,
-                                          args.methy_label, args.depth, args.num_subreads, args.seed,
-                                          contigs)
-
-    return feature_list
+    specs_features = []
+    for (motifs, mod_loc), tsite_locs in zip(mod_specs, specs_tsite_locs):
+        specs_features.append(_extract_kmer_features(holeid, holechrom, refpos_min, refpos_max, ccs_strand,
+                                                     ipd_mean, ipd_std, pw_mean, pw_std, ipd_depth, depth_all,
+                                                     subreads_info, motifs, mod_loc, args.seq_len,
+                                                     args.methy_label, args.depth, args.num_subreads, args.seed,
+                                                     contigs, None, tsite_locs))
+    return specs_features
 
 
 def _comb_fb_features(fwd_feas, bwd_feas):
+    """
+    pair the features of a site on the forward strand (pos) with those of the backward strand (pos + 1),
+    the pairs are joined on arrays of positions, only the matched features are combined, in the order of
+    positions
+    """
     if len(fwd_feas) <= 0 or len(bwd_feas) <= 0:
         return []
-    fwd_feas = sorted(fwd_feas, key=lambda x: x[1])
-    bwd_feas = sorted(bwd_feas[::-1], key=lambda x: x[1])
+    fpos = np.fromiter((ffea[1] for ffea in fwd_feas), dtype=np.int64, count=len(fwd_feas))
+    bpos = np.fromiter((bfea[1] for bfea in bwd_feas), dtype=np.int64, count=len(bwd_feas)) - 1
+    _, idxs_f, idxs_b = np.intersect1d(fpos, bpos, assume_unique=True, return_indices=True)
     comb_feas = []
-    idx_f, idx_b = 0, 0
-    while idx_f < len(fwd_feas) and idx_b < len(bwd_feas):
+    for idx_f, idx_b in zip(idxs_f.tolist(), idxs_b.tolist()):
         ffea = fwd_feas[idx_f]
         bfea = bwd_feas[idx_b]
-        fpos = ffea[1]
-        bpos = bfea[1]
-        if fpos == bpos - 1:
-            # ffea[4] = max(ffea[4], bfea[4])
-            # comb_feas.append(ffea[:13] + bfea[5:])
-            comb_feas.append(ffea[:4] + (max(ffea[4], bfea[4]), ) + ffea[5:13] + bfea[5:])
-            idx_f += 1
-            idx_b += 1
-        elif fpos < bpos - 1:
-            idx_f += 1
-        else:
-            idx_b += 1
+        comb_feas.append(ffea[:4] + (max(ffea[4], bfea[4]), ) + ffea[5:13] + bfea[5:])
     return comb_feas
 
 
+def _get_ccsinfo(words):
+    # ("ccs", (chrom, ccs seq, reference loc of each ccs base)) of subreads aligned to their ccs read
+    if len(words) > 11 and isinstance(words[-1], tuple) and words[-1][0] == "ccs":
+        return words[-1][1]
+    return None
+
+
+def _lift_ccs_features(feature_list, ccsinfo):
+    """
+    lift features in ccs coordinates to the reference, sites in insertions of the ccs read are dropped
+    """
+    chrom, _, ccs2ref = ccsinfo
+    lifted = []
+    for feature in feature_list:
+        refloc = ccs2ref[feature[1]]
+        if refloc >= 0:
+            lifted.append((chrom, int(refloc)) + feature[2:])
+    return lifted
+
+
 def handle_one_hole2(hole_aligninfo, contigs, motifs, args):
+    return handle_one_hole_specs(hole_aligninfo, contigs, [(motifs, args.mod_loc)], args)[0]
+
+
+def handle_one_hole_specs(hole_aligninfo, contigs, mod_specs, args):
+    """
+    :param mod_specs: [(motifs, mod_loc), ], see _handle_one_strand_of_hole_specs()
+    :return: [features of each spec, ]
+    """
     two_strands = args.two_strands
     comb_strands = args.comb_strands
     two_strands = True if comb_strands else two_strands
 
     holeid, hole_aligns = hole_aligninfo
 
+    # subreads aligned to the ccs read of the hole (--align_to_ccs): kinetics are aggregated and
+    # sites are found in ccs coordinates, then the sites are lifted to the reference
+    ccsinfo = _get_ccsinfo(hole_aligns[0]) if len(hole_aligns) > 0 else None
+    if ccsinfo is not None:
+        contigs = {ccs_contig: ccsinfo[1]}
+
     chrom2lines = {}
     chrom2starts = {}
     for sridx in range(len(hole_aligns)):
@@ -390,7 +711,7 @@ def handle_one_hole2(hole_aligninfo, contigs, motifs, args):
         chrom2lines[chrom].append(sridx)
         chrom2starts[chrom].append(start)
 
-    feature_list = []
+    specs_features = [[] for _ in mod_specs]
     for holechrom in chrom2lines.keys():
         chromlineidxs = chrom2lines[holechrom]
         start_median = np.median(chrom2starts[holechrom])
@@ -399,12 +720,11 @@ def handle_one_hole2(hole_aligninfo, contigs, motifs, args):
         for clidx in chromlineidxs:
             words = hole_aligns[clidx]
             flag, start = int(words[1]), int(words[3]) - 1
-            chrom = words[2]
             if abs(start - start_median) > 100e3:  # filter reads aligned too far away from main alignments
                 # print(holeid, holechrom, flag, start, start_median, "start - start_median too far")
                 continue
             cigar = words[5]
-            identity, qlocs_to_ref, refpos2querypos = _parse_cigar(cigar)
+            identity, blocks = _parse_cigar_blocks(cigar)
             if identity < args.identity:  # skip reads with low identity
                 # print(holeid, holechrom, identity, "identity too low")
                 continue
@@ -412,49 +732,42 @@ def handle_one_hole2(hole_aligninfo, contigs, motifs, args):
             # _, flag, chrom, start = words[0], int(words[1]), words[2], int(words[3]) - 1
             # assert (chrom == holechrom)  # duplicate
             strand = "+" if flag == 0 else "-"
-            ipd, pw = [], []
-            try:
-                for i in range(11, len(words)):
-                    if words[i].startswith("ip:B:C,"):
-                        ipd = [int(ipdval) for ipdval in words[i].split(",")[1:]]
-                    elif words[i].startswith("pw:B:C,"):
-                        pw = [int(pwval) for pwval in words[i].split(",")[1:]]
-                if len(ipd) == 0 or len(pw) == 0:
-                    # print(holeid, "no ipd")
-                    continue
-                if len(ipd) != len(pw):
-                    # print(holeid, "len ipd!=pw")
-                    continue
-            except ValueError:
+            # only the presence of ipd/pw is checked here, they are decoded in
+            # _handle_one_strand_of_hole_specs() one subread at a time
+            ipd, _ = _get_kinetics_tags(words)
+            if ipd is None:
+                # print(holeid, "no ipd, or len ipd!=pw")
                 continue
-            if not args.no_decode:
-                ipd = [code2frames[ipdval] for ipdval in ipd]
-                pw = [code2frames[pwval] for pwval in pw]
-            ipd = _normalize_signals(ipd, args.norm)
-            pw = _normalize_signals(pw, args.norm)
 
             # assert (flag == 0 or flag == 16)  # duplicate
             if flag == 0:
-                subreads_fwd.append((chrom, start, strand, ipd, pw, qlocs_to_ref, refpos2querypos))
+                subreads_fwd.append((start, strand, blocks, words))
             else:
-                subreads_bwd.append((chrom, start, strand, ipd, pw, qlocs_to_ref, refpos2querypos))
+                subreads_bwd.append((start, strand, blocks, words))
 
         # skip read which only have subreads in one strand
         if two_strands and (len(subreads_fwd) < 1 or len(subreads_bwd) < 1):
             continue
 
-        fwd_features, bwd_features = [], []
+        specs_fwd_features, specs_bwd_features = [[] for _ in mod_specs], [[] for _ in mod_specs]
         if len(subreads_fwd) >= args.depth:
-            fwd_features = _handle_one_strand_of_hole2(holeid, holechrom, "+", subreads_fwd, contigs, motifs, args)
+            specs_fwd_features = _handle_one_strand_of_hole_specs(holeid, holechrom, "+", subreads_fwd, contigs,
+                                                                  mod_specs, args, ccsinfo is None)
         if len(subreads_bwd) >= args.depth:
-            bwd_features = _handle_one_strand_of_hole2(holeid, holechrom, "-", subreads_bwd, contigs, motifs, args)
-        if comb_strands:
-            feature_list += _comb_fb_features(fwd_features, bwd_features)
-            del fwd_features
-            del bwd_features
-        else:
-            feature_list += fwd_features + bwd_features
-    return feature_list
+            specs_bwd_features = _handle_one_strand_of_hole_specs(holeid, holechrom, "-", subreads_bwd, contigs,
+                                                                  mod_specs, args, ccsinfo is None)
+        for spec_idx in range(len(mod_specs)):
+            fwd_features, bwd_features = specs_fwd_features[spec_idx], specs_bwd_features[spec_idx]
+            if ccsinfo is not None:
+                fwd_features = _lift_ccs_features(fwd_features, ccsinfo)
+                bwd_features = _lift_ccs_features(bwd_features, ccsinfo)
+            if comb_strands:
+                specs_features[spec_idx] += _comb_fb_features(fwd_features, bwd_features)
+            else:
+                specs_features[spec_idx] += fwd_features + bwd_features
+        del specs_fwd_features
+        del specs_bwd_features
+    return specs_features
 
 
 def _features_to_str(features):
@@ -527,55 +840,116 @@ def _features_to_str_combedfeatures(features):
                       str(label)])
 
 
-def _worker_extract(hole_align_q, featurestr_q, contigs, motifs, args):
+def _worker_extract(hole_align_q, featurestr_qs, contigs, mod_specs, args, metrics_q=None, mem_budget=None):
+    """
+    :param featurestr_qs: a queue for the features of each of mod_specs
+    :param mem_budget: utils/mem_budget.MemoryBudget, to count the batches put/got, and to pause when it is
+                       used up
+    """
     sys.stderr.write("extrac_features process-{} starts\n".format(os.getpid()))
+    metrics = StageMetrics("extract", metrics_q, args.metrics_interval)
     cnt_holesbatch = 0
     while True:
         # print("hole_align_q size:", hole_align_q.qsize(), "; pid:", os.getpid())
         if hole_align_q.empty():
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
             continue
-        holes_aligninfo = hole_align_q.get()
-        if holes_aligninfo == "kill":
+        holes_batch = hole_align_q.get()
+        if holes_batch == "kill":
             hole_align_q.put("kill")
             break
-        feature_list = []
+        seq, holes_aligninfo = holes_batch
+        batch_start = time.time()
+        specs_features = [[] for _ in mod_specs]
         for hole_aligninfo in holes_aligninfo:
-            feature_list += handle_one_hole2(hole_aligninfo, contigs, motifs, args)
-        feature_strs = []
-        if args.comb_strands:
-            for feature in feature_list:
-                feature_strs.append(_features_to_str_combedfeatures(feature))
-        else:
-            for feature in feature_list:
-                feature_strs.append(_features_to_str(feature))
-        featurestr_q.put(feature_strs)
-        while featurestr_q.qsize() > queen_size_border:
+            for spec_idx, features in enumerate(handle_one_hole_specs(hole_aligninfo, contigs, mod_specs, args)):
+                specs_features[spec_idx] += features
+        features_to_str = _features_to_str_combedfeatures if args.comb_strands else _features_to_str
+        cnt_sites = 0
+        for featurestr_q, feature_list in zip(featurestr_qs, specs_features):
+            featurestr_batch = (seq, [features_to_str(feature) for feature in feature_list])
+            if mem_budget is not None:
+                mem_budget.add(estimate_nbytes(featurestr_batch))
+            featurestr_q.put(featurestr_batch)
+            cnt_sites += len(feature_list)
+        metrics.add(holes=len(holes_aligninfo), sites=cnt_sites)
+        metrics.observe_batch(time.time() - batch_start)
+        if mem_budget is not None:
+            mem_budget.release(estimate_nbytes(holes_batch))
+            metrics.add_idle(mem_budget.pause(featurestr_qs))
+        while max(featurestr_q.qsize() for featurestr_q in featurestr_qs) > queen_size_border:
             time.sleep(time_wait)
+            metrics.add_idle(time_wait)
+        metrics.report()
         cnt_holesbatch += 1
         if cnt_holesbatch % 200 == 0:
             sys.stderr.write("extrac_features process-{}, {} hole_batches({}) "
                              "proceed\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
             sys.stderr.flush()
+    metrics.report(force=True)
     sys.stderr.write("extrac_features process-{} ending, proceed {} "
                      "hole_batches({})\n".format(os.getpid(), cnt_holesbatch, args.holes_batch))
 
 
-def _write_featurestr_to_file(write_fp, featurestr_q):
+def _write_featurestr_to_file(write_fp, featurestr_q, metrics_q=None, metrics_interval=10, order_window=None,
+                              writer_idx=0, mem_budget=None):
+    """
+    :param order_window: utils/reorder.OrderWindow, to write the batches in the order of holes in the input,
+                         None to write them as they come
+    :param mem_budget: utils/mem_budget.MemoryBudget, the batches got are released from it
+    """
     sys.stderr.write('write_process-{} started\n'.format(os.getpid()))
+    metrics = StageMetrics("write", metrics_q, metrics_interval)
+    reorder_buffer = ReorderBuffer(order_window.written(writer_idx)) if order_window is not None else None
     with open(write_fp, 'w') as wf:
         while True:
             # during test, it's ok without the sleep(time_wait)
             if featurestr_q.empty():
                 time.sleep(time_wait)
+                metrics.add_idle(time_wait)
                 continue
-            features_str = featurestr_q.get()
-            if features_str == "kill":
+            features_batch = featurestr_q.get()
+            if features_batch == "kill":
                 sys.stderr.write('write_process-{} finished\n'.format(os.getpid()))
                 break
-            for one_features_str in features_str:
-                wf.write(one_features_str + "\n")
+            batch_start = time.time()
+            if mem_budget is not None:
+                mem_budget.release(estimate_nbytes(features_batch))
+            seq, features_str = features_batch
+            for features_str in (reorder_buffer.push(seq, features_str) if reorder_buffer is not None
+                                 else [features_str]):
+                for one_features_str in features_str:
+                    wf.write(one_features_str + "\n")
+                metrics.add(sites=len(features_str))
             wf.flush()
+            metrics.observe_batch(time.time() - batch_start)
+            metrics.report()
+        if reorder_buffer is not None and len(reorder_buffer) > 0:
+            sys.stderr.write('write_process-{}: {} batches written out of order\n'.format(os.getpid(),
+                                                                                         len(reorder_buffer)))
+            for features_str in reorder_buffer.flush():
+                for one_features_str in features_str:
+                    wf.write(one_features_str + "\n")
+    metrics.report(force=True)
+
+
+def get_mod_specs(args, extra_motifs=None):
+    """
+    :param extra_motifs: [[motifs, mod_loc, ..], ] of --extra_motifs
+    :return: [(motifs, mod_loc), ] of --motifs/--mod_loc and each of extra_motifs
+    """
+    mod_specs = [(get_motif_seqs(args.motifs), args.mod_loc)]
+    for extra_motif in extra_motifs if extra_motifs is not None else []:
+        try:
+            mod_loc = int(extra_motif[1])
+        except ValueError:
+            raise ValueError("MOD_LOC of --extra_motifs must be an integer, got {}".format(extra_motif[1]))
+        motifs = get_motif_seqs(extra_motif[0])
+        if not 0 <= mod_loc < len(motifs[0]):
+            raise ValueError("MOD_LOC {} of --extra_motifs is out of motif {}".format(mod_loc, extra_motif[0]))
+        mod_specs.append((motifs, mod_loc))
+    return mod_specs
 
 
 def _get_holes(holeidfile):
@@ -604,17 +978,44 @@ def extract_subreads_features(args):
 
     if args.seq_len % 2 == 0:
         raise ValueError("seq_len must be odd")
+    check_align_args(args)
 
     holeids_e = None if args.holeids_e is None else _get_holes(args.holeids_e)
     holeids_ne = None if args.holeids_ne is None else _get_holes(args.holeids_ne)
-
-    contigs = DNAReference(reference).getcontigs()
-    motifs = get_motif_seqs(args.motifs)
+    holeids_e = holeids_of_args(args, holeids_e)
+
+    contigs = load_reference_contigs(reference, args.ref_cache)
+    mod_specs = get_mod_specs(args, args.extra_motifs)
+    motifs = mod_specs[0][0]
+    if args.motif_index is not None:
+        args.motif_index = os.path.abspath(args.motif_index)
+        load_motif_index(args.motif_index).check_compatible(motifs, args.mod_loc, contigs)
+    # features of --extra_motifs are written to their own outputs
+    outputpaths = [outputpath] + [os.path.abspath(extra_motif[2]) for extra_motif in
+                                  (args.extra_motifs if args.extra_motifs is not None else [])]
+    if len(set(outputpaths)) < len(outputpaths):
+        raise ValueError("the outputs of --output/--extra_motifs must be different files!")
+
+    args.profile, profile_start = prepare_profile_dir(args.profile)
 
     hole_align_q = Queue()
-    featurestr_q = Queue()
-
-    p_read = mp.Process(target=worker_read, args=(inputpath, hole_align_q, args, holeids_e, holeids_ne))
+    featurestr_qs = [Queue() for _ in mod_specs]
+
+    metrics_q, metrics_monitor = None, None
+    if args.metrics_file is not None:
+        metrics_q = Queue()
+        queues = {"hole_align_q": hole_align_q, "featurestr_q": featurestr_qs[0]}
+        for spec_idx in range(1, len(featurestr_qs)):
+            queues["featurestr_q{}".format(spec_idx)] = featurestr_qs[spec_idx]
+        metrics_monitor = MetricsMonitor(metrics_q, args.metrics_file, queues, args.metrics_interval)
+        metrics_monitor.start()
+
+    order_window = get_order_window(mp, args.reorder_window, len(featurestr_qs))
+    mem_budget = get_memory_budget(mp, args.max_memory)
+    target, target_args = wrap_target(worker_read, (inputpath, hole_align_q, args, holeids_e, holeids_ne,
+                                                    metrics_q, None, order_window, mem_budget),
+                                      args.profile, "reader")
+    p_read = mp.Process(target=target, args=target_args)
     p_read.daemon = True
     p_read.start()
 
@@ -625,16 +1026,30 @@ def extract_subreads_features(args):
     if nproc > 2:
         nproc -= 2
     for _ in range(nproc):
-        p = mp.Process(target=_worker_extract, args=(hole_align_q, featurestr_q, contigs, motifs, args))
+        target, target_args = wrap_target(_worker_extract, (hole_align_q, featurestr_qs, contigs, mod_specs,
+                                                            args, metrics_q, mem_budget),
+                                          args.profile, "extract")
+        p = mp.Process(target=target, args=target_args)
         p.daemon = True
         p.start()
         ps_extract.append(p)
 
     # print("write_process started..")
-    p_w = mp.Process(target=_write_featurestr_to_file, args=(outputpath, featurestr_q))
-    p_w.daemon = True
-    p_w.start()
+    ps_write = []
+    for writer_idx, (outputpath, featurestr_q) in enumerate(zip(outputpaths, featurestr_qs)):
+        target, target_args = wrap_target(_write_featurestr_to_file, (outputpath, featurestr_q, metrics_q,
+                                                                      args.metrics_interval, order_window,
+                                                                      writer_idx, mem_budget),
+                                          args.profile, "write")
+        p_w = mp.Process(target=target, args=target_args)
+        p_w.daemon = True
+        p_w.start()
+        ps_write.append(p_w)
 
+    p_read.join()
+    if p_read.exitcode != 0:
+        # the reader may have been killed before it put "kill", e.g. by a crash in loading the aligner
+        hole_align_q.put("kill")
     while True:
         # print("killing _worker_extract process")
         running = any(p.is_alive() for p in ps_extract)
@@ -643,12 +1058,22 @@ def extract_subreads_features(args):
 
     for p in ps_extract:
         p.join()
-    p_read.join()
 
     # sys.stderr.write("finishing the write_process..\n")
-    featurestr_q.put("kill")
-    p_w.join()
-
+    for featurestr_q in featurestr_qs:
+        featurestr_q.put("kill")
+    for p_w in ps_write:
+        p_w.join()
+
+    if metrics_monitor is not None:
+        metrics_monitor.stop()
+    if args.profile is not None:
+        merge_profiles(args.profile, profile_start, "extract")
+    if p_read.exitcode != 0:
+        raise RuntimeError("read_input process failed with exitcode {}, the features in {} are "
+                           "incomplete".format(p_read.exitcode, ", ".join(outputpaths)))
+
+    report_peak_memory("extract_features", mem_budget)
     endtime = time.time()
     sys.stderr.write("[extract_features]costs {:.1f} seconds\n".format(endtime - start))
 
@@ -664,15 +1089,57 @@ def main():
                               "in aligned.bam, which generated by align_subreads.py from subreads.bam.")
     p_input.add_argument("--ref", type=str, required=True,
                          help="path to genome reference to be aligned, in fasta/fa format.")
+    p_input.add_argument("--ref_cache", action="store_true", default=False, required=False,
+                         help="serve the reference from a pre-uppercased 1-byte-per-base cache file "
+                              "(ref.ccsmeth.seq, built at the first use) instead of the fasta. By default "
+                              "the reference is memory-mapped through its .fai index (built if missing), "
+                              "and shared by all processes.")
+    p_input.add_argument("--align", action="store_true", default=False, required=False,
+                         help="the input is unaligned subreads.bam/sam, align them to --ref on the fly "
+                              "with mappy (`pip install mappy`) and extract from the alignments directly, "
+                              "without writing/reading an intermediate aligned bam")
+    p_input.add_argument("--align_index", type=str, default=None, required=False,
+                         help="minimap2 index (.mmi, -x map-pb) of --ref for --align, to skip building "
+                              "the index from --ref")
+    p_input.add_argument("--align_threads", type=int, default=4, required=False,
+                         help="number of threads to align with, for --align only, default 4")
+    p_input.add_argument("--guide_bam", type=str, default=None, required=False,
+                         help="aligned CCS bam/sam of the subreads, for --align only. subreads of a hole are "
+                              "aligned only to a padded window of --ref around the alignment of its CCS read, "
+                              "instead of to the whole genome. default None")
+    p_input.add_argument("--guide_pad", type=int, default=1000, required=False,
+                         help="bases padded to each side of the CCS alignment, for --guide_bam, default 1000")
+    p_input.add_argument("--align_to_ccs", action="store_true", default=False, required=False,
+                         help="with --align and --guide_bam, align subreads to the CCS read of their hole instead "
+                              "of the reference, aggregate kinetics in CCS coordinates, and lift the sites to "
+                              "the reference through the CCS alignment. --guide_bam must be grouped by holes in "
+                              "the same order as the subreads (e.g. aligned without sorting)")
+    p_input.add_argument("--tee_aligned", type=str, default=None, required=False,
+                         help="also save the alignments of --align to this bam/sam file, default None")
     p_input.add_argument("--holeids_e", type=str, default=None, required=False,
                          help="file contains holeids to be extracted, default None")
     p_input.add_argument("--holeids_ne", type=str, default=None, required=False,
                          help="file contains holeids not to be extracted, default None")
+    p_input.add_argument("--ccs_bam", type=str, default=None, required=False,
+                         help="CCS bam/sam of the subreads, only holes with a usable CCS read (--min_rq, "
+                              "--min_np, --ccs_mapped) are used, the others are dropped before parsing. "
+                              "default None")
+    p_input.add_argument("--min_rq", type=float, default=0.99, required=False,
+                         help="min read quality (rq) of CCS reads, for --ccs_bam, default 0.99")
+    p_input.add_argument("--min_np", type=int, default=1, required=False,
+                         help="min number of passes (np) of CCS reads, for --ccs_bam, default 1")
+    p_input.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                         help="only holes whose CCS read is mapped, for --ccs_bam (aligned) only")
 
     p_output = parser.add_argument_group("OUTPUT")
     p_output.add_argument("--output", "-o", type=str, required=False,
                           help="output file path to save the extracted features. "
                                "If not specified, use input_prefix.tsv as default.")
+    p_output.add_argument("--reorder_window", type=int, default=64, required=False,
+                          help="max number of batches of holes done ahead of the earliest unwritten one, which "
+                               "wait in the writer to be written in the hole order of the input; the reader pauses "
+                               "when it is reached. 0 to write the batches as they are done (not in input order). "
+                               "default 64")
 
     p_extract = parser.add_argument_group("EXTRACT")
     p_extract.add_argument("--seq_len", type=int, default=21, required=False,
@@ -687,6 +1154,14 @@ def main():
                                 'the same')
     p_extract.add_argument("--mod_loc", action="store", type=int, required=False, default=0,
                            help='0-based location of the targeted base in the motif, default 0')
+    p_extract.add_argument("--extra_motifs", action="append", nargs=3, type=str, required=False,
+                           metavar=("MOTIFS", "MOD_LOC", "OUTPUT"), default=None,
+                           help="an extra motif spec to extract in the same pass, features of its sites are "
+                                "saved in OUTPUT. can be repeated, e.g. --extra_motifs CHG,CHH 0 chh.features.tsv, "
+                                "default None")
+    p_extract.add_argument("--motif_index", type=str, default=None, required=False,
+                           help="motif index built by `ccsmeth index_motifs` with the same --ref/--motifs/--mod_loc, "
+                                "to get target sites from the index instead of scanning the reference, default None")
     p_extract.add_argument("--methy_label", action="store", type=int,
                            choices=[1, 0], required=False, default=1,
                            help="the label of the interested modified bases, this is for training."
@@ -718,9 +1193,31 @@ def main():
                                 "the PATH.")
     p_extract.add_argument("--holes_batch", type=int, default=50, required=False,
                            help="number of holes in an batch to get/put in queues")
+    p_extract.add_argument("--holes_batch_bases", type=int, default=10000000, required=False,
+                           help="max number of subread bases in a batch of holes, a batch is put once it has "
+                                "--holes_batch holes or this many bases, so that batches of deep/long holes cost "
+                                "about the same; a hole of more bases is put in a batch of its own. 0 to batch by "
+                                "--holes_batch only. default 10000000")
+    p_extract.add_argument("--max_memory", type=str, default=None, required=False,
+                           help="max memory of the batches waiting in the queues between the reader, workers and "
+                                "writers, in bytes or with a unit (e.g. 4G, 512M). when it is reached, the reader "
+                                "pauses, and the workers pause while the next stage has batches to drain. the sizes "
+                                "of batches are estimated and the reference/models are not counted, so it is not a "
+                                "hard limit of the RSS. default None, batches are limited by count only")
     p_extract.add_argument("--seed", type=int, default=1234, required=False,
                            help="seed for randomly selecting subreads, default 1234")
 
+    p_metrics = parser.add_argument_group("METRICS")
+    p_metrics.add_argument("--metrics_file", type=str, default=None, required=False,
+                           help="file to export per-stage throughput/latency/queue-depth metrics "
+                                "periodically, in json-lines format, or in prometheus text format "
+                                "if the file ends with .prom. default None, no metrics exported")
+    p_metrics.add_argument("--metrics_interval", type=float, default=10, required=False,
+                           help="interval (seconds) of exporting metrics, default 10")
+    p_metrics.add_argument("--profile", type=str, default=None, required=False,
+                           help="directory to save cProfile stats of each worker process, the stats "
+                                "are merged into DIR/report.txt at the end. default None, no profiling")
+
     args = parser.parse_args()
 
     display_args(args, True)
@@ -0,0 +1,85 @@
+"""
+align -> extract -> call_mods -> frequency of subreads in one streaming run. subreads are aligned on
+the fly in the reader process (mappy), features are passed to the calling workers through queues,
+and the frequency of sites is aggregated by the writer, so only the per-read calls and the frequency
+are written to disk (plus the alignments, if --tee_aligned).
+"""
+import os
+import sys
+import time
+import argparse
+
+from .utils.process_utils import display_args
+from .utils.process_utils import nproc_to_call_mods_in_cpu_mode
+from .call_modifications import add_call_mods_args
+
+
+def split_threads(threads, threads_call):
+    """
+    split the thread budget of the pipeline into aligner threads (in the reader process) and
+    call_mods processes (reader, extract workers, call workers, writer).
+    :return: align_threads, threads of call_mods
+    """
+    nproc_dp = min(threads_call, nproc_to_call_mods_in_cpu_mode) if threads_call > 0 else 1
+    # the reader/writer/call workers are not counted, the rest is shared by aligning and extracting
+    nproc_free = max(2, threads - nproc_dp - 2)
+    align_threads = max(1, nproc_free // 2)
+    threads_call_mods = max(nproc_dp + 3, threads - align_threads + 1)
+    return align_threads, threads_call_mods
+
+
+def pipeline(args):
+    from .call_modifications import call_mods
+
+    sys.stderr.write("[pipeline]start..\n")
+    start = time.time()
+    if args.ref is None:
+        raise ValueError("--ref is needed to align the subreads")
+    if not (args.input.endswith(".bam") or args.input.endswith(".sam")):
+        raise ValueError("--input/-i must be subreads in bam/sam format!")
+    args.align = True
+    output_dir = os.path.dirname(os.path.abspath(args.output))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    if args.freq_output is None:
+        args.freq_output = os.path.splitext(args.output)[0] + (".freq.bed" if args.freq_bed else ".freq.tsv")
+    if args.align_threads is None:
+        args.align_threads, args.threads = split_threads(args.threads, args.threads_call)
+    sys.stderr.write("threads: {} to align, {} processes to extract/call\n".format(args.align_threads,
+                                                                                  args.threads))
+
+    call_mods(args)
+
+    sys.stderr.write("per-read calls saved in {}, frequency of sites in {}\n".format(
+        os.path.abspath(args.output), os.path.abspath(args.freq_output)))
+    sys.stderr.write("[pipeline]costs {:.1f} seconds\n".format(time.time() - start))
+
+
+def add_pipeline_args(parser):
+    add_call_mods_args(parser)
+    parser.set_defaults(align=True, align_threads=None)
+    for action in parser._actions:
+        if action.dest == "input":
+            action.help = "subreads.bam/sam (unaligned) as input, grouped by holes as from the sequencer"
+        elif action.dest == "align":
+            action.help = "always on in pipeline"
+        elif action.dest == "align_threads":
+            action.help = "number of threads to align with, default: half of the threads left by " \
+                          "the reader/writer/call workers"
+        elif action.dest == "freq_output":
+            action.help = "file to save the modification frequency of sites, default " \
+                          "output_prefix.freq.tsv (or .freq.bed with --freq_bed)"
+
+
+def main():
+    parser = argparse.ArgumentParser("align, extract, call modifications and calculate frequency "
+                                     "of subreads in one run")
+    add_pipeline_args(parser)
+
+    args = parser.parse_args()
+    display_args(args)
+    pipeline(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,328 @@
+"""
+simulate a random reference and PacBio-like reads with kinetics, for testing/benchmarking
+extract/call_mods/ccs_features at any scale, offline and reproducibly.
+outputs (in --output_dir, with --prefix):
+    prefix.ref.fa                  random reference, with CpGs planted at --cpg_density
+    prefix.subreads.sam/bam        unaligned subreads with ip:B:C/pw:B:C tags, input of `ccsmeth align`
+    prefix.subreads.aligned.sam/bam  hole-sorted aligned subreads, input of `ccsmeth extract/call_mods`
+    prefix.ccs.sam/bam             aligned CCS reads with fi/ri/fp/rp/fn/rn tags, input of ccs_features.py
+    prefix.truth.tsv               methylation state of the simulated CpGs (chrom, pos, strand, label)
+kinetics codes are drawn from gamma distributions, IPDs of methylated CpGs are increased by
+--methy_ipd_ratio.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from .utils.process_utils import display_args
+from .utils.process_utils import SamWriter
+
+bases = np.array(list("ACGT"))
+base2idx = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+comp_idx = np.array([3, 2, 1, 0], dtype=np.uint8)  # A<->T, C<->G
+adapter_len = 45
+movie_name = "m00000_000000_000000"
+
+
+def _idx2seq(idxs):
+    return "".join(bases[idxs])
+
+
+def _revcomp_idx(idxs):
+    return comp_idx[idxs][::-1]
+
+
+def _simulate_contig(rng, contig_len, cpg_density):
+    seq = rng.integers(0, 4, size=contig_len).astype(np.uint8)
+    # remove random CGs first, then plant CpGs at the given density
+    seq[:-1][(seq[:-1] == 1) & (seq[1:] == 2)] = 0
+    n_cpg = int(contig_len * cpg_density)
+    if n_cpg > 0:
+        cg_locs = rng.choice(np.arange(0, contig_len - 1, 2), size=min(n_cpg, contig_len // 2), replace=False)
+        seq[cg_locs] = 1
+        seq[cg_locs + 1] = 2
+    return seq
+
+
+def _simulate_reference(rng, args):
+    contigs = []
+    for cidx in range(args.contigs):
+        contigs.append(("chr{}".format(cidx + 1), _simulate_contig(rng, args.contig_len, args.cpg_density)))
+    return contigs
+
+
+def _write_reference(contigs, ref_path, line_width=60):
+    with open(ref_path, "w") as wf:
+        for name, seq in contigs:
+            wf.write(">{}\n".format(name))
+            seqstr = _idx2seq(seq)
+            for i in range(0, len(seqstr), line_width):
+                wf.write(seqstr[i:(i + line_width)] + "\n")
+
+
+def _cpg_methy_states(rng, contigs, methy_ratio):
+    """
+    :return: dict of contig -> (cpg_locs, is_methylated), cpg_locs are 0-based locs of the C in + strand
+    """
+    states = {}
+    for name, seq in contigs:
+        cpg_locs = np.where((seq[:-1] == 1) & (seq[1:] == 2))[0]
+        states[name] = (cpg_locs, rng.random(len(cpg_locs)) < methy_ratio)
+    return states
+
+
+def _strand_ipd_means(rng, ref_len, methy_cpg_locs, strand, args):
+    """
+    mean ipd code of each base of one strand, indexed by + strand coordinate.
+    the modified base is the C of a CpG in + strand, and the C (G in + strand) in - strand.
+    """
+    ipd_means = rng.gamma(args.ipd_shape, args.ipd_scale, size=ref_len)
+    if len(methy_cpg_locs) > 0:
+        mod_locs = methy_cpg_locs if strand == "+" else methy_cpg_locs + 1
+        ipd_means[mod_locs] *= args.methy_ipd_ratio
+    return ipd_means
+
+
+def _codes(values):
+    return np.clip(np.round(values), 0, 255).astype(np.int64)
+
+
+def _simulate_subread_alignment(rng, ref_seq, ipd_means, identity, args):
+    """
+    simulate one pass of a subread over ref_seq, in + strand coordinate.
+    :return: query seq (idx), cigar, ipd codes, pw codes of the query bases (+ strand order)
+    """
+    ref_len = len(ref_seq)
+    err = 1.0 - identity
+    # 0: match, 1: mismatch, 2: match followed by an insertion, 3: deletion
+    ops = rng.choice(4, size=ref_len, p=[identity, err * 0.2, err * 0.5, err * 0.3])
+    ops[0] = ops[-1] = 0  # alignments start/end with matches
+
+    emit = np.array([1, 1, 2, 0])[ops]
+    query_refpos = np.repeat(np.arange(ref_len), emit)
+    query = ref_seq[query_refpos].copy()
+    is_ins = np.zeros(len(query), dtype=bool)
+    # the 2nd base emitted by an insertion op is the inserted base
+    ins_ends = np.cumsum(emit)[ops == 2] - 1
+    is_ins[ins_ends] = True
+    query[is_ins] = rng.integers(0, 4, size=int(is_ins.sum()))
+    mis_qlocs = (np.cumsum(emit) - 1)[ops == 1]
+    query[mis_qlocs] = (query[mis_qlocs] + rng.integers(1, 4, size=len(mis_qlocs))) % 4
+
+    ipd_mean_q = ipd_means[query_refpos]
+    ipd_mean_q[is_ins] = args.ipd_shape * args.ipd_scale
+    ipds = _codes(rng.gamma(args.ipd_shape, ipd_mean_q / args.ipd_shape))
+    pws = _codes(rng.gamma(args.pw_shape, args.pw_scale, size=len(query)))
+
+    # cigar ops of each ref position, insertions expanded after their matches
+    op_chars = np.array(list("=XID"))
+    cigar_chars = op_chars[np.where(ops == 2, 0, ops)]
+    cigar_chars = np.insert(cigar_chars, np.where(ops == 2)[0] + 1, "I")
+    run_starts = np.concatenate(([0], np.where(cigar_chars[1:] != cigar_chars[:-1])[0] + 1))
+    run_lens = np.diff(np.concatenate((run_starts, [len(cigar_chars)])))
+    cigar = "".join(["{}{}".format(num, op) for num, op in zip(run_lens.tolist(),
+                                                                cigar_chars[run_starts].tolist())])
+    return query, cigar, ipds, pws
+
+
+def _array_tag(tag, values):
+    return tag + ":B:C," + ",".join(map(str, values.tolist()))
+
+
+def _sam_header(contigs, aligned, program="ccsmeth-simulate"):
+    lines = ["@HD\tVN:1.6\tSO:unknown\tGO:query"]
+    if aligned:
+        for name, seq in contigs:
+            lines.append("@SQ\tSN:{}\tLN:{}".format(name, len(seq)))
+    lines.append("@PG\tID:{}\tPN:{}\tCL:{}".format(program, program, " ".join(sys.argv)))
+    return "\n".join(lines) + "\n"
+
+
+def _simulate_hole(rng, holenum, contigs, contig2ipdmeans, args):
+    cidx = int(rng.integers(0, len(contigs)))
+    chrom, ref_seq = contigs[cidx]
+    read_len = int(max(args.seq_len_min, rng.normal(args.read_len, args.read_len_sd)))
+    read_len = min(read_len, len(ref_seq) - 1)
+    start = int(rng.integers(0, len(ref_seq) - read_len + 1))
+    insert = ref_seq[start:(start + read_len)]
+    ipdmeans_fwd, ipdmeans_bwd = contig2ipdmeans[chrom]
+    ipdmeans_fwd = ipdmeans_fwd[start:(start + read_len)]
+    ipdmeans_bwd = ipdmeans_bwd[start:(start + read_len)]
+
+    n_subreads = max(1, int(rng.poisson(args.subreads_per_hole)))
+    first_strand = int(rng.integers(0, 2))
+    subreads = []
+    qstart = 0
+    for sidx in range(n_subreads):
+        is_fwd = (sidx + first_strand) % 2 == 0
+        ipd_means = ipdmeans_fwd if is_fwd else ipdmeans_bwd
+        query, cigar, ipds, pws = _simulate_subread_alignment(rng, insert, ipd_means, args.identity, args)
+        if not is_fwd:
+            # kinetics are saved in the orientation of the read, not the reference
+            ipds, pws = ipds[::-1], pws[::-1]
+        qend = qstart + len(query)
+        name = "{}/{}/{}_{}".format(movie_name, holenum, qstart, qend)
+        subreads.append((name, is_fwd, query, cigar, ipds, pws))
+        qstart = qend + adapter_len
+
+    # ccs: consensus is the insert itself, kinetics are the means over subreads
+    fn = sum([1 for subread in subreads if subread[1]])
+    rn = len(subreads) - fn
+    ccs_fwd = rng.random() < 0.5
+    ccs_info = (chrom, start, insert, ccs_fwd, _codes(ipdmeans_fwd), _codes(ipdmeans_bwd),
+                _codes(np.full(read_len, args.pw_shape * args.pw_scale)), fn, rn)
+    return chrom, start, subreads, ccs_info
+
+
+def _write_hole(holenum, chrom, start, subreads, ccs_info, writers):
+    unaligned_w, aligned_w, ccs_w = writers
+    for name, is_fwd, query, cigar, ipds, pws in subreads:
+        tags = [_array_tag("ip", ipds), _array_tag("pw", pws),
+                "np:i:1", "zm:i:{}".format(holenum), "RG:Z:simulate"]
+        qual = "!" * len(query)
+        if aligned_w is not None:
+            flag = "0" if is_fwd else "16"
+            aligned_w.write([name, flag, chrom, str(start + 1), "60", cigar, "*", "0", "0",
+                             _idx2seq(query), qual] + tags)
+        if unaligned_w is not None:
+            read_seq = query if is_fwd else _revcomp_idx(query)
+            unaligned_w.write([name, "4", "*", "0", "255", "*", "*", "0", "0",
+                               _idx2seq(read_seq), qual] + tags)
+    if ccs_w is not None:
+        chrom, start, insert, ccs_fwd, ipd_fwd, ipd_bwd, pw, fn, rn = ccs_info
+        # tags are in the orientation of the ccs read, ri/rp are in the reading direction of its
+        # reverse strand
+        if ccs_fwd:
+            fi, ri = ipd_fwd, ipd_bwd[::-1]
+        else:
+            fi, ri = ipd_bwd[::-1], ipd_fwd
+        name = "{}/{}/ccs".format(movie_name, holenum)
+        tags = [_array_tag("fi", fi), _array_tag("fp", pw), _array_tag("ri", ri), _array_tag("rp", pw),
+                "fn:i:{}".format(fn), "rn:i:{}".format(rn), "np:i:{}".format(min(fn, rn)),
+                "rq:f:0.999", "zm:i:{}".format(holenum), "RG:Z:simulate"]
+        ccs_w.write([name, "0" if ccs_fwd else "16", chrom, str(start + 1), "60", "{}=".format(len(insert)),
+                     "*", "0", "0", _idx2seq(insert), "~" * len(insert)] + tags)
+
+
+def simulate(args):
+    sys.stderr.write("[simulate]start..\n")
+    start = time.time()
+    rng = np.random.default_rng(args.seed)
+
+    output_dir = os.path.abspath(args.output_dir)
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    outprefix = os.path.join(output_dir, args.prefix)
+    outputs = set(args.outputs.split(","))
+    if not outputs.issubset({"unaligned", "aligned", "ccs"}):
+        raise ValueError("--outputs must be comma-separated items of unaligned, aligned and ccs")
+    ext = ".bam" if args.bam else ".sam"
+
+    contigs = _simulate_reference(rng, args)
+    ref_path = outprefix + ".ref.fa"
+    _write_reference(contigs, ref_path)
+    sys.stderr.write("reference of {} contigs saved in {}\n".format(len(contigs), ref_path))
+
+    methy_states = _cpg_methy_states(rng, contigs, args.methy_ratio)
+    with open(outprefix + ".truth.tsv", "w") as wf:
+        for name, _ in contigs:
+            cpg_locs, is_methy = methy_states[name]
+            for loc, label in zip(cpg_locs.tolist(), is_methy.tolist()):
+                wf.write("\t".join([name, str(loc), "+", str(int(label))]) + "\n")
+                wf.write("\t".join([name, str(loc + 1), "-", str(int(label))]) + "\n")
+    contig2ipdmeans = {}
+    for name, seq in contigs:
+        cpg_locs, is_methy = methy_states[name]
+        contig2ipdmeans[name] = (_strand_ipd_means(rng, len(seq), cpg_locs[is_methy], "+", args),
+                                 _strand_ipd_means(rng, len(seq), cpg_locs[is_methy], "-", args))
+
+    writers = (SamWriter(outprefix + ".subreads" + ext, _sam_header(contigs, False),
+                          args.path_to_samtools, args.threads) if "unaligned" in outputs else None,
+               SamWriter(outprefix + ".subreads.aligned" + ext, _sam_header(contigs, True),
+                          args.path_to_samtools, args.threads) if "aligned" in outputs else None,
+               SamWriter(outprefix + ".ccs" + ext, _sam_header(contigs, True),
+                          args.path_to_samtools, args.threads) if "ccs" in outputs else None)
+    cnt_subreads = 0
+    for hidx in range(args.holes):
+        holenum = hidx + 1
+        chrom, hstart, subreads, ccs_info = _simulate_hole(rng, holenum, contigs, contig2ipdmeans, args)
+        _write_hole(holenum, chrom, hstart, subreads, ccs_info, writers)
+        cnt_subreads += len(subreads)
+        if holenum % 1000 == 0:
+            sys.stderr.write("simulated {} holes\n".format(holenum))
+    for writer in writers:
+        if writer is not None:
+            writer.close()
+    sys.stderr.write("simulated {} holes, {} subreads, saved in {}.*\n".format(args.holes, cnt_subreads,
+                                                                             outprefix))
+    sys.stderr.write("[simulate]costs {:.1f} seconds\n".format(time.time() - start))
+
+
+def add_simulate_args(parser):
+    p_ref = parser.add_argument_group("REFERENCE")
+    p_ref.add_argument("--contigs", type=int, default=1, required=False,
+                       help="number of contigs in the reference, default 1")
+    p_ref.add_argument("--contig_len", type=int, default=1000000, required=False,
+                       help="length of each contig, default 1000000")
+    p_ref.add_argument("--cpg_density", type=float, default=0.01, required=False,
+                       help="CpGs per base in the reference, default 0.01")
+    p_ref.add_argument("--methy_ratio", type=float, default=0.7, required=False,
+                       help="ratio of methylated CpGs, default 0.7")
+
+    p_read = parser.add_argument_group("READS")
+    p_read.add_argument("--holes", type=int, default=1000, required=False,
+                        help="number of holes (ZMWs), default 1000")
+    p_read.add_argument("--subreads_per_hole", type=float, default=10, required=False,
+                        help="mean number of subreads per hole (poisson), default 10")
+    p_read.add_argument("--read_len", type=int, default=15000, required=False,
+                        help="mean insert length, default 15000")
+    p_read.add_argument("--read_len_sd", type=int, default=3000, required=False,
+                        help="sd of insert length, default 3000")
+    p_read.add_argument("--seq_len_min", type=int, default=500, required=False,
+                        help="min insert length, default 500")
+    p_read.add_argument("--identity", type=float, default=0.9, required=False,
+                        help="identity of subreads to the reference, default 0.9")
+    p_read.add_argument("--ipd_shape", type=float, default=2.0, required=False,
+                        help="shape of the gamma distribution of ipd codes, default 2.0")
+    p_read.add_argument("--ipd_scale", type=float, default=10.0, required=False,
+                        help="scale of the gamma distribution of ipd codes, default 10.0")
+    p_read.add_argument("--pw_shape", type=float, default=3.0, required=False,
+                        help="shape of the gamma distribution of pw codes, default 3.0")
+    p_read.add_argument("--pw_scale", type=float, default=3.0, required=False,
+                        help="scale of the gamma distribution of pw codes, default 3.0")
+    p_read.add_argument("--methy_ipd_ratio", type=float, default=1.5, required=False,
+                        help="ipd of methylated CpGs is increased by this ratio, default 1.5")
+
+    p_output = parser.add_argument_group("OUTPUT")
+    p_output.add_argument("--output_dir", "-o", type=str, required=True,
+                          help="output dir")
+    p_output.add_argument("--prefix", type=str, default="simulated", required=False,
+                          help="prefix of output files, default simulated")
+    p_output.add_argument("--outputs", type=str, default="unaligned,aligned,ccs", required=False,
+                          help="reads to output, comma-separated items of unaligned, aligned and ccs, "
+                               "default unaligned,aligned,ccs")
+    p_output.add_argument("--bam", action="store_true", default=False, required=False,
+                          help="output reads in bam format (samtools needed), default sam")
+    p_output.add_argument("--path_to_samtools", type=str, default=None, required=False,
+                          help="full path to the executable binary samtools file. "
+                               "If not specified, it is assumed that samtools is in "
+                               "the PATH.")
+    parser.add_argument("--threads", "-t", type=int, default=1, required=False,
+                        help="number of threads of samtools to compress bam, default 1")
+    parser.add_argument("--seed", type=int, default=1234, required=False,
+                        help="random seed, default 1234")
+
+
+def main():
+    parser = argparse.ArgumentParser("simulate a reference and subreads/ccs reads with kinetics")
+    add_simulate_args(parser)
+
+    args = parser.parse_args()
+    display_args(args, True)
+    simulate(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""
+runtime tuning of --holes_batch and --batch_size of call_mods (--adaptive_batch). the current values
+are shared by all processes in mp.Values: the reader reads holes_batch before cutting each batch of
+holes, the call workers read batch_size before calling each batch of features. the extract/call
+workers add their busy/idle seconds to shared counters, and a BatchController thread in the main
+process moves the values within their bounds every interval seconds:
+  - batch_size is hill-climbed on the samples/s of the busy call workers, only while the call
+    workers are the bottleneck (busy, with batches of features waiting). a move that makes calling
+    slower is reverted, and the other way is tried after a few intervals.
+  - holes_batch is shrunk when the call workers are starved (idle, no features waiting), so that
+    holes flow to the extract workers in smaller lumps with fewer stragglers; and grown when the call
+    workers are saturated and features pile up, so that there are fewer, bigger batches to pass.
+"""
+import sys
+import threading
+
+stat_names = ("extract_busy", "extract_idle", "call_busy", "call_idle", "call_samples")
+tune_interval_default = 5
+holes_batch_factor = 1.5
+util_high, util_low = 0.9, 0.6
+slower_ratio = 0.95  # samples/s below slower_ratio * that of the last batch_size is slower
+hold_steps = 6  # intervals to wait after reverting a move of batch_size
+
+
+def _clamp(value, bounds):
+    return max(bounds[0], min(bounds[1], int(value)))
+
+
+def _check_bounds(bounds, name):
+    if len(bounds) != 2 or bounds[0] < 1 or bounds[0] > bounds[1]:
+        raise ValueError("{} must be MIN MAX, with 1 <= MIN <= MAX".format(name))
+    return int(bounds[0]), int(bounds[1])
+
+
+class BatchTuner:
+    """
+    holes_batch/batch_size shared by the processes of one run, and the busy/idle counters of the
+    workers. created in the main process and passed to the workers as a process argument.
+    """
+    def __init__(self, mp_ctx, holes_batch, batch_size, holes_batch_bounds, batch_size_bounds):
+        self.holes_batch_bounds = _check_bounds(holes_batch_bounds, "--holes_batch_bounds")
+        self.batch_size_bounds = _check_bounds(batch_size_bounds, "--batch_size_bounds")
+        self._holes_batch = mp_ctx.Value("i", _clamp(holes_batch, self.holes_batch_bounds))
+        self._batch_size = mp_ctx.Value("i", _clamp(batch_size, self.batch_size_bounds))
+        self._stats = mp_ctx.Array("d", len(stat_names))
+
+    def holes_batch(self):
+        return self._holes_batch.value
+
+    def batch_size(self):
+        return self._batch_size.value
+
+    def set(self, holes_batch=None, batch_size=None):
+        if holes_batch is not None:
+            self._holes_batch.value = _clamp(holes_batch, self.holes_batch_bounds)
+        if batch_size is not None:
+            self._batch_size.value = _clamp(batch_size, self.batch_size_bounds)
+
+    def observe(self, stage, busy=0.0, idle=0.0, samples=0):
+        """
+        :param stage: extract or call
+        """
+        with self._stats.get_lock():
+            self._stats[stat_names.index(stage + "_busy")] += busy
+            self._stats[stat_names.index(stage + "_idle")] += idle
+            if samples > 0:
+                self._stats[stat_names.index("call_samples")] += samples
+
+    def stats(self):
+        with self._stats.get_lock():
+            return dict(zip(stat_names, self._stats[:]))
+
+
+def _sum_qsize(queues):
+    try:
+        return sum([q.qsize() for q in queues])
+    except NotImplementedError:  # e.g. macOS
+        return -1
+
+
+class BatchController(threading.Thread):
+    """
+    runs in the main process, see the module docstring for the policy.
+    :param hole_qs: queues of batches of holes to the extract workers
+    :param features_qs: queues of batches of features to the call workers
+    """
+    def __init__(self, tuner, hole_qs, features_qs, nproc_extract, nproc_call, interval=tune_interval_default):
+        super(BatchController, self).__init__()
+        self.daemon = True
+        self._tuner = tuner
+        self._hole_qs = hole_qs
+        self._features_qs = features_qs
+        self._nproc_extract = max(1, nproc_extract)
+        self._nproc_call = max(1, nproc_call)
+        self._interval = interval
+        self._stop_event = threading.Event()
+        self._prev_stats = tuner.stats()
+        self._prev_speed = None
+        self._prev_batch_size = tuner.batch_size()
+        self._direction = 1
+        self._hold = 0
+        self._cnt_moves = 0
+
+    def _log(self, msg):
+        sys.stderr.write("[batch_tuner]{}\n".format(msg))
+        sys.stderr.flush()
+
+    def _tune_batch_size(self, call_busy, call_samples, call_util, depth_features):
+        tuner = self._tuner
+        curr = tuner.batch_size()
+        if call_busy <= 0 or call_samples <= 0:
+            return
+        speed = call_samples / call_busy
+        if self._prev_speed is not None and curr != self._prev_batch_size and \
+                speed < slower_ratio * self._prev_speed:
+            # the last move made calling slower: move back, and try the other way later
+            tuner.set(batch_size=self._prev_batch_size)
+            self._log("batch_size {} -> {}, {:.1f} samples/s is slower than {:.1f}".format(
+                curr, self._prev_batch_size, speed, self._prev_speed))
+            self._direction = -self._direction
+            self._prev_speed = None
+            self._hold = hold_steps
+            self._cnt_moves += 1
+            return
+        self._prev_speed, self._prev_batch_size = speed, curr
+        if self._hold > 0:
+            self._hold -= 1
+            return
+        if call_util < util_high or depth_features < self._nproc_call:
+            return
+        new = tuner.batch_size() * 2 if self._direction > 0 else tuner.batch_size() // 2
+        new = _clamp(new, tuner.batch_size_bounds)
+        if new == curr:
+            self._direction = -self._direction
+            return
+        tuner.set(batch_size=new)
+        self._log("batch_size {} -> {}, call workers {:.0%} busy with {} batches waiting".format(
+            curr, new, call_util, depth_features))
+        self._cnt_moves += 1
+
+    def _tune_holes_batch(self, call_util, extract_util, depth_holes, depth_features):
+        tuner = self._tuner
+        curr = tuner.holes_batch()
+        if call_util < util_low and depth_features == 0:
+            new = _clamp(curr / holes_batch_factor, tuner.holes_batch_bounds)
+            reason = "call workers {:.0%} busy, extract workers {:.0%} busy with {} batches waiting".format(
+                call_util, extract_util, depth_holes)
+        elif call_util >= util_high and depth_features >= 4 * self._nproc_call:
+            new = _clamp(curr * holes_batch_factor, tuner.holes_batch_bounds)
+            reason = "call workers {:.0%} busy with {} batches waiting".format(call_util, depth_features)
+        else:
+            return
+        if new != curr:
+            tuner.set(holes_batch=new)
+            self._log("holes_batch {} -> {}, {}".format(curr, new, reason))
+            self._cnt_moves += 1
+
+    def step(self):
+        stats = self._tuner.stats()
+        delta = dict([(name, stats[name] - self._prev_stats[name]) for name in stat_names])
+        self._prev_stats = stats
+        call_time = delta["call_busy"] + delta["call_idle"]
+        extract_time = delta["extract_busy"] + delta["extract_idle"]
+        if call_time <= 0:
+            return
+        call_util = delta["call_busy"] / call_time
+        extract_util = delta["extract_busy"] / extract_time if extract_time > 0 else 0.0
+        depth_holes, depth_features = _sum_qsize(self._hole_qs), _sum_qsize(self._features_qs)
+        if depth_holes < 0 or depth_features < 0:
+            return
+        self._tune_batch_size(delta["call_busy"], delta["call_samples"], call_util, depth_features)
+        self._tune_holes_batch(call_util, extract_util, depth_holes, depth_features)
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.step()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._log("{} moves, holes_batch={}, batch_size={} at the end".format(
+            self._cnt_moves, self._tuner.holes_batch(), self._tuner.batch_size()))
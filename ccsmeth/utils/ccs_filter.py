@@ -0,0 +1,103 @@
+"""
+whitelist of holes with a usable CCS read, from the CCS bam/sam of the same movie(s): read quality
+(rq) >= min_rq, number of passes (np) >= min_np, and, optionally, a primary alignment of the CCS
+read. subreads of the other holes are dropped before alignment/extraction.
+
+the whitelist can also be saved once and passed as --holeids_e:
+    python -m ccsmeth.utils.ccs_filter --ccs_bam ccs.bam --min_rq 0.99 -o holeids.txt
+"""
+import os
+import sys
+import argparse
+from subprocess import Popen, PIPE
+
+from .process_utils import generate_samtools_view_cmd
+
+
+def get_ccs_holeids(ccs_bam, min_rq=0.99, min_np=1, mapped_only=False, path_to_samtools=None):
+    """
+    :param mapped_only: only holes whose CCS read has a primary alignment, needs an aligned CCS bam
+    :return: set of holeids (movie/zmw). a CCS read without rq/np tag is not filtered by the tag.
+    """
+    if ccs_bam.endswith(".bam"):
+        proc_read = Popen(" ".join([generate_samtools_view_cmd(path_to_samtools), ccs_bam]), shell=True,
+                          stdout=PIPE)
+        rf = (str(line, 'utf-8') for line in proc_read.stdout)
+    elif ccs_bam.endswith(".sam"):
+        proc_read = None
+        rf = open(ccs_bam, "r")
+    else:
+        raise ValueError("--ccs_bam must be in bam/sam format!")
+    holeids = set()
+    cnt_reads = 0
+    for line in rf:
+        if line.startswith("@"):
+            continue
+        words = line.rstrip("\n").split("\t")
+        flag = int(words[1])
+        if flag & (256 | 2048):
+            continue
+        cnt_reads += 1
+        if mapped_only and flag & 4:
+            continue
+        usable = True
+        for tag in words[11:]:
+            if tag.startswith("rq:f:"):
+                usable = float(tag[5:]) >= min_rq
+            elif tag.startswith("np:i:"):
+                usable = int(tag[5:]) >= min_np
+            if not usable:
+                break
+        if usable:
+            namewords = words[0].split("/")
+            holeids.add(namewords[0] + "/" + namewords[1])
+    if proc_read is not None:
+        if proc_read.wait() != 0:
+            raise RuntimeError("samtools failed in reading {}".format(ccs_bam))
+    else:
+        rf.close()
+    sys.stderr.write("get {} usable holes of {} CCS reads from {}\n".format(len(holeids), cnt_reads, ccs_bam))
+    return holeids
+
+
+def holeids_of_args(args, holeids=None):
+    """
+    holeids, intersected with the whitelist from args.ccs_bam if it is set
+    """
+    if args.ccs_bam is None:
+        return holeids
+    ccs_holeids = get_ccs_holeids(os.path.abspath(args.ccs_bam), args.min_rq, args.min_np, args.ccs_mapped,
+                                  args.path_to_samtools)
+    return ccs_holeids if holeids is None else holeids & ccs_holeids
+
+
+def write_holeids(holeids, holeids_file):
+    with open(holeids_file, "w") as wf:
+        for holeid in sorted(holeids):
+            wf.write(holeid + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser("save holeids of usable CCS reads, for --holeids_e of "
+                                     "align/extract/call_mods")
+    parser.add_argument("--ccs_bam", type=str, required=True,
+                        help="CCS bam/sam of the subreads")
+    parser.add_argument("--min_rq", type=float, default=0.99, required=False,
+                        help="min read quality (rq) of CCS reads, default 0.99")
+    parser.add_argument("--min_np", type=int, default=1, required=False,
+                        help="min number of passes (np) of CCS reads, default 1")
+    parser.add_argument("--ccs_mapped", action="store_true", default=False, required=False,
+                        help="only holes whose CCS read is mapped, needs an aligned CCS bam")
+    parser.add_argument("--path_to_samtools", type=str, default=None, required=False,
+                        help="full path to the executable binary samtools file. "
+                             "If not specified, it is assumed that samtools is in "
+                             "the PATH.")
+    parser.add_argument("--output", "-o", type=str, required=True,
+                        help="file to save the holeids, one per line")
+
+    args = parser.parse_args()
+    write_holeids(holeids_of_args(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+"""
+in-process alignment of subreads with mappy (the python binding of minimap2). the index is loaded
+once and shared by all aligning threads (mappy releases the GIL while mapping). subreads are read
+hole by hole, aligned in parallel, and yielded in the input (hole) order, with the ip/pw kinetics
+kept as numpy arrays. the aligned holes can be written to a hole-sorted sam/bam, or passed to
+extraction directly, without the sam->fastq->sam text round-trips of the minimap2 pipeline.
+
+an aligned subread is a list of sam fields as strings, like a line of `samtools view` split by tab,
+except that the kinetics tags are tuples of (tag, type, array), e.g. ("ip", "C", array([...])).
+"""
+import os
+import re
+import sys
+import threading
+import numpy as np
+from collections import deque
+from importlib.util import find_spec
+from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+from .process_utils import generate_samtools_view_cmd
+from .process_utils import SamWriter
+
+kinetics_tags = ("ip", "pw")
+mmi_magic = b"MMI\2"
+_tag_type2dtype = {"c": np.int8, "C": np.uint8, "s": np.int16, "S": np.uint16,
+                   "i": np.int32, "I": np.uint32}
+_revcomp_table = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+def load_aligner(reference, bestn=3, threads=1):
+    """
+    :param reference: fasta, or minimap2 index (.mmi) built with -x map-pb
+    :param threads: threads to build the index, if reference is a fasta
+    """
+    try:
+        import mappy
+    except ImportError:
+        raise ImportError("mappy is needed to align in process, install it by `pip install mappy`")
+    aligner = mappy.Aligner(reference, preset="map-pb", best_n=bestn, n_threads=threads)
+    if not aligner:
+        raise IOError("failed to load/build the minimap2 index of {}".format(reference))
+    return aligner
+
+
+def get_aligner(reference, bestn=3, threads=1, guide_bam=None, guide_pad=1000, path_to_samtools=None,
+                to_ccs=False):
+    """
+    CcsGuide if to_ccs, LocusGuide if guide_bam is set, or else mappy.Aligner of the whole reference
+    """
+    if to_ccs:
+        if guide_bam is None:
+            raise ValueError("an aligned CCS bam is needed to align subreads to CCS reads")
+        sys.stderr.write("aligning to CCS reads in {}..\n".format(guide_bam))
+        return CcsGuide(reference, guide_bam, path_to_samtools)
+    if guide_bam is not None:
+        sys.stderr.write("aligning to windows of {} around CCS alignments in {}..\n".format(reference, guide_bam))
+        return LocusGuide(reference, guide_bam, guide_pad, path_to_samtools)
+    sys.stderr.write("loading minimap2 index of {}..\n".format(reference))
+    return load_aligner(reference, bestn, threads)
+
+
+def aligner_sam_header(aligner, input_header=""):
+    """
+    @HD/@SQ lines of the aligner's reference, plus the @RG/@PG lines of the input subreads
+    """
+    if isinstance(aligner, LocusGuide) or isinstance(aligner, CcsGuide):
+        contig_lens = aligner.contig_lens()
+    else:
+        contig_lens = [(name, len(aligner.seq(name))) for name in aligner.seq_names]
+    header = "@HD\tVN:1.6\tSO:unknown\tGO:query\n"
+    for name, contiglen in contig_lens:
+        header += "@SQ\tSN:{}\tLN:{}\n".format(name, contiglen)
+    for line in input_header.splitlines():
+        if line.startswith("@RG") or line.startswith("@PG"):
+            header += line + "\n"
+    header += "@PG\tID:ccsmeth-mappy\tPN:mappy\n"
+    return header
+
+
+def read_sam_header(inputpath, path_to_samtools=None):
+    if inputpath.endswith(".bam"):
+        samtools_view = generate_samtools_view_cmd(path_to_samtools)
+        proc = Popen(" ".join([samtools_view, "-H", inputpath]), shell=True, stdout=PIPE)
+        header = str(proc.communicate()[0], 'utf-8')
+        return header
+    header = ""
+    if inputpath.endswith(".sam"):
+        with open(inputpath, "r") as rf:
+            for line in rf:
+                if not line.startswith("@"):
+                    break
+                header += line
+    return header
+
+
+def _parse_tags(tagstrs):
+    """
+    :return: tags (str) except ip/pw, and ip/pw as (tag, type, array)
+    """
+    tags, kinetics = [], []
+    for tagstr in tagstrs:
+        if tagstr[:2] in kinetics_tags and tagstr[3:5] == "B:":
+            kinetics.append((tagstr[:2], tagstr[5],
+                             np.fromstring(tagstr[7:], dtype=_tag_type2dtype.get(tagstr[5], np.int64),
+                                           sep=",")))
+        elif tagstr != "":
+            tags.append(tagstr)
+    return tags, kinetics
+
+
+def _iter_subreads_of_sam(inputpath, path_to_samtools=None):
+    if inputpath.endswith(".bam"):
+        samtools_view = generate_samtools_view_cmd(path_to_samtools)
+        proc = Popen(" ".join([samtools_view, inputpath]), shell=True, stdout=PIPE)
+        rf = (str(line, 'utf-8') for line in proc.stdout)
+    else:
+        proc = None
+        rf = open(inputpath, "r")
+    for line in rf:
+        if line.startswith("@"):
+            continue
+        words = line.rstrip("\n").split("\t")
+        tags, kinetics = _parse_tags(words[11:])
+        yield words[0], words[9], words[10], tags, kinetics
+    if proc is not None:
+        if proc.wait() != 0:
+            raise RuntimeError("samtools failed in reading {}".format(inputpath))
+    else:
+        rf.close()
+
+
+def _iter_subreads_of_fastq(inputpath):
+    # fastq from subreads_sam2fastq_std.py, tags are in the comment
+    import mappy
+    for name, seq, qual, comment in mappy.fastx_read(inputpath, read_comment=True):
+        tags, kinetics = _parse_tags(comment.split("\t") if comment else [])
+        yield name, seq, qual if qual else "*", tags, kinetics
+
+
+def iter_subreads_holes(inputpath, path_to_samtools=None):
+    """
+    subreads of each hole, in the input order. the input (subreads.bam/sam/fastq) must be grouped
+    by holes, as subreads.bam from the sequencer is.
+    :return: generator of (holeid, [(name, seq, qual, tags, kinetics), ]), holeid is movie/zmw
+    """
+    if inputpath.endswith(".fq") or inputpath.endswith(".fastq"):
+        subreads = _iter_subreads_of_fastq(inputpath)
+    else:
+        subreads = _iter_subreads_of_sam(inputpath, path_to_samtools)
+    holeid_curr = None
+    hole_subreads = []
+    for subread in subreads:
+        namewords = subread[0].split("/")
+        holeid = namewords[0] + "/" + namewords[1]
+        if holeid != holeid_curr:
+            if len(hole_subreads) > 0:
+                yield holeid_curr, hole_subreads
+            holeid_curr = holeid
+            hole_subreads = []
+        hole_subreads.append(subread)
+    if len(hole_subreads) > 0:
+        yield holeid_curr, hole_subreads
+
+
+_cigar_ref_ops = re.compile(r"(\d+)[MDN=X]")
+_cigar_ops = re.compile(r"(\d+)([MIDNSHP=X])")
+ccs_contig = "ccs"  # rname of subreads aligned to the ccs read of their hole
+
+
+def read_ccs_loci(ccs_bam, path_to_samtools=None):
+    """
+    loci of the primary alignments of CCS reads
+    :return: dict of holeid -> (chrom, start, end, mapq), 0-based, end exclusive
+    """
+    if ccs_bam.endswith(".bam"):
+        proc = Popen(" ".join([generate_samtools_view_cmd(path_to_samtools), ccs_bam]), shell=True, stdout=PIPE)
+        rf = (str(line, 'utf-8') for line in proc.stdout)
+    else:
+        proc = None
+        rf = open(ccs_bam, "r")
+    hole2locus = {}
+    for line in rf:
+        if line.startswith("@"):
+            continue
+        words = line.split("\t", 6)
+        if int(words[1]) & (4 | 256 | 2048):
+            continue
+        start = int(words[3]) - 1
+        reflen = sum([int(num) for num in _cigar_ref_ops.findall(words[5])])
+        namewords = words[0].split("/")
+        hole2locus[namewords[0] + "/" + namewords[1]] = (words[2], start, start + reflen, int(words[4]))
+    if proc is not None:
+        if proc.wait() != 0:
+            raise RuntimeError("samtools failed in reading {}".format(ccs_bam))
+    else:
+        rf.close()
+    sys.stderr.write("get loci of {} mapped CCS reads from {}\n".format(len(hole2locus), ccs_bam))
+    return hole2locus
+
+
+def check_aligner_inputs(reference, guide_bam=None, to_ccs=False):
+    """
+    check what get_aligner() needs, before the aligner is loaded in the reader process, where an
+    error only shows up in the log of the process
+    """
+    if find_spec("mappy") is None:
+        raise ImportError("mappy is needed to align in process, install it by `pip install mappy`")
+    if to_ccs and guide_bam is None:
+        raise ValueError("an aligned CCS bam is needed to align subreads to CCS reads")
+    if not os.path.isfile(reference):
+        raise IOError("the reference/index to align to ({}) does not exist!".format(reference))
+    if reference.endswith(".mmi"):
+        with open(reference, "rb") as rf:
+            if rf.read(4) != mmi_magic:
+                raise IOError("{} is not a minimap2 index".format(reference))
+    if guide_bam is not None and not os.path.isfile(guide_bam):
+        raise IOError("the CCS bam to guide the alignment ({}) does not exist!".format(guide_bam))
+
+
+class LocusGuide(object):
+    """
+    align the subreads of a hole only to a padded reference window around the alignment of its CCS
+    read, with a small index built for each window, instead of to the whole genome. subreads of holes
+    without a mapped CCS read are left unmapped.
+    """
+    def __init__(self, reference, ccs_bam, pad=1000, path_to_samtools=None):
+        from .ref_reader import load_reference_contigs
+        try:
+            import mappy
+        except ImportError:
+            raise ImportError("mappy is needed to align in process, install it by `pip install mappy`")
+        self._mappy = mappy
+        self._contigs = load_reference_contigs(reference)
+        self._hole2locus = read_ccs_loci(ccs_bam, path_to_samtools)
+        self._pad = pad
+
+    def contig_lens(self):
+        return [(name, len(self._contigs[name])) for name in self._contigs.keys()]
+
+    def window(self, holeid):
+        """
+        :return: mappy.Aligner of the window, (chrom, window start, mapq of the CCS read), or None
+        """
+        if holeid not in self._hole2locus:
+            return None
+        chrom, start, end, mapq = self._hole2locus[holeid]
+        if chrom not in self._contigs:
+            return None
+        contig = self._contigs[chrom]
+        wstart, wend = max(0, start - self._pad), min(len(contig), end + self._pad)
+        aligner = self._mappy.Aligner(seq=str(contig[wstart:wend]), preset="map-pb")
+        if not aligner:
+            return None
+        return aligner, (chrom, wstart, mapq)
+
+
+def _ccs_to_ref_locs(pos, cigar, seqlen):
+    """
+    0-based reference loc of each base of the SEQ of an aligned read, -1 for clipped/inserted bases
+    """
+    ccs2ref = np.full(seqlen, -1, dtype=np.int64)
+    qloc, rloc = 0, pos
+    for num, op in _cigar_ops.findall(cigar):
+        num = int(num)
+        if op in "M=X":
+            ccs2ref[qloc:(qloc + num)] = np.arange(rloc, rloc + num)
+            qloc += num
+            rloc += num
+        elif op in "IS":
+            qloc += num
+        elif op in "DN":
+            rloc += num
+    return ccs2ref
+
+
+def _iter_ccs_reads(ccs_bam, path_to_samtools=None):
+    """
+    primary records of an aligned CCS bam/sam: (movie, zmw, chrom, 0-based pos, mapq, seq, cigar)
+    """
+    if ccs_bam.endswith(".bam"):
+        proc = Popen(" ".join([generate_samtools_view_cmd(path_to_samtools), ccs_bam]), shell=True, stdout=PIPE)
+        rf = (str(line, 'utf-8') for line in proc.stdout)
+    else:
+        proc = None
+        rf = open(ccs_bam, "r")
+    for line in rf:
+        if line.startswith("@"):
+            continue
+        words = line.split("\t", 11)
+        if int(words[1]) & (256 | 2048):
+            continue
+        namewords = words[0].split("/")
+        if int(words[1]) & 4:
+            yield namewords[0], int(namewords[1]), None, -1, 0, words[9], "*"
+        else:
+            yield namewords[0], int(namewords[1]), words[2], int(words[3]) - 1, int(words[4]), words[9], words[5]
+    if proc is not None:
+        if proc.wait() != 0:
+            raise RuntimeError("samtools failed in reading {}".format(ccs_bam))
+    else:
+        rf.close()
+
+
+class CcsGuide(object):
+    """
+    align the subreads of a hole to the (aligned) CCS read of the hole, instead of to the reference.
+    the aligned CCS bam is read along with the subreads, so it must be grouped by holes in the same
+    order as the subreads (e.g. aligned without sorting). each subread alignment carries
+    ("ccs", (chrom, ccs seq, reference loc of each ccs base)) of its hole, the ccs seq is in
+    reference-forward orientation, as the SEQ of the CCS alignment, so alignments to its + strand
+    are alignments to the + strand of the reference.
+    """
+    def __init__(self, reference, ccs_bam, path_to_samtools=None):
+        from .ref_reader import load_reference_contigs
+        try:
+            import mappy
+        except ImportError:
+            raise ImportError("mappy is needed to align in process, install it by `pip install mappy`")
+        self._mappy = mappy
+        self._contigs = load_reference_contigs(reference)
+        self._ccs_bam = ccs_bam
+        self._path_to_samtools = path_to_samtools
+
+    def contig_lens(self):
+        return [(name, len(self._contigs[name])) for name in self._contigs.keys()]
+
+    def attach(self, holes):
+        """
+        :return: generator of (holeid, subreads, ccs read of the hole or None)
+        """
+        ccs_reads = _iter_ccs_reads(self._ccs_bam, self._path_to_samtools)
+        ccs_read = next(ccs_reads, None)
+        movies_done = set()
+        movie_curr = None
+        for holeid, subreads in holes:
+            movie, zmw = holeid.split("/")
+            zmw = int(zmw)
+            if movie != movie_curr:
+                if movie_curr is not None:
+                    movies_done.add(movie_curr)
+                movie_curr = movie
+            while ccs_read is not None and (ccs_read[0] in movies_done or
+                                            (ccs_read[0] == movie and ccs_read[1] < zmw)):
+                ccs_read = next(ccs_reads, None)
+            if ccs_read is not None and ccs_read[0] == movie and ccs_read[1] == zmw:
+                yield holeid, subreads, ccs_read
+            else:
+                yield holeid, subreads, None
+
+    def window(self, ccs_read):
+        """
+        :return: mappy.Aligner of the ccs read, (locus of the ccs read, ccsinfo), or None
+        """
+        if ccs_read is None or ccs_read[2] is None:
+            return None
+        _, _, chrom, pos, mapq, seq, cigar = ccs_read
+        aligner = self._mappy.Aligner(seq=seq, preset="map-pb")
+        if not aligner:
+            return None
+        return aligner, (ccs_contig, 0, mapq), (chrom, seq, _ccs_to_ref_locs(pos, cigar, len(seq)))
+
+
+def _revcomp(seq):
+    return seq.translate(_revcomp_table)[::-1]
+
+
+def _unmapped_subread(subread):
+    name, seq, qual, tags, kinetics = subread
+    return [name, "4", "*", "0", "0", "*", "*", "0", "0", seq, qual] + tags + kinetics
+
+
+def _align_subread(aligner, subread, bestn, buf, locus=None):
+    """
+    :param locus: (chrom, start, max mapq) of the window, if aligner is of a reference window
+    """
+    name, seq, qual, tags, kinetics = subread
+    hits = list(aligner.map(seq, buf=buf))
+    if len(hits) == 0:
+        return [_unmapped_subread(subread)]
+    # same as `minimap2 --secondary=no` for bestn<=2, or -N bestn-1
+    num_secondary = bestn - 1 if bestn > 2 else 0
+    seqlen = len(seq)
+    records = []
+    has_primary = False
+    for hit in hits:
+        if hit.is_primary:
+            flag = 2048 if has_primary else 0
+            has_primary = True
+        else:
+            if num_secondary <= 0:
+                continue
+            num_secondary -= 1
+            flag = 256
+        if hit.strand == 1:
+            clip_l, clip_r = hit.q_st, seqlen - hit.q_en
+            seq_out, qual_out = seq, qual
+        else:
+            flag |= 16
+            clip_l, clip_r = seqlen - hit.q_en, hit.q_st
+            seq_out = _revcomp(seq)
+            qual_out = qual[::-1] if qual != "*" else qual
+        if flag & 256:
+            seq_out, qual_out = "*", "*"
+        cigar = ("{}S".format(clip_l) if clip_l > 0 else "") + hit.cigar_str + \
+                ("{}S".format(clip_r) if clip_r > 0 else "")
+        chrom, pos, mapq = hit.ctg, hit.r_st + 1, hit.mapq
+        if locus is not None:
+            # the uniqueness of the locus is given by the alignment of the CCS read
+            chrom, pos, mapq = locus[0], pos + locus[1], min(mapq, locus[2])
+        records.append([name, str(flag), chrom, str(pos), str(mapq), cigar, "*", "0", "0",
+                        seq_out, qual_out, "NM:i:{}".format(hit.NM),
+                        "tp:A:{}".format("P" if hit.is_primary else "S")] + tags + kinetics)
+    return records
+
+
+_thread_local = threading.local()
+
+
+def _align_holes(aligner, holes, bestn):
+    # a mappy.ThreadBuffer for each thread, reused by all its alignments
+    if not hasattr(_thread_local, "buf"):
+        import mappy
+        _thread_local.buf = mappy.ThreadBuffer()
+    holes_aligned = []
+    for hole in holes:
+        holeid, hole_subreads = hole[0], hole[1]
+        hole_aligner, locus, ccsinfo = aligner, None, None
+        if isinstance(aligner, LocusGuide) or isinstance(aligner, CcsGuide):
+            window = aligner.window(holeid) if isinstance(aligner, LocusGuide) else aligner.window(hole[2])
+            if window is None:
+                holes_aligned.append((holeid, [_unmapped_subread(subread) for subread in hole_subreads]))
+                continue
+            if isinstance(aligner, LocusGuide):
+                hole_aligner, locus = window
+            else:
+                hole_aligner, locus, ccsinfo = window
+        hole_aligns = []
+        for subread in hole_subreads:
+            hole_aligns += _align_subread(hole_aligner, subread, bestn, _thread_local.buf, locus)
+        if ccsinfo is not None:
+            # shared by the subreads of the hole, and pickled only once with them
+            hole_aligns = [words + [("ccs", ccsinfo)] if words[1] != "4" else words for words in hole_aligns]
+        holes_aligned.append((holeid, hole_aligns))
+    return holes_aligned
+
+
+def iter_aligned_holes(holes, aligner, bestn=3, threads=1, holes_batch=50):
+    """
+    align holes with threads sharing the aligner, keep the order of holes.
+    :param aligner: mappy.Aligner of the genome, LocusGuide or CcsGuide
+    :param holes: iterable of (holeid, subreads), e.g. from iter_subreads_holes()
+    :return: generator of (holeid, [aligned subread, ]), in the same order as holes
+    """
+    if isinstance(aligner, CcsGuide):
+        holes = aligner.attach(holes)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = deque()
+        holes_tmp = []
+        for hole in holes:
+            holes_tmp.append(hole)
+            if len(holes_tmp) >= holes_batch:
+                pending.append(executor.submit(_align_holes, aligner, holes_tmp, bestn))
+                holes_tmp = []
+                # bound the batches in flight, the results are consumed in order
+                while len(pending) >= threads * 2:
+                    for hole_aligned in pending.popleft().result():
+                        yield hole_aligned
+        if len(holes_tmp) > 0:
+            pending.append(executor.submit(_align_holes, aligner, holes_tmp, bestn))
+        while len(pending) > 0:
+            for hole_aligned in pending.popleft().result():
+                yield hole_aligned
+
+
+def aligned_subread_to_fields(words):
+    """
+    sam fields of an aligned subread, kinetics arrays are formatted as B-array tags
+    """
+    return [word if isinstance(word, str) else
+            "{}:B:{},{}".format(word[0], word[1], ",".join(map(str, word[2].tolist())))
+            for word in words]
+
+
+def align_subreads_with_mappy(inputpath, reference, outputpath, bestn=3, threads=1, holes_batch=50,
+                              path_to_samtools=None, holeids=None, guide_bam=None, guide_pad=1000):
+    """
+    align subreads to a hole-sorted (grouped by holes, in the input order) sam/bam
+    :param holeids: only align these holes, default all
+    :param guide_bam: aligned CCS bam/sam, to align subreads to the windows of their CCS reads only
+    """
+    aligner = get_aligner(reference, bestn, threads, guide_bam, guide_pad, path_to_samtools)
+    header = aligner_sam_header(aligner, read_sam_header(inputpath, path_to_samtools))
+
+    writer = SamWriter(outputpath, header, path_to_samtools, threads)
+    cnt_holes, cnt_subreads, cnt_mapped = 0, 0, 0
+    try:
+        holes = iter_subreads_holes(inputpath, path_to_samtools)
+        if holeids is not None:
+            holes = ((holeid, subreads) for holeid, subreads in holes if holeid in holeids)
+        for holeid, hole_aligns in iter_aligned_holes(holes, aligner, bestn, threads, holes_batch):
+            cnt_holes += 1
+            for words in hole_aligns:
+                flag = int(words[1])
+                if not (flag & (256 | 2048)):  # count each subread once
+                    cnt_subreads += 1
+                    if not (flag & 4):
+                        cnt_mapped += 1
+                writer.write(aligned_subread_to_fields(words))
+    finally:
+        writer.close()
+    sys.stderr.write("aligned {} holes, {} of {} subreads mapped, saved in {}\n".format(
+        cnt_holes, cnt_mapped, cnt_subreads, os.path.abspath(outputpath)))
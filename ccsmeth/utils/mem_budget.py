@@ -0,0 +1,154 @@
+"""
+memory budget of the batches in flight (--max_memory). queen_size_border only counts batches, which can
+be of a few KB or of many MB, so the bytes of the batches put in the queues and not yet got by the next
+stage are counted in a shared MemoryBudget:
+  - the reader waits before putting a batch of holes while the pending bytes are over the budget (a
+    batch is always admitted when nothing is pending, so that a batch bigger than the budget still goes).
+  - a worker adds the bytes of the batches it puts, releases those of the batch it got once its outputs
+    are put, and then pauses while the pending bytes are over the budget and its output queues are not
+    empty, i.e. while the next stage has work to drain. the writers never wait, so the pipeline always
+    moves on.
+  - a writer releases the bytes of a batch as it gets it, the batches held in its ReorderBuffer are
+    bounded by --reorder_window.
+the bytes of a batch are estimated from its content by estimate_nbytes(), which gives the same number
+in the process that puts the batch and in the one that gets it.
+"""
+import re
+import sys
+import time
+
+import numpy as np
+
+wait_seconds = 0.05
+_size_pattern = re.compile(r"^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)I?B?\s*$", re.IGNORECASE)
+_size_units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(sizestr):
+    """
+    :param sizestr: bytes, or with a unit of K/M/G/T (e.g. 512M, 4G, 1.5GB)
+    :return: number of bytes
+    """
+    match = _size_pattern.match(str(sizestr))
+    if match is None:
+        raise ValueError("size {} is not like 4G/512M/1048576".format(sizestr))
+    return int(float(match.group(1)) * _size_units[match.group(2).upper()])
+
+
+def estimate_nbytes(obj):
+    """
+    estimated bytes of a batch (nested lists/tuples of str/numbers/numpy arrays), from the lengths of
+    its content plus the overhead of python objects.
+    """
+    if isinstance(obj, str):
+        return 49 + len(obj)
+    if isinstance(obj, (list, tuple)):
+        return 56 + 8 * len(obj) + sum([estimate_nbytes(item) for item in obj])
+    if isinstance(obj, np.ndarray):
+        return 112 + obj.nbytes
+    if isinstance(obj, (bytes, bytearray)):
+        return 33 + len(obj)
+    if hasattr(obj, "itemsize") and hasattr(obj, "__len__"):  # array.array, e.g. of pysam
+        return 64 + obj.itemsize * len(obj)
+    return 32
+
+
+def _any_not_empty(queues):
+    return any(not q.empty() for q in queues)
+
+
+class MemoryBudget:
+    """
+    pending bytes of the batches in the queues, shared by the processes of one run. created in the main
+    process and passed to the reader/workers/writers as a process argument.
+    """
+    def __init__(self, mp_ctx, max_bytes):
+        if max_bytes < 1:
+            raise ValueError("--max_memory must be > 0")
+        self.max_bytes = max_bytes
+        self._pending = mp_ctx.Value("q", 0)
+        self._peak = mp_ctx.Value("q", 0)
+
+    def _add(self, nbytes):
+        self._pending.value += nbytes
+        if self._pending.value > self._peak.value:
+            self._peak.value = self._pending.value
+
+    def admit(self, nbytes):
+        """
+        in the reader, wait until the batch fits in the budget, and count its bytes
+        :return: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._pending.get_lock():
+                if self._pending.value == 0 or self._pending.value + nbytes <= self.max_bytes:
+                    self._add(nbytes)
+                    return waited
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+
+    def add(self, nbytes):
+        with self._pending.get_lock():
+            self._add(nbytes)
+
+    def release(self, nbytes):
+        with self._pending.get_lock():
+            self._pending.value = max(0, self._pending.value - nbytes)
+
+    def pause(self, out_queues):
+        """
+        in a worker, wait while the budget is used up and the next stage has batches to drain
+        :return: seconds waited
+        """
+        waited = 0.0
+        while self._pending.value > self.max_bytes and _any_not_empty(out_queues):
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+        return waited
+
+    def pending(self):
+        return self._pending.value
+
+    def peak(self):
+        return self._peak.value
+
+
+def get_memory_budget(mp_ctx, max_memory):
+    """
+    :param max_memory: --max_memory, e.g. 4G, None for no budget
+    :return: MemoryBudget, or None
+    """
+    return MemoryBudget(mp_ctx, parse_size(max_memory)) if max_memory is not None else None
+
+
+def _mb(nbytes):
+    return nbytes / 1024.0 / 1024
+
+
+def peak_rss():
+    """
+    :return: peak rss (bytes) of this process and of its largest child process waited for, -1 if
+             not available (e.g. on windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return -1, -1
+    # ru_maxrss is in KB on linux, in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale, \
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+
+
+def report_peak_memory(name, mem_budget=None):
+    rss_self, rss_children = peak_rss()
+    if rss_self < 0:
+        return
+    msg = "[{}]peak RSS: {:.1f} MB of the main process, {:.1f} MB of the largest child process".format(
+        name, _mb(rss_self), _mb(rss_children))
+    if mem_budget is not None:
+        msg += ", {:.1f} MB of batches pending at most (--max_memory {:.1f} MB)".format(
+            _mb(mem_budget.peak()), _mb(mem_budget.max_bytes))
+    sys.stderr.write(msg + "\n")
+    sys.stderr.flush()
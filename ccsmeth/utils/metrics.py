@@ -0,0 +1,211 @@
+"""
+per-stage throughput/latency counters of the reader/extract/format/call/write processes.
+each process keeps a StageMetrics and sends snapshots to a metrics queue, a MetricsMonitor thread
+in the main process aggregates them together with queue depths, and exports them periodically
+to a json-lines file, or a prometheus text file (if the file path ends with .prom).
+"""
+import os
+import sys
+import time
+import json
+import threading
+from queue import Empty
+
+metrics_interval_default = 10
+latency_buckets = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float("inf"))
+item_kinds = ("holes", "sites", "samples", "batches")
+
+
+class StageMetrics:
+    """
+    counters of one stage in one process. cheap enough to be called for every batch,
+    snapshots are only sent to metrics_q every interval seconds.
+    """
+    def __init__(self, stage, metrics_q=None, interval=metrics_interval_default):
+        self.stage = stage
+        self.pid = os.getpid()
+        self._metrics_q = metrics_q
+        self._interval = interval
+        self._items = dict([(kind, 0) for kind in item_kinds])
+        self._latency_counts = [0] * len(latency_buckets)
+        self._latency_sum = 0.0
+        self._busy = 0.0
+        self._idle = 0.0
+        self._start = time.time()
+        self._last_report = self._start
+
+    def add(self, **items):
+        for kind, num in items.items():
+            self._items[kind] = self._items.get(kind, 0) + num
+
+    def observe_batch(self, seconds):
+        self._items["batches"] += 1
+        self._busy += seconds
+        self._latency_sum += seconds
+        for idx, upper in enumerate(latency_buckets):
+            if seconds <= upper:
+                self._latency_counts[idx] += 1
+                break
+
+    def add_idle(self, seconds):
+        self._idle += seconds
+
+    def snapshot(self):
+        return {"stage": self.stage,
+                "pid": self.pid,
+                "time": time.time(),
+                "start": self._start,
+                "items": dict(self._items),
+                "latency_counts": list(self._latency_counts),
+                "latency_sum": self._latency_sum,
+                "busy": self._busy,
+                "idle": self._idle}
+
+    def report(self, force=False):
+        if self._metrics_q is None:
+            return
+        now = time.time()
+        if force or now - self._last_report >= self._interval:
+            self._metrics_q.put(self.snapshot())
+            self._last_report = now
+
+
+def _merge_snapshots(snapshots):
+    merged = {"processes": len(snapshots),
+              "items": dict([(kind, 0) for kind in item_kinds]),
+              "latency_counts": [0] * len(latency_buckets),
+              "latency_sum": 0.0,
+              "busy": 0.0,
+              "idle": 0.0,
+              "start": min([snapshot["start"] for snapshot in snapshots])}
+    for snapshot in snapshots:
+        for kind, num in snapshot["items"].items():
+            merged["items"][kind] = merged["items"].get(kind, 0) + num
+        for idx, cnt in enumerate(snapshot["latency_counts"]):
+            merged["latency_counts"][idx] += cnt
+        merged["latency_sum"] += snapshot["latency_sum"]
+        merged["busy"] += snapshot["busy"]
+        merged["idle"] += snapshot["idle"]
+    return merged
+
+
+class MetricsMonitor(threading.Thread):
+    """
+    runs in the main process. queues: dict of queue_name -> queue, whose depths are sampled
+    at each export.
+    """
+    def __init__(self, metrics_q, output_path, queues=None, interval=metrics_interval_default):
+        super(MetricsMonitor, self).__init__()
+        self.daemon = True
+        self._metrics_q = metrics_q
+        self._output_path = os.path.abspath(output_path)
+        self._is_prom = output_path.endswith(".prom")
+        self._queues = queues if queues is not None else {}
+        self._interval = interval
+        self._latest = {}  # (stage, pid) -> snapshot
+        self._prev_items = {}  # stage -> (time, items), for rates between two exports
+        self._stop_event = threading.Event()
+        self._start_time = time.time()
+        if not self._is_prom:
+            open(self._output_path, "w").close()
+
+    def _drain(self, timeout):
+        try:
+            snapshot = self._metrics_q.get(timeout=timeout)
+            self._latest[(snapshot["stage"], snapshot["pid"])] = snapshot
+            while True:
+                snapshot = self._metrics_q.get_nowait()
+                self._latest[(snapshot["stage"], snapshot["pid"])] = snapshot
+        except Empty:
+            pass
+
+    def _queue_depths(self):
+        depths = {}
+        for qname, q in self._queues.items():
+            try:
+                depths[qname] = q.qsize()
+            except NotImplementedError:  # e.g. macOS
+                depths[qname] = -1
+        return depths
+
+    def collect(self):
+        now = time.time()
+        stage2snapshots = {}
+        for (stage, _), snapshot in self._latest.items():
+            stage2snapshots.setdefault(stage, []).append(snapshot)
+        stages = {}
+        for stage, snapshots in stage2snapshots.items():
+            merged = _merge_snapshots(snapshots)
+            prev_time, prev_items = self._prev_items.get(stage, (merged["start"], {}))
+            duration = max(now - prev_time, 1e-6)
+            merged["rates"] = dict([(kind + "_per_s", round((num - prev_items.get(kind, 0)) / duration, 3))
+                                    for kind, num in merged["items"].items()])
+            busy_idle = merged["busy"] + merged["idle"]
+            merged["busy_ratio"] = round(merged["busy"] / busy_idle, 4) if busy_idle > 0 else 0.0
+            self._prev_items[stage] = (now, dict(merged["items"]))
+            stages[stage] = merged
+        return {"time": round(now, 3),
+                "elapsed": round(now - self._start_time, 3),
+                "queues": self._queue_depths(),
+                "stages": stages}
+
+    def _write_jsonl(self, record):
+        with open(self._output_path, "a") as wf:
+            wf.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def _write_prom(self, record):
+        lines = ["# TYPE ccsmeth_elapsed_seconds gauge",
+                 "ccsmeth_elapsed_seconds {}".format(record["elapsed"]),
+                 "# TYPE ccsmeth_queue_depth gauge"]
+        for qname, depth in sorted(record["queues"].items()):
+            lines.append('ccsmeth_queue_depth{{queue="{}"}} {}'.format(qname, depth))
+        lines += ["# TYPE ccsmeth_stage_items_total counter",
+                  "# TYPE ccsmeth_stage_items_per_second gauge",
+                  "# TYPE ccsmeth_stage_busy_seconds_total counter",
+                  "# TYPE ccsmeth_stage_idle_seconds_total counter",
+                  "# TYPE ccsmeth_stage_processes gauge",
+                  "# TYPE ccsmeth_stage_batch_latency_seconds histogram"]
+        for stage, merged in sorted(record["stages"].items()):
+            for kind, num in sorted(merged["items"].items()):
+                lines.append('ccsmeth_stage_items_total{{stage="{}",item="{}"}} {}'.format(stage, kind, num))
+                lines.append('ccsmeth_stage_items_per_second{{stage="{}",item="{}"}} {}'.format(
+                    stage, kind, merged["rates"][kind + "_per_s"]))
+            lines.append('ccsmeth_stage_busy_seconds_total{{stage="{}"}} {:.3f}'.format(stage, merged["busy"]))
+            lines.append('ccsmeth_stage_idle_seconds_total{{stage="{}"}} {:.3f}'.format(stage, merged["idle"]))
+            lines.append('ccsmeth_stage_processes{{stage="{}"}} {}'.format(stage, merged["processes"]))
+            cumulative = 0
+            for upper, cnt in zip(latency_buckets, merged["latency_counts"]):
+                cumulative += cnt
+                le = "+Inf" if upper == float("inf") else str(upper)
+                lines.append('ccsmeth_stage_batch_latency_seconds_bucket{{stage="{}",le="{}"}} {}'.format(
+                    stage, le, cumulative))
+            lines.append('ccsmeth_stage_batch_latency_seconds_sum{{stage="{}"}} {:.3f}'.format(
+                stage, merged["latency_sum"]))
+            lines.append('ccsmeth_stage_batch_latency_seconds_count{{stage="{}"}} {}'.format(stage, cumulative))
+        # write to a tmp file then rename, so that a scraper never sees a half-written file
+        tmp_path = self._output_path + ".tmp"
+        with open(tmp_path, "w") as wf:
+            wf.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self._output_path)
+
+    def export(self):
+        record = self.collect()
+        if self._is_prom:
+            self._write_prom(record)
+        else:
+            self._write_jsonl(record)
+
+    def run(self):
+        last_export = time.time()
+        while not self._stop_event.is_set():
+            self._drain(timeout=1)
+            if time.time() - last_export >= self._interval:
+                self.export()
+                last_export = time.time()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self._drain(timeout=0.1)
+        self.export()
+        sys.stderr.write("metrics of all stages saved in {}\n".format(self._output_path))
@@ -0,0 +1,73 @@
+"""
+modification frequency of sites, aggregated from per-read calls as they are written, in the same
+formats as scripts/call_modification_frequency.py (tsv, or bedMethyl with --bed)
+"""
+
+
+class SiteStats:
+    def __init__(self, strand, kmer):
+
+        self._strand = strand
+        self._kmer = kmer
+
+        self._prob_0 = 0.0
+        self._prob_1 = 0.0
+        self._met = 0
+        self._unmet = 0
+        self._coverage = 0
+
+
+class ModFreqAggregator:
+    def __init__(self, prob_cf=0.0, rm_1strand=False):
+        self._prob_cf = prob_cf
+        self._rm_1strand = rm_1strand
+        self._sitekey2stats = dict()
+        self.count = 0
+        self.used = 0
+
+    def add(self, pred_str):
+        """
+        :param pred_str: a call of call_mods: chromosome, pos, strand, holeid, depth, prob_0, prob_1,
+                         called_label, kmer
+        """
+        self.count += 1
+        words = pred_str.split("\t")
+        depthstr = words[4]
+        if self._rm_1strand and "," not in depthstr:
+            return
+        prob_0, prob_1 = float(words[5]), float(words[6])
+        if abs(prob_0 - prob_1) < self._prob_cf:
+            return
+        sitekey = (words[0], int(words[1]))
+        if sitekey not in self._sitekey2stats:
+            self._sitekey2stats[sitekey] = SiteStats(words[2], words[8])
+        sitestats = self._sitekey2stats[sitekey]
+        sitestats._prob_0 += prob_0
+        sitestats._prob_1 += prob_1
+        sitestats._coverage += 1
+        if int(words[7]) == 1:
+            sitestats._met += 1
+        else:
+            sitestats._unmet += 1
+        self.used += 1
+
+    def write(self, result_file, is_sort=False, is_bed=False):
+        keys = sorted(self._sitekey2stats.keys()) if is_sort else list(self._sitekey2stats.keys())
+        with open(result_file, 'w') as wf:
+            for key in keys:
+                chrom, pos = key
+                sitestats = self._sitekey2stats[key]
+                rmet = float(sitestats._met) / sitestats._coverage
+                if is_bed:
+                    wf.write("\t".join([chrom, str(pos), str(pos + 1), ".", str(sitestats._coverage),
+                                        sitestats._strand,
+                                        str(pos), str(pos + 1), "0,0,0", str(sitestats._coverage),
+                                        str(int(round(rmet * 100, 0)))]) + "\n")
+                else:
+                    wf.write("%s\t%d\t%s\t%.3f\t%.3f\t%d\t%d\t%d\t%.4f\t%s\n" % (chrom, pos, sitestats._strand,
+                                                                                 sitestats._prob_0,
+                                                                                 sitestats._prob_1,
+                                                                                 sitestats._met, sitestats._unmet,
+                                                                                 sitestats._coverage, rmet,
+                                                                                 sitestats._kmer))
+        return len(keys)
@@ -0,0 +1,198 @@
+"""
+genome-wide index of motif sites, built once by `ccsmeth index_motifs` and memory-mapped by
+extract/call_mods/bam2bis, instead of rescanning the reference for motifs.
+file layout: magic (8 bytes), header length (uint64, little-endian), json header, then the sorted site
+arrays of each contig and strand. sites are 0-based locs of the modified base in + strand coordinates,
+for both strands (the same as abs_loc in the features/call_mods results).
+"""
+import os
+import re
+import sys
+import json
+import struct
+import numpy as np
+
+from .process_utils import get_motif_seqs
+from .process_utils import complement_seq
+
+index_magic = b"CCSMMI01"
+index_suffix = ".motifs.idx"
+array_align = 8
+
+
+def _find_sites(seqstr, motif_seqs, loc_in_seq):
+    """
+    starts (+loc_in_seq) of all, possibly overlapping, occurrences of motif_seqs in seqstr, sorted
+    """
+    if len(motif_seqs) == 0:
+        return np.array([], dtype=np.int64)
+    pattern = re.compile("(?=(?:" + "|".join([re.escape(motif) for motif in motif_seqs]) + "))")
+    return np.fromiter((m.start() + loc_in_seq for m in pattern.finditer(seqstr)), dtype=np.int64)
+
+
+def find_motif_sites_of_contig(contigseq, motif_seqs, mod_loc):
+    """
+    :return: sorted sites of + strand and - strand, in + strand coordinates
+    """
+    motiflen = len(motif_seqs[0])
+    fwd_sites = _find_sites(contigseq, sorted(set(motif_seqs)), mod_loc)
+    # a motif in - strand is its reverse complement in + strand, read backwards
+    rc_motif_seqs = sorted(set([complement_seq(motif) for motif in motif_seqs]))
+    bwd_sites = _find_sites(contigseq, rc_motif_seqs, motiflen - 1 - mod_loc)
+    return fwd_sites, bwd_sites
+
+
+def build_motif_index(ref_path, motifs, mod_loc, index_path):
+    from .ref_reader import load_reference_contigs
+
+    motif_seqs = get_motif_seqs(motifs)
+    if len(set([len(motif) for motif in motif_seqs])) != 1:
+        raise ValueError("motifs must be of the same length")
+    if not 0 <= mod_loc < len(motif_seqs[0]):
+        raise ValueError("mod_loc is out of the range of the motifs")
+    contigs = load_reference_contigs(ref_path)
+    contignames = list(contigs.keys())
+    dtype = "<u4" if max([len(contigs[name]) for name in contignames] + [0]) < 2 ** 32 else "<i8"
+
+    tmp_path = index_path + ".tmp.{}".format(os.getpid())
+    contig_infos = []
+    data_offset = 0
+    with open(tmp_path, "wb") as wf:
+        # sites are written first, the header is prepended when all offsets are known
+        for contigname in contignames:
+            contigseq = str(contigs[contigname])
+            fwd_sites, bwd_sites = find_motif_sites_of_contig(contigseq, motif_seqs, mod_loc)
+            del contigseq
+            contig_info = {"name": contigname, "len": len(contigs[contigname])}
+            for strand, sites in (("+", fwd_sites), ("-", bwd_sites)):
+                contig_info[strand] = [data_offset, len(sites)]
+                sites = np.sort(sites).astype(dtype)
+                wf.write(sites.tobytes())
+                data_offset += sites.nbytes
+            contig_infos.append(contig_info)
+            sys.stderr.write("{}: {} sites in + strand, {} in - strand\n".format(contigname, len(fwd_sites),
+                                                                                len(bwd_sites)))
+    header = {"ref": os.path.abspath(ref_path),
+              "motifs": motifs,
+              "motif_seqs": sorted(set(motif_seqs)),
+              "mod_loc": mod_loc,
+              "dtype": dtype,
+              "contigs": contig_infos}
+    headerbytes = json.dumps(header).encode()
+    headerbytes += b" " * ((-(len(index_magic) + 8 + len(headerbytes))) % array_align)
+    with open(index_path, "wb") as wf, open(tmp_path, "rb") as rf:
+        wf.write(index_magic)
+        wf.write(struct.pack("<Q", len(headerbytes)))
+        wf.write(headerbytes)
+        while True:
+            chunk = rf.read(1 << 24)
+            if not chunk:
+                break
+            wf.write(chunk)
+    os.remove(tmp_path)
+    return index_path
+
+
+class MotifIndex:
+    """
+    memory-mapped motif index. only the path is pickled, so it is cheap to send to worker
+    processes, the sites are shared by all processes through the os page cache.
+    """
+    def __init__(self, index_path):
+        self._path = os.path.abspath(index_path)
+        with open(self._path, "rb") as rf:
+            if rf.read(len(index_magic)) != index_magic:
+                raise ValueError("{} is not a motif index of ccsmeth".format(index_path))
+            headerlen = struct.unpack("<Q", rf.read(8))[0]
+            self._header = json.loads(rf.read(headerlen).decode())
+        self._data_offset = len(index_magic) + 8 + headerlen
+        self._contig2info = dict([(info["name"], info) for info in self._header["contigs"]])
+        self._sites = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_sites"] = None
+        return state
+
+    def _get_sites_array(self):
+        if self._sites is None:
+            if os.path.getsize(self._path) == self._data_offset:
+                self._sites = np.array([], dtype=self._header["dtype"])
+            else:
+                self._sites = np.memmap(self._path, dtype=self._header["dtype"], mode="r",
+                                        offset=self._data_offset)
+        return self._sites
+
+    def getmotifseqs(self):
+        return self._header["motif_seqs"]
+
+    def getmodloc(self):
+        return self._header["mod_loc"]
+
+    def getcontignames(self):
+        return [info["name"] for info in self._header["contigs"]]
+
+    def getcontiglen(self, contigname):
+        return self._contig2info[contigname]["len"]
+
+    def get_sites(self, contigname, strand="+", start=0, end=None):
+        """
+        sorted sites in [start, end) of a strand of a contig, as a read-only numpy view
+        """
+        if contigname not in self._contig2info:
+            return np.array([], dtype=np.int64)
+        offset, count = self._contig2info[contigname][strand]
+        itemsize = np.dtype(self._header["dtype"]).itemsize
+        sites = self._get_sites_array()[(offset // itemsize):(offset // itemsize + count)]
+        lidx = np.searchsorted(sites, start, side="left") if start > 0 else 0
+        ridx = np.searchsorted(sites, end, side="left") if end is not None else len(sites)
+        return sites[lidx:ridx]
+
+    def check_compatible(self, motif_seqs, mod_loc, contigs=None):
+        """
+        raise ValueError if the index was not built with the same motifs/mod_loc (and reference)
+        """
+        if sorted(set(motif_seqs)) != self.getmotifseqs() or mod_loc != self.getmodloc():
+            raise ValueError("motif index {} was built with --motifs {} --mod_loc {}, which are not the same as "
+                             "the args".format(self._path, self._header["motifs"], self.getmodloc()))
+        if contigs is not None:
+            self.check_contigs([(contigname, len(contigs[contigname])) for contigname in contigs.keys()])
+
+    def check_contigs(self, contig_lens):
+        """
+        raise ValueError if a contig of the reference is not in the index, or is of another length, as
+        get_sites() finds no sites in a contig not in the index
+        :param contig_lens: [(contig name, length), ] of the reference
+        """
+        missing = [contigname for contigname, _ in contig_lens if contigname not in self._contig2info]
+        if len(missing) > 0:
+            raise ValueError("{} contigs of the reference are not in motif index {} ({}{}), the index must be "
+                             "built from the same reference".format(len(missing), self._path,
+                                                                    ", ".join(missing[:5]),
+                                                                    ", .." if len(missing) > 5 else ""))
+        for contigname, contiglen in contig_lens:
+            if contiglen != self.getcontiglen(contigname):
+                raise ValueError("length of contig {} in motif index {} is not the same as in "
+                                 "the reference".format(contigname, self._path))
+
+
+_path2index = {}
+
+
+def load_motif_index(index_path):
+    """
+    MotifIndex of index_path, opened at most once in each process
+    """
+    if index_path not in _path2index:
+        _path2index[index_path] = MotifIndex(index_path)
+    return _path2index[index_path]
+
+
+def index_motifs(args):
+    reference = os.path.abspath(args.ref)
+    if not os.path.exists(reference):
+        raise IOError("refernce(--ref) file does not exist!")
+    index_path = args.output if args.output is not None else reference + index_suffix
+    sys.stderr.write("[index_motifs]start..\n")
+    build_motif_index(reference, args.motifs, args.mod_loc, index_path)
+    sys.stderr.write("[index_motifs]motif index saved in {}\n".format(index_path))
@@ -0,0 +1,45 @@
+"""
+multiprocessing context of call_mods workers. forkserver is preferred: the server process imports
+the heavy modules once (numpy, torch, ccsmeth), and each worker is forked from it, so workers start
+in milliseconds and share the read-only pages of the preloaded modules. the server is started
+before the main process touches torch/CUDA, and nothing in the preloaded modules runs torch ops or
+initializes CUDA (ccsmeth.models/constants_torch are not preloaded, they call
+torch.cuda.is_available()), so the forked workers are safe to create their own torch threads and
+CUDA contexts. falls back to spawn where forkserver is not available (e.g. Windows).
+ccsmeth.call_modifications itself is not preloaded, only what it imports: it is the __main__ module
+when run as `python -m ccsmeth.call_modifications`, and preloading it would run it again in each
+worker (with a RuntimeWarning of runpy); it is imported by the workers in no time on top of its
+preloaded dependencies.
+"""
+import multiprocessing as mp
+
+start_methods = ("forkserver", "spawn")
+forkserver_preload = ["numpy",
+                      "torch",
+                      "ccsmeth.extract_features",
+                      "ccsmeth.ccs_features",
+                      "ccsmeth.utils.process_utils",
+                      "ccsmeth.utils.ref_reader",
+                      "ccsmeth.utils.motif_index",
+                      "ccsmeth.utils.metrics",
+                      "ccsmeth.utils.batch_tuner",
+                      "ccsmeth.utils.reorder",
+                      "ccsmeth.utils.mem_budget",
+                      "ccsmeth.utils.profiling",
+                      "ccsmeth.utils.mod_freq",
+                      "ccsmeth.utils.ccs_filter"]
+
+
+def get_mp_context(start_method="forkserver", preload=None):
+    """
+    :param start_method: forkserver or spawn
+    :param preload: modules imported by the forkserver, default forkserver_preload
+    """
+    if start_method not in start_methods:
+        raise ValueError("start_method must be one of {}".format(", ".join(start_methods)))
+    if start_method == "forkserver" and "forkserver" not in mp.get_all_start_methods():
+        start_method = "spawn"
+    ctx = mp.get_context(start_method)
+    if start_method == "forkserver":
+        ctx.set_forkserver_preload(forkserver_preload if preload is None else preload)
+    return ctx
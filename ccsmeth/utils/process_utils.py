@@ -19,6 +19,10 @@ base2code_dna = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'N': 4,
                  'Y': 4, 'B': 4, 'V': 4, 'D': 4, 'H': 4,
                  'Z': 4}  # set 4 for all bases except ACGT, for now
 code2base_dna = {0: 'A', 1: 'C', 2: 'G', 3: 'T', 4: 'N'}
+# base2code_dna indexed by the byte of a base, to encode many kmers at once
+base2code_dna_table = np.full(256, base2code_dna['N'], dtype=np.int64)
+for _base, _code in base2code_dna.items():
+    base2code_dna_table[ord(_base)] = _code
 base2code_rna = {'A': 0, 'C': 1, 'G': 2, 'U': 3, 'N': 4,
                  'W': 4, 'S': 4, 'M': 4, 'K': 4, 'R': 4,
                  'Y': 4, 'B': 4, 'V': 4, 'D': 4, 'H': 4,
@@ -115,6 +119,17 @@ def _convert_motif_seq(ori_seq, is_dna=True):
     return recursive_permute(outbases)
 
 
+def kmers_to_codes(kmer_seqs):
+    """
+    :param kmer_seqs: kmers of the same length
+    :return: (n, kmer_len) array of base2code_dna codes
+    """
+    if len(kmer_seqs) == 0:
+        return np.zeros((0, 0), dtype=np.int64)
+    codes = base2code_dna_table[np.frombuffer("".join(kmer_seqs).encode(), dtype=np.uint8)]
+    return codes.reshape(len(kmer_seqs), -1)
+
+
 def get_motif_seqs(motifs, is_dna=True):
     ori_motif_seqs = motifs.strip().split(',')
 
@@ -167,6 +182,30 @@ def generate_samtools_view_cmd(path_to_samtools):
     return samtools + " view -@ 3 -h"
 
 
+class SamWriter(object):
+    """
+    write sam text to a .sam file, or to a .bam file through samtools
+    """
+    def __init__(self, path, header, path_to_samtools=None, threads=1):
+        self._proc = None
+        if path.endswith(".bam"):
+            samtools = samtools_exec if path_to_samtools is None else os.path.abspath(path_to_samtools)
+            cmd = "{} view -b -@ {} -o {} -".format(samtools, threads, path)
+            self._proc = Popen(cmd, shell=True, stdin=PIPE, universal_newlines=True)
+            self._wf = self._proc.stdin
+        else:
+            self._wf = open(path, "w")
+        self._wf.write(header)
+
+    def write(self, fields):
+        self._wf.write("\t".join(fields) + "\n")
+
+    def close(self):
+        self._wf.close()
+        if self._proc is not None and self._proc.wait() != 0:
+            raise RuntimeError("samtools failed in writing bam")
+
+
 # =================================================================
 def count_line_num(sl_filepath, fheader=False):
     count = 0
@@ -253,6 +292,26 @@ def concat_two_files(file1, file2, concated_fp, shuffle_lines_num=2000000,
 # =================================================================
 
 
+# scale of MAD to be a consistent estimator of std for normal data: scipy.stats.norm.ppf(0.75),
+# the same as statsmodels.robust.mad()
+mad_normal_scale = 0.6744897501960817
+
+
+def mad(signals):
+    """
+    median absolute deviation, scaled to std, same as statsmodels.robust.mad(signals)
+    """
+    signals = np.asarray(signals)
+    return float(np.median(np.abs(signals - np.median(signals))) / mad_normal_scale)
+
+
+def accuracy_score(labels, predicted):
+    """
+    fraction of same labels, same as sklearn.metrics.accuracy_score(labels, predicted)
+    """
+    return float(np.mean(np.asarray(labels) == np.asarray(predicted))) if len(labels) > 0 else 0.0
+
+
 def codecv1_to_frame():
     code2frames = dict()
     for i in range(0, 64):
@@ -0,0 +1,97 @@
+"""
+profiling hooks for the worker processes: with --profile DIR, each worker runs under cProfile
+(and optionally the torch profiler for call workers), dumps its stats to DIR/stage.pid.prof,
+and the main process merges all stats of one run into one report at shutdown.
+"""
+import os
+import sys
+import time
+import glob
+import cProfile
+import pstats
+
+prof_suffix = ".prof"
+report_topn = 60
+
+
+def _run_profiled(target, target_args, profile_dir, stage, torch_profile=False):
+    prof_path = os.path.join(profile_dir, "{}.{}{}".format(stage, os.getpid(), prof_suffix))
+    profiler = cProfile.Profile()
+    tprof = None
+    if torch_profile:
+        import torch
+        tprof = torch.autograd.profiler.profile()
+        tprof.__enter__()
+    profiler.enable()
+    try:
+        target(*target_args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(prof_path)
+        if tprof is not None:
+            tprof.__exit__(None, None, None)
+            tprof_path = os.path.join(profile_dir, "{}.{}.torch".format(stage, os.getpid()))
+            with open(tprof_path + ".txt", "w") as wf:
+                wf.write(tprof.key_averages().table(sort_by="self_cpu_time_total") + "\n")
+            tprof.export_chrome_trace(tprof_path + ".trace.json")
+
+
+def wrap_target(target, target_args, profile_dir=None, stage="worker", torch_profile=False):
+    """
+    return (target, args) for mp.Process(), wrapped with cProfile if profile_dir is set.
+    :param target: worker function, must be picklable (module-level)
+    :param target_args: tuple of args of target
+    """
+    if profile_dir is None:
+        return target, target_args
+    return _run_profiled, (target, target_args, profile_dir, stage, torch_profile)
+
+
+def prepare_profile_dir(profile_dir):
+    """
+    :return: abspath of profile_dir and the start time of this run, prof files older than the
+    start time are not merged
+    """
+    if profile_dir is None:
+        return None, None
+    profile_dir = os.path.abspath(profile_dir)
+    if not os.path.exists(profile_dir):
+        os.makedirs(profile_dir)
+    return profile_dir, time.time()
+
+
+def _stage_of_prof(prof_path):
+    return os.path.basename(prof_path).split(".")[0]
+
+
+def merge_profiles(profile_dir, since=None, title="ccsmeth"):
+    """
+    merge all stage.pid.prof files in profile_dir into merged.prof, and write a text report
+    (overall and per-stage, sorted by cumulative time) to report.txt.
+    """
+    prof_paths = sorted(glob.glob(os.path.join(profile_dir, "*.*" + prof_suffix)))
+    if since is not None:
+        prof_paths = [prof_path for prof_path in prof_paths if os.path.getmtime(prof_path) >= since]
+    prof_paths = [prof_path for prof_path in prof_paths
+                  if not os.path.basename(prof_path).startswith("merged.")]
+    if len(prof_paths) == 0:
+        sys.stderr.write("no profile stats found in {}\n".format(profile_dir))
+        return None
+
+    stage2paths = {}
+    for prof_path in prof_paths:
+        stage2paths.setdefault(_stage_of_prof(prof_path), []).append(prof_path)
+
+    report_path = os.path.join(profile_dir, "report.txt")
+    with open(report_path, "w") as wf:
+        wf.write("# {} profile report, {} processes\n".format(title, len(prof_paths)))
+        merged = pstats.Stats(*prof_paths, stream=wf)
+        merged.dump_stats(os.path.join(profile_dir, "merged" + prof_suffix))
+        wf.write("\n## all processes\n")
+        merged.strip_dirs().sort_stats("cumulative").print_stats(report_topn)
+        for stage in sorted(stage2paths.keys()):
+            wf.write("\n## stage {}, {} processes\n".format(stage, len(stage2paths[stage])))
+            stage_stats = pstats.Stats(*stage2paths[stage], stream=wf)
+            stage_stats.strip_dirs().sort_stats("cumulative").print_stats(report_topn)
+    sys.stderr.write("profile report of {} processes saved in {}\n".format(len(prof_paths), report_path))
+    return report_path
@@ -1,10 +1,19 @@
 from __future__ import absolute_import
 
+import os
+import sys
+import mmap
+
 from .process_utils import complement_seq
 from .process_utils import get_refloc_of_methysite_in_motif
 
+fai_suffix = ".fai"
+cache_suffix = ".ccsmeth.seq"  # uppercased sequences of all contigs, 1 byte per base, no newlines
+
 
 def get_contig2len(ref_path):
+    if os.path.exists(ref_path + fai_suffix):
+        return dict([(name, length) for name, length, _, _, _ in read_fai(ref_path + fai_suffix)])
     refseq = DNAReference(ref_path)
     chrom2len = {}
     for contigname in refseq.getcontignames():
@@ -17,16 +26,16 @@ def get_contigs_of_ref(reffile):
     contig2seq = {}
     with open(reffile, 'r') as rf:
         contigname = ''
-        contigseq = ''
+        contiglines = []
         for line in rf:
             if line.startswith('>'):
-                if contigname != '' and contigseq != '':
-                    contig2seq[contigname] = contigseq
+                if contigname != '' and len(contiglines) > 0:
+                    contig2seq[contigname] = "".join(contiglines)
                 contigname = line.strip()[1:].split(' ')[0]
-                contigseq = ''
+                contiglines = []
             else:
-                contigseq += line.strip()
-        contig2seq[contigname] = contigseq
+                contiglines.append(line.strip())
+        contig2seq[contigname] = "".join(contiglines)
     return contig2seq
 
 
@@ -36,18 +45,18 @@ class DNAReference:
         self._contigs = {}  # contigname 2 contigseq
         with open(reffile, 'r') as rf:
             contigname = ''
-            contigseq = ''
+            contiglines = []
             for line in rf:
                 if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
+                    if contigname != '' and len(contiglines) > 0:
+                        self._contigs[contigname] = "".join(contiglines)
                         self._contignames.append(contigname)
                     contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
+                    contiglines = []
                 else:
                     # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
+                    contiglines.append(line.strip().upper())
+            self._contigs[contigname] = "".join(contiglines)
             self._contignames.append(contigname)
 
     def getcontigs(self):
@@ -57,12 +66,202 @@ class DNAReference:
         return self._contignames
 
 
+def build_fai(ref_path, fai_path=None):
+    """
+    write a samtools-compatible .fai index of ref_path: name, length, offset, linebases, linewidth.
+    all lines of a contig except the last must have the same length.
+    :return: fai_path
+    """
+    fai_path = ref_path + fai_suffix if fai_path is None else fai_path
+    records = []
+    with open(ref_path, 'rb') as rf:
+        name = None
+        offset = 0
+        length, linebases, linewidth, seq_offset = 0, 0, 0, 0
+        short_line_seen = False
+        for line in rf:
+            if line.startswith(b'>'):
+                if name is not None:
+                    records.append((name, length, seq_offset, linebases, linewidth))
+                name = line[1:].strip().split()[0].decode()
+                seq_offset = offset + len(line)
+                length, linebases, linewidth = 0, 0, 0
+                short_line_seen = False
+            else:
+                bases = len(line.rstrip(b'\r\n'))
+                if bases > 0:
+                    if linebases == 0:
+                        linebases, linewidth = bases, len(line)
+                    elif short_line_seen or bases > linebases or \
+                            (bases == linebases and len(line) != linewidth):
+                        raise ValueError("different line length in contig {} of {}, cannot be "
+                                         "indexed".format(name, ref_path))
+                    if bases < linebases:
+                        short_line_seen = True
+                    length += bases
+                else:
+                    short_line_seen = True
+            offset += len(line)
+        if name is not None:
+            records.append((name, length, seq_offset, linebases, linewidth))
+    with open(fai_path, 'w') as wf:
+        for record in records:
+            wf.write("\t".join(map(str, record)) + "\n")
+    return fai_path
+
+
+def read_fai(fai_path):
+    records = []
+    with open(fai_path, 'r') as rf:
+        for line in rf:
+            words = line.strip().split("\t")
+            records.append((words[0], int(words[1]), int(words[2]), int(words[3]), int(words[4])))
+    return records
+
+
+def _is_outdated(path, ref_path):
+    return (not os.path.exists(path)) or os.path.getmtime(path) < os.path.getmtime(ref_path)
+
+
+def build_seq_cache(ref_path, fai_records, cache_path=None):
+    """
+    write the uppercased sequences of all contigs (in the order of .fai) into one file without
+    newlines, so that a contig slice is one contiguous range of the file.
+    """
+    cache_path = ref_path + cache_suffix if cache_path is None else cache_path
+    tmp_path = cache_path + ".tmp.{}".format(os.getpid())
+    with open(ref_path, 'rb') as rf, open(tmp_path, 'wb') as wf:
+        mm = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+        for _, length, offset, linebases, linewidth in fai_records:
+            for lstart in range(0, length, linebases):
+                fstart = offset + (lstart // linebases) * linewidth
+                wf.write(mm[fstart:(fstart + min(linebases, length - lstart))].upper())
+        mm.close()
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+# path -> mmap, opened at most once in each process and shared by all contigs of the file, so that
+# the pages are shared by all processes through the os page cache
+_path2mmap = {}
+
+
+def _get_mmap(path):
+    if path not in _path2mmap:
+        with open(path, 'rb') as rf:
+            _path2mmap[path] = mmap.mmap(rf.fileno(), 0, access=mmap.ACCESS_READ)
+    return _path2mmap[path]
+
+
+class MmapContig:
+    """
+    read-only str-like view of a contig in a memory-mapped fasta (via .fai) or in a cache file of
+    uppercased bases (linebases=0), supports len() and slicing, e.g. contig[start:end] -> str.
+    only the path and the offsets are pickled, so it is cheap to send to worker processes.
+    """
+    def __init__(self, path, length, offset, linebases=0, linewidth=0):
+        self._path = path
+        self._len = length
+        self._offset = offset
+        self._linebases = linebases
+        self._linewidth = linewidth
+
+    def __len__(self):
+        return self._len
+
+    def _fileloc(self, loc):
+        if self._linebases == 0:
+            return self._offset + loc
+        return self._offset + (loc // self._linebases) * self._linewidth + loc % self._linebases
+
+    def _getrange(self, start, end):
+        if start >= end:
+            return ""
+        mm = _get_mmap(self._path)
+        if self._linebases == 0:
+            return mm[self._fileloc(start):self._fileloc(end)].decode()
+        seqbytes = mm[self._fileloc(start):(self._fileloc(end - 1) + 1)]
+        return seqbytes.replace(b'\n', b'').replace(b'\r', b'').upper().decode()
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, end, step = item.indices(self._len)
+            if step == 1:
+                return self._getrange(start, end)
+            locs = range(start, end, step)
+            if len(locs) == 0:
+                return ""
+            return self._getrange(min(locs[0], locs[-1]), max(locs[0], locs[-1]) + 1)[::step]
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError("contig index out of range")
+        return self._getrange(item, item + 1)
+
+    def __str__(self):
+        return self._getrange(0, self._len)
+
+
+class IndexedReference:
+    """
+    same interface as DNAReference, but contigs are MmapContigs of the memory-mapped reference,
+    instead of str in memory. the .fai index is built if it does not exist.
+    :param use_cache: serve the contigs from a pre-uppercased cache file (ref_path.ccsmeth.seq,
+    built if it does not exist), which avoids stripping newlines/uppercasing of each slice.
+    """
+    def __init__(self, reffile, use_cache=False):
+        reffile = os.path.abspath(reffile)
+        fai_path = reffile + fai_suffix
+        if _is_outdated(fai_path, reffile):
+            build_fai(reffile, fai_path)
+        fai_records = read_fai(fai_path)
+        self._contignames = [record[0] for record in fai_records]
+        self._contigs = {}
+        if use_cache:
+            cache_path = reffile + cache_suffix
+            if _is_outdated(cache_path, reffile) or \
+                    os.path.getsize(cache_path) != sum([record[1] for record in fai_records]):
+                sys.stderr.write("building sequence cache of reference: {}\n".format(cache_path))
+                build_seq_cache(reffile, fai_records, cache_path)
+            cache_offset = 0
+            for name, length, _, _, _ in fai_records:
+                self._contigs[name] = MmapContig(cache_path, length, cache_offset)
+                cache_offset += length
+        else:
+            for name, length, offset, linebases, linewidth in fai_records:
+                self._contigs[name] = MmapContig(reffile, length, offset, linebases, linewidth)
+
+    def getcontigs(self):
+        return self._contigs
+
+    def getcontignames(self):
+        return self._contignames
+
+
+def load_reference_contigs(reffile, use_cache=False):
+    """
+    contigs of reffile as memory-mapped MmapContigs, or as str in memory (DNAReference) if the
+    reference cannot be indexed (e.g. lines of different lengths, or the dir is not writable).
+    """
+    try:
+        return IndexedReference(reffile, use_cache).getcontigs()
+    except (ValueError, IOError, OSError) as e:
+        sys.stderr.write("cannot memory-map reference ({}), loading it into memory\n".format(e))
+        return DNAReference(reffile).getcontigs()
+
+
 class DNAContig:
-    def __init__(self, contigname, contigseq):
+    def __init__(self, contigname, contigseq, motif_index=None):
+        """
+        :param motif_index: MotifIndex of CG (mod_loc 0), to get CpG sites from instead of scanning
+        """
         self._name = contigname
         self._seq = contigseq
         self._len = len(contigseq)
         self._complementseq = complement_seq(contigseq)
+        self._motif_index = None
+        if motif_index is not None and motif_index.getmotifseqs() == ['CG'] and motif_index.getmodloc() == 0:
+            self._motif_index = motif_index
 
     def getseq(self):
         return self._seq
@@ -77,9 +276,14 @@ class DNAContig:
         return self._name
 
     def get_seq_CpG_sites(self):
+        if self._motif_index is not None:
+            return self._motif_index.get_sites(self._name, "+").tolist()
         return get_refloc_of_methysite_in_motif(self._seq, {'CG'}, 0)
 
     def get_comseq_CpG_sites(self):
+        if self._motif_index is not None:
+            # sites of - strand in the index are in + strand coordinates
+            return (self._len - 1 - self._motif_index.get_sites(self._name, "-").astype(int))[::-1].tolist()
         return get_refloc_of_methysite_in_motif(self._complementseq, {'CG'}, 0)
 
     def get_subseq_start_sites_of_seq(self, subseq, offsetloc=0):
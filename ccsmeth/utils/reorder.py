@@ -0,0 +1,84 @@
+"""
+hole-ordered output. the reader tags each batch of holes with a sequence number (0, 1, ...), which is
+carried along with the batch by the extract/format/call workers, one output batch for each input
+batch (empty if the holes have no sites). a writer keeps the batches which are done ahead of their
+turn in a ReorderBuffer, and writes them in sequence order, so that the output is in the hole order
+of the input whatever the number of workers. the reader waits before putting batch seq until all
+writers have written the batches before seq - window (OrderWindow), so that at most window batches
+wait in the buffer of a writer.
+"""
+import time
+
+reorder_window_default = 64
+wait_seconds = 0.05
+
+
+class ReorderBuffer:
+    """
+    in a writer process.
+    :param written: mp.Value of OrderWindow, the number of batches written is kept in it for the reader
+    """
+    def __init__(self, written=None):
+        self._pending = {}
+        self._next_seq = 0
+        self._written = written
+        self.max_pending = 0
+
+    def push(self, seq, batch):
+        """
+        :return: batches ready to be written, in sequence order
+        """
+        self._pending[seq] = batch
+        self.max_pending = max(self.max_pending, len(self._pending))
+        ready = []
+        while self._next_seq in self._pending:
+            ready.append(self._pending.pop(self._next_seq))
+            self._next_seq += 1
+        if len(ready) > 0 and self._written is not None:
+            self._written.value = self._next_seq
+        return ready
+
+    def flush(self):
+        """
+        batches left in the buffer at the end, whose predecessors never came (e.g. a worker failed),
+        in sequence order
+        """
+        ready = [self._pending[seq] for seq in sorted(self._pending.keys())]
+        self._pending = {}
+        return ready
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class OrderWindow:
+    """
+    number of batches written by each writer, shared by the reader and the writers.
+    """
+    def __init__(self, mp_ctx, window=reorder_window_default, nwriters=1):
+        if window < 1:
+            raise ValueError("window of OrderWindow must be >= 1")
+        self.window = window
+        self._written = [mp_ctx.Value("q", 0) for _ in range(nwriters)]
+
+    def written(self, writer_idx=0):
+        return self._written[writer_idx]
+
+    def wait(self, seq):
+        """
+        wait until batch seq is in the window of all writers
+        :return: seconds waited
+        """
+        waited = 0.0
+        while seq - min([written.value for written in self._written]) >= self.window:
+            time.sleep(wait_seconds)
+            waited += wait_seconds
+        return waited
+
+
+def get_order_window(mp_ctx, window, nwriters=1):
+    """
+    :param window: --reorder_window, 0 to write batches as they are done
+    :return: OrderWindow, or None if window is 0
+    """
+    return OrderWindow(mp_ctx, window, nwriters) if window > 0 else None
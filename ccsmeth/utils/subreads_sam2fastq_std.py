@@ -6,9 +6,16 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--header_file", type=str, default=None,
                         help="file to save header in sam")
+    parser.add_argument("--holeids_file", type=str, default=None,
+                        help="file contains holeids to be kept, one per line, default keep all")
 
     args = parser.parse_args()
 
+    holeids = None
+    if args.holeids_file is not None:
+        with open(args.holeids_file, "r") as rf:
+            holeids = set([line.strip().split("\t")[0] for line in rf])
+
     for line in sys.stdin:
         headers = ""
         if str(line).startswith("@"):
@@ -18,6 +25,10 @@ def main():
             with open(args.header_file, "w") as wf:
                 wf.write(headers)
                 wf.flush()
+        if holeids is not None:
+            readwords = line[:line.find("\t")].split("/")
+            if readwords[0] + "/" + readwords[1] not in holeids:
+                continue
         words = line.strip().split("\t")
         readid = words[0]
         comments = "\t".join(words[11:])
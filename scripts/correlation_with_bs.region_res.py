@@ -16,18 +16,18 @@ class DNAReference:
         self._contigs = {}  # contigname 2 contigseq
         with open(reffile, 'r') as rf:
             contigname = ''
-            contigseq = ''
+            contiglines = []
             for line in rf:
                 if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
+                    if contigname != '' and len(contiglines) > 0:
+                        self._contigs[contigname] = "".join(contiglines)
                         self._contignames.append(contigname)
                     contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
+                    contiglines = []
                 else:
                     # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
+                    contiglines.append(line.strip().upper())
+            self._contigs[contigname] = "".join(contiglines)
             self._contignames.append(contigname)
 
     def getcontigs(self):
@@ -37,19 +37,29 @@ class DNAReference:
         return self._contignames
 
 
+def _get_contig2len(ref):
+    # only lengths are needed, read them from the .fai index if there is one
+    if os.path.exists(ref + ".fai"):
+        contig2len = {}
+        with open(ref + ".fai", "r") as rf:
+            for line in rf:
+                words = line.strip().split("\t")
+                contig2len[words[0]] = int(words[1])
+        return contig2len
+    contig2seq = DNAReference(ref).getcontigs()
+    return dict([(contig, len(contig2seq[contig])) for contig in contig2seq.keys()])
+
+
 def _generate_regions(ref, resolution, contig_prefix, contig_names):
     contigs = set(contig_names.split(",")) if contig_names is not None else None
-    dnaref = DNAReference(ref)
     contig2len = []
-    contig2seq = dnaref.getcontigs()
-    for contig in contig2seq.keys():
+    for contig, clen in _get_contig2len(ref).items():
         if contigs is not None and contig not in contigs:
             continue
         if contig_prefix is not None and (not contig.startswith(contig_prefix)):
             continue
-        contig2len.append((contig, len(contig2seq[contig])))
+        contig2len.append((contig, clen))
     contig2len = sorted(contig2len, key=lambda key: key[0])
-    del dnaref
 
     print("==contig num: {}".format(len(contig2len)))
 
@@ -3,7 +3,6 @@ import argparse
 import sys
 import time
 import numpy as np
-from statsmodels import robust
 from subprocess import Popen, PIPE
 import multiprocessing as mp
 from multiprocessing import Queue
@@ -62,18 +61,18 @@ class DNAReference:
         self._contigs = {}  # contigname 2 contigseq
         with open(reffile, 'r') as rf:
             contigname = ''
-            contigseq = ''
+            contiglines = []
             for line in rf:
                 if line.startswith('>'):
-                    if contigname != '' and contigseq != '':
-                        self._contigs[contigname] = contigseq
+                    if contigname != '' and len(contiglines) > 0:
+                        self._contigs[contigname] = "".join(contiglines)
                         self._contignames.append(contigname)
                     contigname = line.strip()[1:].split(' ')[0]
-                    contigseq = ''
+                    contiglines = []
                 else:
                     # turn to upper case
-                    contigseq += line.strip().upper()
-            self._contigs[contigname] = contigseq
+                    contiglines.append(line.strip().upper())
+            self._contigs[contigname] = "".join(contiglines)
             self._contignames.append(contigname)
 
     def getcontigs(self):
@@ -274,6 +273,20 @@ def _worker_read(inputfile, hole_align_q, args):
                                                                                                  rc_read))
 
 
+# scale of MAD to be a consistent estimator of std for normal data: scipy.stats.norm.ppf(0.75),
+# the same as statsmodels.robust.mad()
+mad_normal_scale = 0.6744897501960817
+
+
+def mad(signals):
+    """
+    median absolute deviation, scaled to std, same as statsmodels.robust.mad(signals), the same as
+    ccsmeth/utils/process_utils.py
+    """
+    signals = np.asarray(signals)
+    return float(np.median(np.abs(signals - np.median(signals))) / mad_normal_scale)
+
+
 def _normalize_signals(signals, normalize_method="zscore"):
     if normalize_method == 'zscore':
         sshift, sscale = np.mean(signals), np.std(signals)
@@ -282,7 +295,7 @@ def _normalize_signals(signals, normalize_method="zscore"):
     elif normalize_method == 'min-mean':
         sshift, sscale = np.min(signals), np.mean(signals)
     elif normalize_method == 'mad':
-        sshift, sscale = np.median(signals), np.float(robust.mad(signals))
+        sshift, sscale = np.median(signals), mad(signals)
     else:
         raise ValueError("")
     if sscale == 0.0: